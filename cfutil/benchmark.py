@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Benchmarks for the parts of the program that have to keep up with the bus.
+# Everything runs against the simulated nodes in cfutil.simulator on the
+# python-can virtual bus so no hardware is needed.  Run it with
+#
+#   python -m cfutil.benchmark --output results.json
+#
+# and compare a later run against those results with
+#
+#   python -m cfutil.benchmark --compare results.json --threshold 0.1
+#
+# which exits with an error if anything got slower by more than 10%.
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tarfile
+import tempfile
+import time
+from collections import OrderedDict
+import can
+import canfix
+import intelhex
+import cfutil.config as config
+
+# Channel of the virtual bus that the simulated nodes are on
+CHANNEL = "cfutil-bench"
+
+# Node, device and firmware verification code of the simulated nodes
+BENCH_NODE = 0x30
+BENCH_DEVICE = 0xFE
+BENCH_MODEL = 0xBE0C
+BENCH_VCODE = 0x5A5A
+
+# Types that are used for the configuration keys of the benchmark device
+CONFIG_TYPES = ("BYTE", "WORD", "SHORT", "USHORT", "INT", "UINT", "DINT", "UDINT", "FLOAT")
+
+# Parameters that the benchmark nodes publish
+PARAMETERS = (0x180, 0x181, 0x183, 0x184, 0x186, 0x190, 0x400, 0x401, 0x402)
+
+# The benchmarks in the order that they are run.  Each one is a function
+# that takes the arguments and a Results object.
+benchmarks = OrderedDict()
+
+def benchmark(name):
+    def register(func):
+        benchmarks[name] = func
+        return func
+    return register
+
+
+class Results:
+    def __init__(self):
+        self.results = OrderedDict()
+
+    def add(self, name, value, unit, higher=True):
+        self.results[name] = {"value": value, "unit": unit, "higher_is_better": higher}
+        print(f"{name:32} {value:>14.6g} {unit}")
+
+    def skip(self, name, reason):
+        self.results[name] = {"skipped": reason}
+        print(f"{name:32} {'skipped':>14} {reason}")
+
+
+# Runs func over and over until at least duration seconds have gone by and
+# returns the number of times it ran and the time it took.
+def repeat(func, duration):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count, elapsed
+
+# Returns a frame for every parameter of every node.  The values are random
+# but within the range of each parameter.
+def parameterFrames(nodecount, seed=1):
+    rand = random.Random(seed)
+    frames = []
+    for node in range(1, nodecount + 1):
+        for pid in PARAMETERS:
+            definition = canfix.protocol.parameters[pid]
+            try:
+                low, high = float(definition.min), float(definition.max)
+            except (TypeError, ValueError):
+                low, high = 0.0, 100.0
+            p = canfix.Parameter()
+            p.identifier = pid
+            p.node = node
+            p.value = rand.uniform(low, high)
+            frames.append(p.msg)
+    return frames
+
+# Node Identification responses for the nodes so that NodeThread knows
+# about them before the parameters come in
+def identificationFrames(nodecount):
+    frames = []
+    for node in range(1, nodecount + 1):
+        msg = canfix.NodeIdentification()
+        msg.sendNode = node
+        msg.destNode = config.node
+        msg.device = BENCH_DEVICE
+        msg.fwrev = 1
+        msg.model = BENCH_MODEL
+        frames.append(msg.msg)
+    return frames
+
+# Writes a random firmware image as an Intel Hex file and as a CAN-FiX
+# standard firmware file that holds the same Intel Hex file.  Returns the
+# image and the two filenames.
+def firmwareFiles(directory, size, seed=1, address=0):
+    rand = random.Random(seed)
+    image = bytes(rand.randrange(256) for x in range(size))
+    ih = intelhex.IntelHex()
+    ih.frombytes(image, offset=address)
+    hexname = os.path.join(directory, "firmware.hex")
+    ih.write_hex_file(hexname)
+    stdname = os.path.join(directory, "firmware.tar.gz")
+    index = {"files": [{"name": "firmware.hex", "type": "intelhex", "block size": 256}]}
+    with tarfile.open(stdname, "w:gz") as tf:
+        for name, data in (("index.json", json.dumps(index).encode()),
+                           ("firmware.hex", open(hexname, "rb").read())):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return image, hexname, stdname
+
+
+# Frames per second that CANBus.run() delivers to all of its connections
+# for each number of connections.  Each test gets its own CANBus on its own
+# virtual channel.
+@benchmark("fanout")
+def benchFanout(args, results):
+    from . import connection
+    msg = can.Message(arbitration_id=0x180, is_extended_id=False, data=[1, 0, 0, 0x10, 0x27])
+    for count in args.connections:
+        channel = f"{CHANNEL}-fanout-{count}"
+        bus = connection.CANBus()
+        bus.start()
+        bus.connect("virtual", channel=channel)
+        conns = [bus.get_connection() for x in range(count)]
+        sender = can.Bus(interface="virtual", channel=channel)
+        try:
+            start = time.perf_counter()
+            for x in range(args.frames):
+                sender.send(msg)
+            endtime = time.time() + 60
+            while bus.recvFrames < args.frames and time.time() < endtime:
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - start
+            results.add(f"fanout_{count}_connections", bus.recvFrames / elapsed, "frames/s")
+        finally:
+            for c in conns:
+                bus.free_connection(c)
+            sender.shutdown()
+            bus.stop()
+            bus.join()
+            bus.disconnect()
+
+# Messages per second that NodeThread.update_node() handles.  The messages
+# are parsed ahead of time since that isn't part of update_node().
+@benchmark("nodethread")
+def benchNodeThread(args, results):
+    from . import nodes
+    nt = nodes.NodeThread()
+    for frame in identificationFrames(args.nodes):
+        nt.update_node(canfix.parseMessage(frame))
+    frames = parameterFrames(args.nodes)
+    msgs = [canfix.parseMessage(frames[x % len(frames)]) for x in range(args.frames)]
+    start = time.perf_counter()
+    for msg in msgs:
+        nt.update_node(msg)
+    elapsed = time.perf_counter() - start
+    results.add("nodethread_update_node", len(msgs) / elapsed, "msgs/s")
+
+# Commands per second that App.manager() takes off the command queue and
+# puts into the widgets.  This needs a display.
+@benchmark("manager")
+def benchManager(args, results):
+    try:
+        from . import mainTk
+        app = mainTk.App(None)
+    except Exception as e:
+        results.skip("manager_drain", f"No GUI available: {e}")
+        return
+    try:
+        app.withdraw()
+        for frame in identificationFrames(args.nodes):
+            app.nt.update_node(canfix.parseMessage(frame))
+        frames = parameterFrames(args.nodes)
+        for x in range(args.frames):
+            app.nt.update_node(canfix.parseMessage(frames[x % len(frames)]))
+        count = app.cmd_queue.qsize()
+        start = time.perf_counter()
+        app.manager()
+        elapsed = time.perf_counter() - start
+        results.add("manager_drain", count / elapsed, "cmds/s")
+    finally:
+        app.destroy()
+
+# Time per key to save and load the configuration of a simulated node.  A
+# device with args.keys configuration keys is added to the devices that
+# we know about for the test.
+@benchmark("configuration")
+def benchConfiguration(args, results):
+    from . import configNode
+    from . import devices
+    from . import simulator
+    items = []
+    for key in range(1, args.keys + 1):
+        t = CONFIG_TYPES[key % len(CONFIG_TYPES)]
+        items.append({"key": key, "name": f"Key {key}", "type": t, "default": key % 100})
+    device = devices.Device("Benchmark Device", BENCH_DEVICE, BENCH_MODEL, 1)
+    device.configuration = items
+    devices.devices[(BENCH_DEVICE, BENCH_MODEL, 1)] = device
+    net = simulator.Network(CHANNEL)
+    net.addNode(simulator.Node(BENCH_NODE, BENCH_DEVICE, BENCH_MODEL, 1, eds={"configuration": items},
+                               parameters=[], latency=args.latency, statusInterval=0))
+    net.start()
+    try:
+        start = time.perf_counter()
+        cfg = configNode.getNodeConfiguration(BENCH_NODE)
+        elapsed = time.perf_counter() - start
+        if len(cfg["items"]) != args.keys:
+            raise RuntimeError(f"Only {len(cfg['items'])} of {args.keys} keys were read")
+        results.add("configuration_save", elapsed / args.keys * 1000, "ms/key", False)
+
+        for differential in (False, True):
+            start = time.perf_counter()
+            failed, skipped = configNode.loadNodeConfiguration(BENCH_NODE, cfg, differential=differential)
+            elapsed = time.perf_counter() - start
+            if failed:
+                raise RuntimeError(f"{len(failed)} keys failed to load")
+            name = "configuration_load_differential" if differential else "configuration_load"
+            results.add(name, elapsed / args.keys * 1000, "ms/key", False)
+    finally:
+        net.stop()
+        del devices.devices[(BENCH_DEVICE, BENCH_MODEL, 1)]
+
+# Bytes per second that each firmware driver downloads to a simulated
+# bootloader.  The image that the bootloader ends up with is checked.
+@benchmark("firmware")
+def benchFirmware(args, results):
+    from . import connection
+    from . import firmware
+    from . import simulator
+    from .firmware.drivers import STM32_AHRS
+    with tempfile.TemporaryDirectory() as directory:
+        image, hexname, stdname = firmwareFiles(directory, args.firmware_size)
+        # The STM32 image has to be in the application flash
+        stm32 = os.path.join(directory, "stm32")
+        os.mkdir(stm32)
+        stmhex = firmwareFiles(stm32, args.firmware_size, address=STM32_AHRS.APP_START)[1]
+        tests = (("BASIC", stdname, simulator.BasicBootloader(),
+                  lambda bl: bl.memory[(0, 0)].read(0, len(image))),
+                 ("AT328", hexname, simulator.AVR8Bootloader(pagesize=128, buffers=2),
+                  lambda bl: bl.flash.read(0, len(image))),
+                 ("STM32_AHRS", stmhex, simulator.STM32Bootloader(),
+                  lambda bl: bl.flash.read(STM32_AHRS.APP_START, len(image))))
+        for n, (driver, filename, bootloader, written) in enumerate(tests):
+            nodeid = BENCH_NODE + 1 + n
+            net = simulator.Network(CHANNEL)
+            net.addNode(simulator.Node(nodeid, BENCH_DEVICE, BENCH_MODEL, 1, parameters=[],
+                                       bootloader=bootloader, firmwareCode=BENCH_VCODE,
+                                       latency=args.latency, statusInterval=0))
+            net.start()
+            conn = connection.canbus.get_connection(ranges=[(canfix.NODE_SPECIFIC_MSGS, 0x7FF)])
+            try:
+                fw = firmware.Firmware(driver, filename, nodeid, BENCH_VCODE, conn)
+                start = time.perf_counter()
+                fw.download()
+                elapsed = time.perf_counter() - start
+                fw.end_download()
+                if written(bootloader) != image:
+                    raise RuntimeError(f"{driver} download failed: {fw.status}")
+                results.add(f"firmware_{driver}", len(image) / elapsed, "bytes/s")
+            finally:
+                connection.canbus.free_connection(conn)
+                net.stop()
+
+# How fast the standard firmware files are loaded and the CRC-16 that is
+# used by the drivers is computed
+@benchmark("stdfile")
+def benchStdfile(args, results):
+    from .firmware import stdfile
+    from .firmware import crc
+    with tempfile.TemporaryDirectory() as directory:
+        image, hexname, stdname = firmwareFiles(directory, args.firmware_size)
+        count, elapsed = repeat(lambda: stdfile.StandardFileLoader(stdname), args.duration)
+        results.add("stdfile_load", count * len(image) / elapsed, "bytes/s")
+        count, elapsed = repeat(lambda: crc.crc16(image).getResult(), args.duration)
+        results.add("crc16", count * len(image) / elapsed, "bytes/s")
+
+
+# Compares the results against the baseline results.  Returns the names of
+# the benchmarks that are worse than the baseline by more than threshold.
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None or "value" not in b or "value" not in r or not b["value"]:
+            continue
+        change = (r["value"] - b["value"]) / b["value"]
+        worse = -change if r["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:32} {b['value']:>12.6g} -> {r['value']:>12.6g} {r['unit']:10} {change:+7.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CAN-FIX Utility Benchmarks')
+    parser.add_argument('--only', help='Comma separated list of the benchmarks to run. '
+                                       'One or more of ' + ', '.join(benchmarks))
+    parser.add_argument('--output', metavar='FILENAME', help='Write the results to this JSON file')
+    parser.add_argument('--compare', metavar='FILENAME', help='Compare the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Fraction that a result can be worse than the one it is compared to '
+                             'before it is a regression (default 0.1)')
+    parser.add_argument('--frames', type=int, default=20000, help='Number of frames or messages to send')
+    parser.add_argument('--connections', default='1,4,16',
+                        help='Comma separated list of the connection counts for the fanout benchmark')
+    parser.add_argument('--nodes', type=int, default=16, help='Number of nodes that send parameters')
+    parser.add_argument('--keys', type=int, default=200, help='Number of configuration keys')
+    parser.add_argument('--firmware-size', type=int, default=32768, help='Size of the firmware image')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency of the simulated nodes')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='Time in seconds to repeat the benchmarks that are repeated')
+    args = parser.parse_args(argv)
+    args.connections = [int(x) for x in args.connections.split(',') if x.strip()]
+    # Everything runs on the virtual bus no matter what is configured
+    args.interface = 'virtual'
+    args.channel = CHANNEL
+    args.bitrate = None
+
+    names = list(benchmarks)
+    if args.only:
+        names = [x.strip() for x in args.only.split(',') if x.strip()]
+        for name in names:
+            if name not in benchmarks:
+                parser.error(f"Unknown benchmark {name}")
+
+    config.initialize(args)
+    # These need the configuration
+    from . import connection
+    connection.canbus.connect(config.interface, channel=config.channel)
+
+    results = Results()
+    try:
+        for name in names:
+            benchmarks[name](args, results)
+    finally:
+        connection.canbus.stop()
+        connection.canbus.join()
+        connection.canbus.disconnect()
+
+    output = OrderedDict()
+    output["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    output["python"] = platform.python_version()
+    output["platform"] = platform.platform()
+    output["arguments"] = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "only")}
+    output["results"] = results.results
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        print()
+        regressions = compare(results.results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,453 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Captures of the bus traffic.  A capture is written to one or more segment
+# files of fixed size records so that any frame can be found from its
+# number.  Each segment has a sidecar index file with the time of every
+# TIME_INDEX_INTERVAL'th frame and the frame numbers of every arbitration
+# ID, so a large capture can be opened with mmap and read from a given time
+# or for only some IDs without reading all of it.
+#
+# Segment file:  HEADER then one RECORD for each frame
+# Index file:    INDEX_HEADER then the time index as an array of doubles
+#                and an array of frame numbers, then an INDEX_ENTRY for each
+#                ID and then the array of frame numbers for each ID.  Each
+#                part starts on an 8 byte boundary.
+
+import array
+import bisect
+import glob
+import heapq
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import can
+from . import connection
+
+log = logging.getLogger(__name__)
+
+CAPTURE_EXT = ".cfcap"
+INDEX_EXT = ".cfidx"
+MAGIC = b"CFXCAP\x00\x01"
+INDEX_MAGIC = b"CFXIDX\x00\x01"
+# magic, time the capture was started
+HEADER = struct.Struct("<8sd")
+# timestamp, arbitration id with the flags below, dlc, data
+RECORD = struct.Struct("<dIB8s")
+# magic, frames, time index entries, ids
+INDEX_HEADER = struct.Struct("<8sIII")
+# arbitration id with flags, number of frames, offset of the frame numbers
+INDEX_ENTRY = struct.Struct("<III")
+
+FLAG_EXTENDED = 0x80000000
+FLAG_REMOTE = 0x40000000
+FLAG_ERROR = 0x20000000
+ID_MASK = 0x1FFFFFFF
+
+# Every this many frames the time is put in the index
+TIME_INDEX_INTERVAL = 1024
+# Size at which a new segment is started
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+# The records are collected in memory and written this many bytes at a time
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+class CaptureError(Exception):
+    pass
+
+
+# The filename without the capture extension.  Rotated segments are named
+# base-0001.cfcap, base-0002.cfcap ...
+def basename(filename):
+    return filename[:-len(CAPTURE_EXT)] if filename.endswith(CAPTURE_EXT) else filename
+
+def indexFilename(filename):
+    return basename(filename) + INDEX_EXT
+
+# Returns the segment files of a capture in order.  filename can be a
+# single segment or the name that was given to the CaptureWriter.
+def segments(filename):
+    if os.path.isfile(filename):
+        return [filename]
+    if os.path.isfile(basename(filename) + CAPTURE_EXT):
+        return [basename(filename) + CAPTURE_EXT]
+    files = sorted(glob.glob(glob.escape(basename(filename)) + "-[0-9][0-9][0-9][0-9]" + CAPTURE_EXT))
+    if not files:
+        raise CaptureError(f"No capture found at {filename}")
+    return files
+
+def packId(msg):
+    aid = msg.arbitration_id & ID_MASK
+    if msg.is_extended_id:
+        aid |= FLAG_EXTENDED
+    if msg.is_remote_frame:
+        aid |= FLAG_REMOTE
+    if msg.is_error_frame:
+        aid |= FLAG_ERROR
+    return aid
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+# Builds the index of a segment as the frames are added
+class IndexBuilder:
+    def __init__(self):
+        self.count = 0
+        self.times = array.array('d')
+        self.timeFrames = array.array('I')
+        self.ids = {}
+
+    def add(self, timestamp, aid):
+        if self.count % TIME_INDEX_INTERVAL == 0:
+            self.times.append(timestamp)
+            self.timeFrames.append(self.count)
+        frames = self.ids.get(aid)
+        if frames is None:
+            frames = self.ids[aid] = array.array('I')
+        frames.append(self.count)
+        self.count += 1
+
+    def write(self, filename):
+        with open(filename + ".tmp", "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.count, len(self.times), len(self.ids)))
+            f.write(b"\x00" * _pad(INDEX_HEADER.size))
+            f.write(self.times.tobytes())
+            f.write(self.timeFrames.tobytes())
+            f.write(b"\x00" * _pad(len(self.timeFrames) * 4))
+            offset = f.tell() + len(self.ids) * INDEX_ENTRY.size
+            offset += _pad(offset)
+            for aid in sorted(self.ids):
+                f.write(INDEX_ENTRY.pack(aid, len(self.ids[aid]), offset))
+                offset += len(self.ids[aid]) * 4
+            f.write(b"\x00" * _pad(f.tell()))
+            for aid in sorted(self.ids):
+                f.write(self.ids[aid].tobytes())
+        os.replace(filename + ".tmp", filename)
+
+
+# Writes frames to a capture.  A new segment is started when the current one
+# reaches segmentSize bytes, 0 never starts a new one.  The records are kept
+# in memory until there are bufferSize bytes of them.
+class CaptureWriter:
+    def __init__(self, filename, segmentSize=DEFAULT_SEGMENT_SIZE, bufferSize=DEFAULT_BUFFER_SIZE):
+        self.base = basename(filename)
+        self.segmentSize = segmentSize
+        self.bufferSize = bufferSize
+        self.frames = 0
+        self.files = []
+        self.__file = None
+        self.__buffer = bytearray()
+        self.__record = bytearray(RECORD.size)
+        self.__open()
+
+    def __open(self):
+        if self.segmentSize:
+            filename = f"{self.base}-{len(self.files)+1:04d}{CAPTURE_EXT}"
+        else:
+            filename = self.base + CAPTURE_EXT
+        self.files.append(filename)
+        self.__file = open(filename, "wb")
+        self.__file.write(HEADER.pack(MAGIC, time.time()))
+        self.__size = HEADER.size
+        self.__index = IndexBuilder()
+
+    def __closeSegment(self):
+        self.flush()
+        self.__file.close()
+        self.__index.write(indexFilename(self.files[-1]))
+
+    def write(self, msg):
+        if self.segmentSize and self.__size + RECORD.size > self.segmentSize and self.__index.count:
+            self.__closeSegment()
+            self.__open()
+        aid = packId(msg)
+        RECORD.pack_into(self.__record, 0, msg.timestamp, aid, msg.dlc, bytes(msg.data))
+        self.__buffer += self.__record
+        self.__index.add(msg.timestamp, aid)
+        self.__size += RECORD.size
+        self.frames += 1
+        if len(self.__buffer) >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.__buffer:
+            self.__file.write(self.__buffer)
+            self.__buffer.clear()
+        self.__file.flush()
+
+    def close(self):
+        if self.__file is not None:
+            self.__closeSegment()
+            self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# One segment file of a capture and its index.  If the index is missing or
+# doesn't match the segment it is built again from the frames.
+class Segment:
+    def __init__(self, filename):
+        self.filename = filename
+        self.__file = open(filename, "rb")
+        size = os.fstat(self.__file.fileno()).st_size
+        if size < HEADER.size:
+            raise CaptureError(f"{filename} is not a capture file")
+        self.mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise CaptureError(f"{filename} is not a capture file")
+        # A partial record at the end of a capture that was cut off is ignored
+        self.count = (size - HEADER.size) // RECORD.size
+        self.__idmm = None
+        if not self.__loadIndex():
+            log.info(f"Building the index for {filename}")
+            builder = IndexBuilder()
+            for n in range(self.count):
+                timestamp, aid, dlc, data = RECORD.unpack_from(self.mm, HEADER.size + n * RECORD.size)
+                builder.add(timestamp, aid)
+            try:
+                builder.write(indexFilename(filename))
+            except OSError as e:
+                log.warning(f"Unable to save the index for {filename}: {e}")
+            self.times = builder.times
+            self.timeFrames = builder.timeFrames
+            self.ids = {aid: (len(f), f) for aid, f in builder.ids.items()}
+
+    def __loadIndex(self):
+        try:
+            with open(indexFilename(self.filename), "rb") as f:
+                idmm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            magic, count, ntimes, nids = INDEX_HEADER.unpack_from(idmm, 0)
+        except struct.error:
+            return False
+        if magic != INDEX_MAGIC or count != self.count:
+            return False
+        offset = INDEX_HEADER.size + _pad(INDEX_HEADER.size)
+        self.times = array.array('d', idmm[offset:offset + ntimes * 8])
+        offset += ntimes * 8
+        self.timeFrames = array.array('I', idmm[offset:offset + ntimes * 4])
+        offset += ntimes * 4
+        offset += _pad(offset)
+        # The frame numbers of each ID are only read when they are asked for
+        self.ids = {}
+        for n in range(nids):
+            aid, frames, location = INDEX_ENTRY.unpack_from(idmm, offset + n * INDEX_ENTRY.size)
+            self.ids[aid] = (frames, location)
+        self.__idmm = idmm
+        return True
+
+    def frames(self, aid):
+        count, frames = self.ids.get(aid, (0, None))
+        if count == 0:
+            return array.array('I')
+        if isinstance(frames, int):
+            frames = array.array('I', self.__idmm[frames:frames + count * 4])
+            self.ids[aid] = (count, frames)
+        return frames
+
+    def record(self, n):
+        return RECORD.unpack_from(self.mm, HEADER.size + n * RECORD.size)
+
+    def timestamp(self, n):
+        return struct.unpack_from("<d", self.mm, HEADER.size + n * RECORD.size)[0]
+
+    # Returns the number of the first frame at or after time t
+    def find(self, t):
+        block = max(bisect.bisect_right(self.times, t) - 1, 0)
+        lo = self.timeFrames[block] if self.timeFrames else 0
+        hi = min(lo + TIME_INDEX_INTERVAL, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        self.mm.close()
+        if self.__idmm is not None:
+            self.__idmm.close()
+        self.__file.close()
+
+
+def toMessage(record):
+    timestamp, aid, dlc, data = record
+    return can.Message(timestamp=timestamp, arbitration_id=aid & ID_MASK,
+                       is_extended_id=bool(aid & FLAG_EXTENDED), is_remote_frame=bool(aid & FLAG_REMOTE),
+                       is_error_frame=bool(aid & FLAG_ERROR), dlc=dlc, data=data[:dlc])
+
+
+# Reads a capture.  The frames of all of the segments are numbered from 0.
+class CaptureReader:
+    def __init__(self, filename):
+        self.filename = filename
+        self.segments = []
+        try:
+            for f in segments(filename):
+                self.segments.append(Segment(f))
+        except Exception:
+            self.close()
+            raise
+        self.__starts = []
+        count = 0
+        for s in self.segments:
+            self.__starts.append(count)
+            count += s.count
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __locate(self, n):
+        if n < 0 or n >= self.count:
+            raise IndexError("Frame number out of range")
+        s = bisect.bisect_right(self.__starts, n) - 1
+        return self.segments[s], n - self.__starts[s]
+
+    def record(self, n):
+        segment, local = self.__locate(n)
+        return segment.record(local)
+
+    def __getitem__(self, n):
+        return toMessage(self.record(n))
+
+    def timestamp(self, n):
+        segment, local = self.__locate(n)
+        return segment.timestamp(local)
+
+    # Time of the first and last frames or None if there aren't any
+    @property
+    def timeRange(self):
+        if self.count == 0:
+            return None
+        return self.timestamp(0), self.timestamp(self.count - 1)
+
+    # Returns the number of the first frame at or after time t
+    def find(self, t):
+        for start, s in zip(self.__starts, self.segments):
+            if s.count and s.timestamp(s.count - 1) >= t:
+                return start + s.find(t)
+        return self.count
+
+    # Returns all of the frame numbers with one of the given arbitration IDs
+    # between start and stop in order.  ids can be plain IDs or IDs with the
+    # flags added by packId().
+    def frames(self, ids, start=0, stop=None):
+        stop = self.count if stop is None else min(stop, self.count)
+        lists = []
+        for base, s in zip(self.__starts, self.segments):
+            if base >= stop or base + s.count <= start:
+                continue
+            for aid in ids:
+                f = s.frames(aid)
+                lo = bisect.bisect_left(f, start - base)
+                hi = bisect.bisect_left(f, stop - base)
+                if lo < hi:
+                    lists.append([base + x for x in f[lo:hi]])
+        return heapq.merge(*lists)
+
+    # Returns the frames as python-can messages.  start and stop are frame
+    # numbers and startTime and stopTime limit them by time.  If ids is given
+    # only the frames with those arbitration IDs are returned.
+    def messages(self, start=0, stop=None, ids=None, startTime=None, stopTime=None):
+        if startTime is not None:
+            start = max(start, self.find(startTime))
+        stop = self.count if stop is None else min(stop, self.count)
+        if stopTime is not None:
+            stop = min(stop, self.find(stopTime))
+        numbers = range(start, stop) if ids is None else self.frames(ids, start, stop)
+        for n in numbers:
+            yield toMessage(self.record(n))
+
+    def close(self):
+        for s in self.segments:
+            s.close()
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Writes the frames of a capture to a candump log (.log) or Vector ASC (.asc)
+# file with the python-can writers.  Returns the number of frames written.
+def export(reader, filename, ids=None, startTime=None, stopTime=None, channel="can0"):
+    if filename.lower().endswith(".asc"):
+        writer = can.ASCWriter(filename, channel=1)
+    elif filename.lower().endswith(".log"):
+        writer = can.CanutilsLogWriter(filename, channel=channel)
+    else:
+        raise CaptureError(f"Unknown export format for {filename}, use .log or .asc")
+    count = 0
+    try:
+        for msg in reader.messages(ids=ids, startTime=startTime, stopTime=stopTime):
+            writer.on_message_received(msg)
+            count += 1
+    finally:
+        writer.stop()
+    return count
+
+
+# Writes everything that is received on the bus to a capture until it is
+# stopped.  The connection buffer is large so that slow disk writes don't
+# lose frames but the number that were dropped is kept in dropped.
+class CaptureThread(threading.Thread):
+    def __init__(self, filename, segmentSize=DEFAULT_SEGMENT_SIZE, bufferSize=65536):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.getout = False
+        self.writer = CaptureWriter(filename, segmentSize)
+        self.conn = connection.canbus.get_connection(bufferSize=bufferSize)
+
+    @property
+    def frames(self):
+        return self.writer.frames
+
+    @property
+    def dropped(self):
+        return self.conn.statistics()["dropped"]
+
+    def run(self):
+        try:
+            while not self.getout:
+                try:
+                    msg = self.conn.recv(0.5)
+                except connection.Timeout:
+                    continue
+                self.writer.write(msg)
+        except Exception as e:
+            log.error(f"Capture stopped: {e}")
+        finally:
+            connection.canbus.free_connection(self.conn)
+            self.writer.close()
+
+    def stop(self):
+        self.getout = True
@@ -41,6 +41,13 @@ channel = None
 bitrate = None
 node = None
 timeout = 5.0
+# Number of configuration queries that we keep outstanding to a single node
+query_window = 8
+# Limits for the adaptive request timeouts.  The timeout for a node starts at
+# rto_initial and is then computed from the measured round trip times.
+rto_initial = 0.5
+rto_min = 0.05
+rto_max = 5.0
 
 # Location where we will be storing our configuration file.
 def_config_path = appdirs.user_config_dir() + "/cfutil"
@@ -52,6 +59,10 @@ def initialize(args):
     global channel
     global bitrate
     global node
+    global query_window
+    global rto_initial
+    global rto_min
+    global rto_max
     global datapath
     global data_index_uri
     global data_download_interval
@@ -91,6 +102,10 @@ def initialize(args):
         bitrate = 125000
 
     node = config.getint("canfix", "node")
+    query_window = config.getint("canfix", "query_window", fallback=query_window)
+    rto_initial = config.getfloat("canfix", "rto_initial", fallback=rto_initial)
+    rto_min = config.getfloat("canfix", "rto_min", fallback=rto_min)
+    rto_max = config.getfloat("canfix", "rto_max", fallback=rto_max)
     #auto_connect = config.getboolean("can", "auto_connect")
 
 def set_value(section, option, value):
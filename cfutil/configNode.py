@@ -24,6 +24,8 @@ import logging
 import json
 import time
 import threading
+import tarfile
+import io
 from collections import OrderedDict
 import canfix
 from . import devices
@@ -45,70 +47,287 @@ def setNodeConfiguration(sendNode, destNode, key, datatype, multiplier, value):
     ncq.destNode = destNode
     ncq.value = value
 
-    conn = canbus.get_connection()
-    conn.send(ncq.msg)
-    endtime = time.time() + 1.0
-    while(True):
-        try:
-            rmsg = conn.recv(timeout = 1.0)
-        except connection.Timeout:
-            canbus.free_connection(conn)
-            return None
-        p = canfix.parseMessage(rmsg)
-        if isinstance(p, canfix.NodeConfigurationSet) and p.destNode == sendNode:
-            canbus.free_connection(conn)
-            return p
-        else:
-            if time.time() > endtime:
-                canbus.free_connection(conn)
-                return None
+    rmsg = canbus.transaction(ncq.msg, destNode, key, attempts = 3)
+    if rmsg is None:
+        return None
+    return canfix.parseMessage(rmsg)
 
 def queryNodeConfiguration(sendNode, destNode, key):
     ncq = canfix.NodeConfigurationQuery(key = key)
-    conn = canbus.get_connection()
     ncq.sendNode = sendNode
     ncq.destNode = destNode
-    conn.send(ncq.msg)
-    endtime = time.time() + 1.0
-    while(True):
-        try:
-            rmsg = conn.recv(timeout = 0.5)
-        except connection.Timeout:
-            canbus.free_connection(conn)
-            return None
-        p = canfix.parseMessage(rmsg)
-        if isinstance(p, canfix.NodeConfigurationQuery) and p.destNode == sendNode:
-            canbus.free_connection(conn)
-            return p
+    rmsg = canbus.transaction(ncq.msg, destNode, key, attempts = 3)
+    if rmsg is None:
+        return None
+    return canfix.parseMessage(rmsg)
+
+# Returns the size of a successful query response for the given datatype
+# or None if we can't tell.
+def responseSize(datatype):
+    try:
+        return 3 + canfix.utils.getTypeSize(datatype.upper())
+    except (KeyError, ValueError, AttributeError):
+        return None
+
+# Reads all of the configuration keys in the keys list from destNode.  Up to
+# window queries are kept outstanding at once.  The query responses do not
+# contain the key so they are matched to the requests by the order they come
+# back.  If any response in a window is missing or is the wrong size for the
+# datatype given in the optional types dictionary we can't tell which one was
+# lost so the keys in that window are read again with the window halved.  The
+# window grows back by one after each good window.  A key is given up on after
+# it fails attempts times by itself, and all the remaining keys are given up
+# on if the node doesn't answer at all attempts times in a row.  If timeout
+# is None the time we wait on a window comes from the node's round trip time
+# estimate.  Only the first request of a window that is not being retried is
+# used as a round trip time sample since the others wait in line behind it.
+# Returns a dictionary of key:parsed response
+# with None for the keys that we never got an answer for.  The callback
+# function is called with each key as it is read.  limiter is an optional
+# connection.RateLimiter that is shared with other readers.
+def readNodeConfiguration(sendNode, destNode, keys, types=None, window=None,
+                          attempts=3, timeout=None, callback=None, limiter=None):
+    if window is None:
+        window = config.query_window
+    rtt = canbus.rtt(destNode)
+    retry = False
+    maxwindow = max(int(window), 1)
+    window = maxwindow
+    types = types or {}
+    results = {}
+    tries = dict.fromkeys(keys, 0)
+    silent = 0
+    pending = list(keys)
+    while pending:
+        batch = pending[:window]
+        trans = []
+        for key in batch:
+            ncq = canfix.NodeConfigurationQuery(key = key)
+            ncq.sendNode = sendNode
+            ncq.destNode = destNode
+            if limiter:
+                limiter.acquire()
+            sample = not trans and not retry
+            trans.append(canbus.start_transaction(ncq.msg, destNode, key, sample=sample))
+        if timeout is None:
+            endtime = time.time() + rtt.window_timeout(len(trans))
+        else:
+            endtime = time.time() + timeout
+        frames = []
+        for t in trans:
+            try:
+                frames.append(t.wait(max(endtime - time.time(), 0)))
+            except connection.Timeout:
+                break
+        good = len(frames) == len(trans)
+        if good and len(trans) > 1:
+            for t, f in zip(trans, frames):
+                size = responseSize(types.get(t.key))
+                if len(f.data) < 3 or (f.data[2] == 0 and size is not None and len(f.data) != size):
+                    good = False
+                    break
+        if good:
+            for t, f in zip(trans, frames):
+                results[t.key] = canfix.parseMessage(f)
+                if callback:
+                    callback(t.key)
+            pending = pending[len(batch):]
+            window = min(window + 1, maxwindow)
+            silent = 0
+            retry = False
         else:
-            if time.time() > endtime:
-                canbus.free_connection(conn)
-                return None
+            for t in trans:
+                canbus.cancel_transaction(t)
+            if len(frames) < len(trans):
+                rtt.backoff()
+            retry = True
+            log.debug("Configuration read window of {} failed on node {}".format(len(batch), destNode))
+            if not frames:
+                silent += 1
+            # A failure is only charged to a key when it was read by itself
+            # otherwise we don't know which key's response went missing.
+            if len(batch) == 1:
+                tries[batch[0]] += 1
+            # If the node has stopped answering altogether we give up on
+            # everything that is left.
+            if silent >= attempts:
+                done = pending
+                pending = []
+            elif tries[pending[0]] >= attempts:
+                done = [pending.pop(0)]
+            else:
+                done = []
+            for key in done:
+                results[key] = None
+                if callback:
+                    callback(key)
+            window = max(window // 2, 1)
+    return results
+
+# Returns the list of configuration items from an EDS file ordered so that
+# every dependent key comes after the key that it depends on.
+def configurationOrder(configuration):
+    done = set()
+    ordered = []
+    remaining = list(configuration)
+    while remaining:
+        left = []
+        for each in remaining:
+            if 'depends' in each and each['depends']['key'] not in done:
+                left.append(each)
+            else:
+                ordered.append(each)
+                done.add(each['key'])
+        if len(left) == len(remaining): # Parent is missing so just put them at the end
+            ordered.extend(left)
+            break
+        remaining = left
+    return ordered
 
 # convienience function to get the node information from a node on the
 # network.  Returns a tuple as (device type, model number, firmware version)
 # if found otherwise it returns None
 def getNodeInformation(sendNode, destNode):
     msg = canfix.NodeIdentification()
-    conn = canbus.get_connection()
     msg.sendNode = sendNode
     msg.destNode = destNode
+    rmsg = canbus.transaction(msg.msg, destNode, attempts = 2)
+    if rmsg is None:
+        return None
+    p = canfix.parseMessage(rmsg)
+    return (p.device, p.model, p.fwrev)
+
+class NodeError(Exception):
+    pass
+
+# Broadcasts a Node Identification request and listens for timeout seconds.
+# Nodes that don't answer the broadcast but are heard on the bus during that
+# time are asked individually.  Returns a dictionary of
+# nodeid:(device type, model number, firmware version)
+def findNodes(sendNode, timeout=2.0):
+    conn = canbus.get_connection(ranges=[(0x001, 0x0FF), (0x100, 0x5FF),
+                                 (canfix.NODE_SPECIFIC_MSGS, canfix.TWOWAY_CONN_CHANS - 1)])
+    msg = canfix.NodeIdentification()
+    msg.sendNode = sendNode
+    msg.destNode = 0
     conn.send(msg.msg)
-    endtime = time.time() + 1.0
-    while(True):
+    found = {}
+    heard = set()
+    endtime = time.time() + timeout
+    try:
+        while True:
+            remaining = endtime - time.time()
+            if remaining <= 0:
+                break
+            try:
+                rmsg = conn.recv(timeout = remaining)
+            except connection.Timeout:
+                break
+            if len(rmsg.data) == 0:
+                continue
+            if rmsg.arbitration_id >= canfix.NODE_SPECIFIC_MSGS:
+                node = rmsg.arbitration_id - canfix.NODE_SPECIFIC_MSGS
+                if rmsg.data[0] == 0x00 and len(rmsg.data) == 8 and rmsg.data[1] == sendNode:
+                    p = canfix.parseMessage(rmsg)
+                    found[node] = (p.device, p.model, p.fwrev)
+                    continue
+            elif rmsg.arbitration_id < 0x100:
+                node = rmsg.arbitration_id # Node alarms are sent on the node's own id
+            else:
+                node = rmsg.data[0] # Parameters carry the sending node in the first byte
+            if node != sendNode and node != 0:
+                heard.add(node)
+    finally:
+        canbus.free_connection(conn)
+
+    trans = []
+    for node in sorted(heard - set(found)):
+        msg = canfix.NodeIdentification()
+        msg.sendNode = sendNode
+        msg.destNode = node
+        trans.append(canbus.start_transaction(msg.msg, node))
+    for t in trans:
         try:
-            rmsg = conn.recv(timeout = 1.0)
+            endtime = t.sent + canbus.rtt(t.destNode).timeout
+            p = canfix.parseMessage(t.wait(max(endtime - time.time(), 0)))
+            found[t.destNode] = (p.device, p.model, p.fwrev)
         except connection.Timeout:
-            canbus.free_connection(conn)
-            return None
-        p = canfix.parseMessage(rmsg)
-        if isinstance(p, canfix.NodeIdentification) and p.destNode == sendNode:
-            canbus.free_connection(conn)
-            return (p.device, p.model, p.fwrev)
+            canbus.cancel_transaction(t)
+    return found
+
+# Reads the complete configuration from the node and returns it as a
+# dictionary in the same form that is written to the configuration files.
+# status and percent are optional callback functions.  Raises NodeError if
+# the node can't be found or we don't have an EDS file for it.
+def getNodeConfiguration(nodeid, attempts=3, timeout=None, status=None, percent=None, limiter=None):
+    status = status or (lambda *args: None)
+    percent = percent or (lambda *args: None)
+    output = {}
+    log.debug("looking for node at {}".format(nodeid))
+    result = getNodeInformation(config.node, nodeid)
+    if result is None:
+        raise NodeError("Node Not Found")
+    device, model, version = result
+    # Find the EDS file information for this node
+    eds_info = devices.findDevice(device, model, version)
+    if eds_info is None:
+        raise NodeError("No EDS information for node")
+    output['name'] = eds_info.name
+    output['device'] = device
+    output['model'] = model
+    output['version'] = version
+    output['cfgVersion'] = 1.0
+    output['saved'] = time.ctime()
+
+    configuration = eds_info.configuration
+    keys = [each['key'] for each in configuration]
+    types = {each['key']:each['type'] for each in configuration if 'type' in each}
+    count = 0
+    def progress(key):
+        nonlocal count
+        count += 1
+        status(f"Saving - {key}")
+        percent(int(count/len(keys)*100))
+    results = readNodeConfiguration(config.node, nodeid, keys, types, attempts=attempts,
+                                    timeout=timeout, callback=progress, limiter=limiter)
+
+    # The datatype of a dependent key comes from the value of its parent so
+    # the parents have to be decoded first
+    items = {}
+    for each in configurationOrder(configuration):
+        result = results.get(each['key'])
+        if result is None:
+            log.error(f"No response for configuration key {each['key']} from node {nodeid}")
+            status(f"No response for key {each['key']}")
+            continue
+        if 'depends' in each: # This is a dependent key
+            key = each['depends']['key']
+            definition = None
+            if key in items:
+                for de in each['depends']['definitions']:
+                    if isinstance(de['compare'], list):
+                        if items[key]['value'] in de['compare']:
+                            definition = de
+                    else:
+                        if items[key]['value'] == de['compare']:
+                            definition = de
+            if definition is None:
+                log.error(f"No definition found for dependent key {each['key']}")
+                continue
+            result.datatype = definition['type']
+            name = definition['name']
+        else:
+            name = each['name']
+            result.datatype = each['type']
+        if 'multiplier' in each:
+            mult = each['multiplier']
         else:
-            if time.time() > endtime:
-                canbus.free_connection(conn)
-                return None
+            mult = 1.0
+        items[each["key"]] = {'name':name,'type':result.datatype,'multiplier':mult,'value':result.value}
+
+    output['items'] = items
+    return output
+
 
 class SaveThread(threading.Thread):
     def __init__(self, node, file):
@@ -116,68 +335,25 @@ class SaveThread(threading.Thread):
         self.daemon = True
         self.getout = False
         self.attempts = 3
-        self.timeout = 1.0
+        self.timeout = None # Adaptive
         self.nodeid = node
         self.statusCallback = lambda message : print(message)
         self.percentCallback = lambda *args: None
         self.finishedCallback = lambda *args: None
-        self.conn = canbus.get_connection()
         self.output = {}
         self.file = file
 
     def run(self):
-        log.debug("looking for node at {}".format(self.nodeid))
-        result = getNodeInformation(config.node, self.nodeid)
-        if result is not None:
-            self.device = result[0]
-            self.model = result[1]
-            self.version = result[2]
-            # Find the EDS file information for this node
-            self.eds_info = devices.findDevice(self.device, self.model, self.version)
-            if self.eds_info is not None:
-                self.output['name'] = self.eds_info.name
-            self.output['device'] = self.device
-            self.output['model'] = self.model
-            self.output['version'] = self.version
-            self.output['cfgVersion'] = 1.0
-            self.output['saved'] = time.ctime()
-        else:
-            log.error("Node Not Found")
-            self.statusCallback(f"Node Not Found")
+        try:
+            self.output = getNodeConfiguration(self.nodeid, self.attempts, self.timeout,
+                                               self.statusCallback, self.percentCallback)
+        except NodeError as e:
+            log.error(e)
+            self.statusCallback(str(e))
             return
-
-
-        items = {}
-        for x, each in enumerate(self.eds_info.configuration):
-            result = queryNodeConfiguration(config.node, self.nodeid, each['key'])
-            if 'depends' in each: # This is a dependent key
-                key = each['depends']['key']
-                for de in each['depends']['definitions']:
-                    if isinstance(de['compare'], list):
-                        if items[key]['value'] in de['compare']:
-                            definition = de
-                    else:
-                        if items[key]['value'] == de['compare']:
-                            definition = de
-                if definition is not None:
-                    result.datatype = definition['type']
-                    name = definition['name']
-            else:
-                name = each['name']
-                result.datatype = each['type']
-            if 'multiplier' in each:
-                mult = each['multiplier']
-            else:
-                mult = 1.0
-            items[each["key"]] = {'name':name,'type':result.datatype,'multiplier':mult,'value':result.value}
-
-            self.statusCallback(f"Saving - {each['key']} - {name}")
-            self.percentCallback(int(x/len(self.eds_info.configuration)*100))
-        self.output['items'] = items
         self.percentCallback(100)
         self.statusCallback("Finished")
         self.finishedCallback(True)
-        canbus.free_connection(self.conn)
         json.dump(self.output, self.file, indent=2)
 
     def stop(self):
@@ -187,18 +363,97 @@ class SaveThread(threading.Thread):
             log.warning("Config Save thread failed to stop properly")
 
 
+# Returns True if cfg looks like a configuration file that we can load
+def validConfiguration(cfg):
+    return cfg.get('cfgVersion') == 1.0 and 'items' in cfg
+
+# Returns the keys of the configuration items (strings as they appear in the
+# file) ordered so that dependent keys come after their parents if we have the
+# EDS information for the device.  Also returns a dictionary of parent
+# key:list of dependent keys.
+def writeOrder(items, eds_info):
+    if eds_info is None:
+        return list(items), {}
+    order = []
+    children = {}
+    for each in configurationOrder(eds_info.configuration):
+        key = str(each['key'])
+        if key in items:
+            order.append(key)
+        if 'depends' in each:
+            children.setdefault(str(each['depends']['key']), []).append(key)
+    order.extend(k for k in items if k not in order)
+    return order, children
+
+# Writes the configuration given in cfg (as read from a configuration file) to
+# the node.  The node has to identify itself as the same device, model and
+# version that the configuration was saved from or NodeError is raised.
+#
+# If differential is True the current configuration is read from the node
+# first and only the keys whose data would change are written.  The data is
+# compared as it would be sent so there are no rounding issues with FLOATs or
+# multipliers.  Dependent keys are always written if their parent is written
+# because the node may reset them when the parent changes.
+#
+# Returns a tuple of (list of keys that could not be written, number of keys
+# that were skipped because they were already set)
+def loadNodeConfiguration(nodeid, cfg, status=None, percent=None, limiter=None, differential=False):
+    status = status or (lambda *args: None)
+    percent = percent or (lambda *args: None)
+    log.debug("looking for node at {}".format(nodeid))
+    result = getNodeInformation(config.node, nodeid)
+    if result is None:
+        raise NodeError("Node Not Found")
+    device, model, version = result
+    if device != cfg['device']:
+        raise NodeError("Device ID mismatch")
+    if model != cfg['model']:
+        raise NodeError("Model Number mismatch")
+    if version != cfg['version']:
+        raise NodeError("Version Number mismatch")
+
+    items = cfg['items']
+    order, children = writeOrder(items, devices.findDevice(device, model, version))
+    current = {}
+    if differential:
+        status("Reading current configuration")
+        types = {int(k):items[k]['type'] for k in items}
+        current = readNodeConfiguration(config.node, nodeid, list(types), types, limiter=limiter)
+
+    failed = []
+    skipped = 0
+    force = set()
+    for x, key in enumerate(order):
+        item = items[key]
+        percent(int(x/len(order)*100))
+        old = current.get(int(key))
+        if old is not None and key not in force and old.error == 0:
+            new = canfix.utils.setValue(item['type'], item['value'], item['multiplier'])
+            if new is not None and bytes(old.rawdata[1:1+len(new)]) == bytes(new):
+                skipped += 1
+                continue
+        status(f"Sending Key {key}")
+        if limiter:
+            limiter.acquire()
+        result = setNodeConfiguration(config.node, nodeid, int(key), item['type'], item['multiplier'], item['value'])
+        if result is None or result.status != canfix.MSG_SUCCESS:
+            failed.append(key)
+            status(f"Error writing Configuration key {key}")
+        force.update(children.get(key, []))
+    return failed, skipped
+
 class LoadThread(threading.Thread):
     def __init__(self, node, file):
         super(LoadThread, self).__init__()
         self.daemon = True
         self.getout = False
         self.attempts = 3
-        self.timeout = 1.0
+        self.timeout = None # Adaptive
         self.nodeid = node
         self.statusCallback = lambda message : print(message)
         self.percentCallback = lambda *args: None
         self.finishedCallback = lambda *args: None
-        self.conn = canbus.get_connection()
+        self.differential = False
         self.input = json.load(file)
         if 'cfgVersion' in self.input:
             self.version = self.input['cfgVersion']
@@ -206,45 +461,25 @@ class LoadThread(threading.Thread):
             self.version = None
 
     def run(self):
-        if self.version is None or self.version != 1.0:
+        if not validConfiguration(self.input):
             log.error("Unknown configuration file")
             self.statusCallback("Unknown configuration file")
             return
 
-        log.debug("looking for node at {}".format(self.nodeid))
-        result = getNodeInformation(config.node, self.nodeid)
-        if result is not None:
-            self.device = result[0]
-            self.model = result[1]
-            self.version = result[2]
-            # Find the EDS file information for this node
-            self.eds_info = devices.findDevice(self.device, self.model, self.version)
-            if self.eds_info is not None:
-                if self.eds_info.deviceType != self.input['device']:
-                    self.statusCallback("Device ID mismatch")
-                    return
-                if self.eds_info.modelNumber != self.input['model']:
-                    self.statusCallback("Model Number mismatch")
-                    return
-                if self.eds_info.version != self.input['version']:
-                    self.statusCallback("Version Number mismatch")
-                    return
-        else:
-            log.error("Node Not Found")
-            self.statusCallback(f"Node Not Found")
+        try:
+            self.failed, self.skipped = loadNodeConfiguration(self.nodeid, self.input,
+                                                self.statusCallback, self.percentCallback,
+                                                differential=self.differential)
+        except NodeError as e:
+            log.error(e)
+            self.statusCallback(str(e))
             return
-
-        for x, key in enumerate(self.input['items']):
-            item = self.input['items'][key]
-            self.statusCallback(f"Sending Key {key}")
-            result = setNodeConfiguration(config.node, self.nodeid, int(key), item['type'], item['multiplier'], item['value'])
-            if result is None:
-                self.statusCallback("Error writing Configuration key {key}")
-            self.percentCallback(int(x/len(self.input['items'])*100))
         self.percentCallback(100)
-        self.statusCallback("Finished")
+        if self.differential:
+            self.statusCallback(f"Finished - {self.skipped} unchanged keys skipped")
+        else:
+            self.statusCallback("Finished")
         self.finishedCallback(True)
-        canbus.free_connection(self.conn)
 
 
     def stop(self):
@@ -253,3 +488,160 @@ class LoadThread(threading.Thread):
         if self.isAlive():
             log.warning("Config Load thread failed to stop properly")
 
+
+# Runs function(nodeid) for each node in nodes, each in its own thread,
+# and waits for them all to finish.
+def runPerNode(nodes, function):
+    workers = []
+    for nodeid in nodes:
+        t = threading.Thread(target=function, args=(nodeid,), daemon=True)
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+
+# Writes the configurations in the dictionary nodes (nodeid:configuration) to
+# a gzipped tar archive.  Each node is saved as nodeXXX.json in the same format
+# that the SaveThread writes so any one of them can be extracted and loaded by
+# itself.  The archive also contains an index.json that lists the nodes.
+def writeNetworkArchive(filename, nodes):
+    index = {'cfgVersion':1.0, 'saved':time.ctime(), 'nodes':[]}
+    with tarfile.open(filename, 'w:gz') as tf:
+        for nodeid in sorted(nodes):
+            name = f"node{nodeid:03d}.json"
+            index['nodes'].append({'node':nodeid, 'name':nodes[nodeid].get('name'), 'file':name})
+            data = json.dumps(nodes[nodeid], indent=2).encode()
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            ti.mtime = time.time()
+            tf.addfile(ti, io.BytesIO(data))
+        data = json.dumps(index, indent=2).encode()
+        ti = tarfile.TarInfo("index.json")
+        ti.size = len(data)
+        ti.mtime = time.time()
+        tf.addfile(ti, io.BytesIO(data))
+
+
+# Saves the configuration of every node in nodes (or every node that we can
+# find on the network if nodes is None) that we have an EDS file for.  Each
+# node is read by its own thread and all of the threads share one rate limiter
+# so that rate is the maximum number of frames per second we send in total.
+class NetworkSaveThread(threading.Thread):
+    def __init__(self, filename, nodes=None, rate=None):
+        super(NetworkSaveThread, self).__init__()
+        self.daemon = True
+        self.attempts = 3
+        self.timeout = None # Adaptive
+        self.filename = filename
+        self.nodes = nodes
+        self.rate = rate
+        self.statusCallback = lambda message : print(message)
+        self.percentCallback = lambda *args: None
+        self.finishedCallback = lambda *args: None
+        self.output = {}
+        self.errors = {}
+
+    def __save_node(self, nodeid):
+        def percent(p):
+            self.__percent[nodeid] = p
+            self.percentCallback(int(sum(self.__percent.values()) / len(self.__percent)))
+        try:
+            self.output[nodeid] = getNodeConfiguration(nodeid, self.attempts, self.timeout,
+                                                       percent=percent, limiter=self.__limiter)
+            self.statusCallback(f"Saved Node {nodeid} - {self.output[nodeid]['name']}")
+        except NodeError as e:
+            log.error(f"Node {nodeid}: {e}")
+            self.errors[nodeid] = str(e)
+            self.statusCallback(f"Node {nodeid}: {e}")
+        percent(100)
+
+    def run(self):
+        if self.nodes is None:
+            self.statusCallback("Searching for nodes")
+            found = findNodes(config.node)
+            self.nodes = [n for n, v in sorted(found.items()) if devices.findDevice(*v) is not None]
+        if not self.nodes:
+            self.statusCallback("No configurable nodes found")
+            self.finishedCallback(False)
+            return
+        self.__percent = dict.fromkeys(self.nodes, 0)
+        self.__limiter = connection.RateLimiter(self.rate)
+        runPerNode(self.nodes, self.__save_node)
+        if self.output:
+            writeNetworkArchive(self.filename, self.output)
+        self.percentCallback(100)
+        self.statusCallback(f"Finished - Saved {len(self.output)} of {len(self.nodes)} nodes")
+        self.finishedCallback(not self.errors)
+
+
+# Writes one configuration to many nodes at once.  The nodes can be given as a
+# list, otherwise we search the network and use every node that matches the
+# device, model and version given.  Any of those that are None match every
+# node.  Each node is written by its own thread and all of the threads share
+# one rate limiter.  The results dictionary has an entry for every node that
+# is either "OK", the list of keys that failed or the reason the node failed.
+# If differential is set only changed keys are written and the number of keys
+# skipped for each node is kept in the skipped dictionary.
+class NetworkLoadThread(threading.Thread):
+    def __init__(self, cfg, nodes=None, device=None, model=None, version=None, rate=None):
+        super(NetworkLoadThread, self).__init__()
+        self.daemon = True
+        self.input = cfg
+        self.nodes = nodes
+        self.device = device
+        self.model = model
+        self.version = version
+        self.rate = rate
+        self.statusCallback = lambda message : print(message)
+        self.percentCallback = lambda *args: None
+        self.nodePercentCallback = lambda *args: None
+        self.finishedCallback = lambda *args: None
+        self.differential = False
+        self.results = {}
+        self.skipped = {}
+
+    def __matches(self, info):
+        return (self.device is None or info[0] == self.device) and \
+               (self.model is None or info[1] == self.model) and \
+               (self.version is None or info[2] == self.version)
+
+    def __load_node(self, nodeid):
+        def percent(p):
+            self.__percent[nodeid] = p
+            self.nodePercentCallback(nodeid, p)
+            self.percentCallback(int(sum(self.__percent.values()) / len(self.__percent)))
+        try:
+            failed, skipped = loadNodeConfiguration(nodeid, self.input, percent=percent,
+                                                    limiter=self.__limiter, differential=self.differential)
+            self.skipped[nodeid] = skipped
+            if failed:
+                self.results[nodeid] = f"Failed keys {', '.join(str(k) for k in failed)}"
+            else:
+                self.results[nodeid] = "OK"
+        except NodeError as e:
+            log.error(f"Node {nodeid}: {e}")
+            self.results[nodeid] = str(e)
+        self.statusCallback(f"Node {nodeid}: {self.results[nodeid]}")
+        percent(100)
+
+    def run(self):
+        if not validConfiguration(self.input):
+            self.statusCallback("Unknown configuration file")
+            self.finishedCallback(False)
+            return
+        if self.nodes is None:
+            self.statusCallback("Searching for nodes")
+            found = findNodes(config.node)
+            self.nodes = [n for n, v in sorted(found.items()) if self.__matches(v)]
+        if not self.nodes:
+            self.statusCallback("No matching nodes found")
+            self.finishedCallback(False)
+            return
+        self.statusCallback(f"Loading configuration to {len(self.nodes)} nodes")
+        self.__percent = dict.fromkeys(self.nodes, 0)
+        self.__limiter = connection.RateLimiter(self.rate)
+        runPerNode(self.nodes, self.__load_node)
+        good = [n for n, r in self.results.items() if r == "OK"]
+        self.percentCallback(100)
+        self.statusCallback(f"Finished - Loaded {len(good)} of {len(self.nodes)} nodes")
+        self.finishedCallback(len(good) == len(self.nodes))
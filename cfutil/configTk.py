@@ -448,9 +448,10 @@ class ConfigTree(ttk.Treeview):
         # still get the exception up to mainTk so that it can pring the error on the
         # status bar or pop up a messagebox.
         error = None
+        results = self.read_config()
         for i in self.records:
             try:
-                i.value = self.get_config_value(i)
+                i.value = self.get_config_value(i, results)
                 if i.value is None:
                     error = TimeoutError("Node Did Not Respond")
                     break
@@ -475,9 +476,26 @@ class ConfigTree(ttk.Treeview):
             log.error("Unable to set configuration for key {}, error code = {}".format(record.key, cfg.errorCode))
 
 
-    def get_config_value(self, record):
+    # Reads the raw configuration from the node for all of the records.  The
+    # responses are decoded later by get_config_value() because the datatype
+    # of a dependent key isn't known until the parent's value is decoded.
+    def read_config(self):
+        types = {}
+        for i in self.records:
+            if not i.dependent:
+                types[i.key] = i.datatype
+        return configNode.readNodeConfiguration(config.node, self.node.nodeid,
+                                                [i.key for i in self.records], types)
+
+    # Returns the value for the record.  If the results of read_config()
+    # are given the value is decoded from them otherwise the key is read from
+    # the node.
+    def get_config_value(self, record, results=None):
         try:
-            cfg = configNode.queryNodeConfiguration(config.node, self.node.nodeid, record.key)
+            if results is None:
+                cfg = configNode.queryNodeConfiguration(config.node, self.node.nodeid, record.key)
+            else:
+                cfg = results.get(record.key)
             if cfg != None:
                 cfg.datatype = record.datatype
                 cfg.multiplier = record.multiplier
@@ -490,8 +508,9 @@ class ConfigTree(ttk.Treeview):
 
     # This reads all the record values from the node and updates the list
     def refresh(self):
+        results = self.read_config()
         for i in self.records:
-            x = self.get_config_value(i)
+            x = self.get_config_value(i, results)
             if x is not None:
                 i.value = x
                 i.save()
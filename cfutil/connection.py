@@ -26,6 +26,9 @@ import logging
 import time
 import can
 import queue
+import collections
+import concurrent.futures
+import canfix
 import cfutil.config as config
 
 log = logging.getLogger(__name__)
@@ -58,15 +61,174 @@ class BadOffset(Exception):
     pass
 
 
+# Overflow policies for the connection receive buffers.  DROP_OLDEST discards
+# the oldest frame in the buffer to make room for the new one, DROP_NEWEST
+# discards the frame that was just received and BLOCK makes the bus thread wait
+# until there is room.  BLOCK will stall every other connection while it waits
+# so it should only be used when losing frames is worse than that.
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+BLOCK = 2
+
+DEFAULT_BUFFER_SIZE = 4096
+
+
+class RingBuffer:
+    """Fixed size receive buffer for a connection.  The get() and put() methods
+    behave like the queue.Queue methods of the same name."""
+    def __init__(self, size=DEFAULT_BUFFER_SIZE, overflow=DROP_OLDEST):
+        if size < 1:
+            raise ValueError("Buffer size must be at least 1")
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.size = size
+        self.overflow = overflow
+        self.__buffer = collections.deque()
+        self.__cond = threading.Condition()
+        self.closed = False
+        # Statistics
+        self.received = 0
+        self.dropped = 0
+        self.highWater = 0
+
+    def put(self, item):
+        with self.__cond:
+            self.received += 1
+            if len(self.__buffer) >= self.size:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == DROP_OLDEST:
+                    self.__buffer.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.__buffer) >= self.size and not self.closed:
+                        self.__cond.wait()
+                    if self.closed:
+                        self.dropped += 1
+                        return
+            self.__buffer.append(item)
+            if len(self.__buffer) > self.highWater:
+                self.highWater = len(self.__buffer)
+            self.__cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.__cond:
+            if not block:
+                if not self.__buffer:
+                    raise queue.Empty
+            elif not self.__cond.wait_for(lambda: self.__buffer, timeout):
+                raise queue.Empty
+            item = self.__buffer.popleft()
+            self.__cond.notify_all()
+            return item
+
+    def qsize(self):
+        return len(self.__buffer)
+
+    def clear(self):
+        with self.__cond:
+            self.__buffer.clear()
+            self.__cond.notify_all()
+
+    # Releases the bus thread if it is blocked on this buffer.  Frames
+    # put after this is called are counted as dropped.
+    def close(self):
+        with self.__cond:
+            self.closed = True
+            self.__cond.notify_all()
+
+    def statistics(self):
+        return {"size": self.size, "queued": len(self.__buffer),
+                "received": self.received, "dropped": self.dropped,
+                "high_water": self.highWater}
+
+
+# Highest standard (11 bit) arbitration ID.  All CAN-FIX traffic uses standard
+# IDs so the dispatch index in the CANBus class is built for this range only.
+MAX_STD_ID = 0x7FF
+
+# Number of two way channels.  Each channel uses a pair of IDs starting at
+# canfix.TWOWAY_CONN_CHANS.  Nodes have to communicate on an open channel at
+# least every half second so a channel that has been quiet for longer than
+# CHANNEL_IDLE_TIME is considered free.
+TWOWAY_CHANNELS = 16
+CHANNEL_IDLE_TIME = 1.0
+
+
 class Connection:
-    """Represent a generic connection to a CANBus network"""
-    def __init__(self, sendFunction=None):
-        self.recvQueue = queue.Queue()
+    """Represent a generic connection to a CANBus network
+
+    The optional filters decide which frames the bus thread delivers to this
+    connection.  ids is an iterable of exact arbitration IDs, ranges is an
+    iterable of (low, high) inclusive tuples and masks is an iterable of
+    (id, mask) tuples that match when (arbitration_id & mask) == (id & mask).
+    A frame is accepted if it matches any of the filters.  If no filters are
+    given the connection receives every frame.  predicate is an optional
+    function that is called with each frame that passes the ID filters and
+    returns True if the frame should be queued.
+
+    Received frames are stored in a RingBuffer of bufferSize frames and
+    overflow is one of DROP_OLDEST, DROP_NEWEST or BLOCK.  limiter is an
+    optional RateLimiter that every frame sent on this connection has to go
+    through.  It can be shared between connections."""
+    def __init__(self, sendFunction=None, ids=None, ranges=None, masks=None, predicate=None,
+                 bufferSize=DEFAULT_BUFFER_SIZE, overflow=DROP_OLDEST, limiter=None):
+        self.recvQueue = RingBuffer(bufferSize, overflow)
         self.__sendFunction = sendFunction
+        self.ids = frozenset(ids) if ids else frozenset()
+        self.ranges = [(int(low), int(high)) for low, high in ranges] if ranges else []
+        self.masks = [(int(i), int(m)) for i, m in masks] if masks else []
+        self.predicate = predicate
+        self.limiter = limiter
+        self.__channelSent = {}
+        self.__channelMsg = {}
+
+    @property
+    def filtered(self):
+        return bool(self.ids or self.ranges or self.masks)
+
+    def accepts(self, arbitration_id):
+        """Returns True if the arbitration ID passes the ID filters"""
+        if not self.filtered:
+            return True
+        if arbitration_id in self.ids:
+            return True
+        for low, high in self.ranges:
+            if low <= arbitration_id <= high:
+                return True
+        for can_id, mask in self.masks:
+            if arbitration_id & mask == can_id & mask:
+                return True
+        return False
+
+    # Returns a list of all the standard arbitration IDs that this
+    # connection would accept.  Used to build the dispatch index.
+    def accepted_ids(self):
+        if not self.filtered:
+            return range(MAX_STD_ID + 1)
+        if not self.masks:
+            s = set(x for x in self.ids if x <= MAX_STD_ID)
+            for low, high in self.ranges:
+                s.update(range(max(low, 0), min(high, MAX_STD_ID) + 1))
+            return sorted(s)
+        return [x for x in range(MAX_STD_ID + 1) if self.accepts(x)]
+
+    # Called from the bus thread to deliver a frame that has already
+    # passed the ID filters
+    def put(self, msg):
+        if self.predicate is None or self.predicate(msg):
+            self.recvQueue.put(msg)
 
     def send(self, msg):
+        if self.limiter is not None:
+            self.limiter.acquire()
         self.__sendFunction(msg)
 
+    # Returns a dictionary of the receive buffer counters
+    def statistics(self):
+        return self.recvQueue.statistics()
+
     def recv(self, timeout=None):
         try:
             if timeout == None:
@@ -76,29 +238,190 @@ class Connection:
         except queue.Empty:
             raise Timeout()
 
-    # Convienience Function for sending on a channel
+    # Convienience Function for sending on a channel.  data can be any bytes
+    # like object, a slice of a memoryview for instance.  The same message
+    # object is reused for every frame sent on the channel so the data is
+    # just copied into its buffer.
     def channel_send(self, ch, data):
-        sframe = can.Message(arbitration_id = 0x7E0 + ch * 2, is_extended_id =False, data=data)
+        sframe = self.__channelMsg.get(ch)
+        if sframe is None:
+            sframe = can.Message(arbitration_id = 0x7E0 + ch * 2, is_extended_id =False)
+            self.__channelMsg[ch] = sframe
+        sframe.data[:] = data
+        sframe.dlc = len(sframe.data)
+        self.__channelSent[ch] = time.time()
         self.send(sframe)
 
-    def channel_recv(self, ch, timeout = 1.0):
+    # Waits for the next frame from the node on the channel.  If rtt is an
+    # RTTEstimator the timeout defaults to the estimator's timeout, the time
+    # since the last channel_send() is added as a sample when a frame is
+    # received and the estimator is backed off if we time out.
+    def channel_recv(self, ch, timeout = None, rtt = None):
+        if timeout is None:
+            timeout = rtt.timeout if rtt is not None else 1.0
         start = time.time()
         while True:
-            rframe = self.recv(timeout)
+            remaining = start + timeout - time.time()
+            try:
+                if remaining <= 0:
+                    raise Timeout()
+                rframe = self.recv(remaining)
+            except Timeout:
+                if rtt is not None:
+                    rtt.backoff()
+                raise
             if rframe.arbitration_id == 0x7E0 + ch*2 + 1:
+                sent = self.__channelSent.pop(ch, None)
+                if rtt is not None and sent is not None:
+                    rtt.update(time.time() - sent)
                 return rframe
-            if time.time() > (start + timeout):
-                raise Timeout()
 
 
 
 
+class RateLimiter:
+    """Token bucket that is used to limit the number of frames per second that
+    we put on the bus.  One limiter can be shared between several threads.  A
+    rate of None or 0 means no limit."""
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        if burst is None:
+            burst = max(rate // 10, 1) if rate else 1
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Blocks until count frames may be sent"""
+        if not self.rate:
+            return
+        count = min(count, self.burst)
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+                self.__last = now
+                if self.__tokens >= count:
+                    self.__tokens -= count
+                    return
+                wait = (count - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class RTTEstimator:
+    """Keeps a smoothed round trip time and its variation for one node and
+    computes the retransmission timeout from them the same way TCP does
+    (RFC 6298).  timeout is the current value that should be used when
+    waiting on a response from the node.  Samples should only be taken
+    from requests that were not retried, otherwise we can't tell which
+    request the response belongs to."""
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    GRANULARITY = 0.01
+
+    def __init__(self, initial=None, minimum=None, maximum=None):
+        self.minimum = config.rto_min if minimum is None else minimum
+        self.maximum = config.rto_max if maximum is None else maximum
+        if initial is None:
+            initial = config.rto_initial
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = min(max(initial, self.minimum), self.maximum)
+        self.samples = 0
+        self.timeouts = 0
+        self.last = None
+        self.__lock = threading.Lock()
+
+    def update(self, rtt):
+        """Adds a new round trip time sample in seconds"""
+        with self.__lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            rto = self.srtt + max(self.GRANULARITY, self.K * self.rttvar)
+            self.timeout = min(max(rto, self.minimum), self.maximum)
+            self.samples += 1
+            self.last = rtt
+
+    def backoff(self):
+        """Called when a request times out.  Doubles the timeout."""
+        with self.__lock:
+            self.timeout = min(self.timeout * 2, self.maximum)
+            self.timeouts += 1
+
+    # Returns the time that we should wait for the responses to count
+    # requests that were sent back to back.  The node answers them one
+    # at a time so each one after the first adds about one round trip.
+    def window_timeout(self, count):
+        if self.srtt is None or count <= 1:
+            return self.timeout
+        return min(self.timeout + (count - 1) * self.srtt, self.maximum * count)
+
+    def statistics(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "timeout": self.timeout,
+                "samples": self.samples, "timeouts": self.timeouts, "last": self.last}
+
+
+class Transaction:
+    """Represents a node specific request that is waiting on a response.  The
+    future is completed with the raw response frame by the bus thread.  If
+    sample is True the round trip time is added to the node's RTTEstimator
+    when the response arrives."""
+    def __init__(self, controlCode, destNode, sendNode, key=None, sample=True):
+        self.controlCode = controlCode
+        self.destNode = destNode
+        self.sendNode = sendNode
+        self.key = key
+        self.sample = sample
+        self.sent = None
+        self.future = concurrent.futures.Future()
+
+    def wait(self, timeout=None):
+        """Returns the response frame or raises Timeout"""
+        try:
+            return self.future.result(timeout)
+        except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError):
+            raise Timeout()
+
+
 class CANBus(threading.Thread):
+    # The frames come from a live bus.  See replay.Replay
+    offline = False
+
     def __init__(self):
         super(CANBus, self).__init__()
         self.getout = False
         self.daemon = True
         self.__connections = []
+        # The dispatch index is a list with one entry for every standard
+        # arbitration ID.  Each entry is a tuple of the connections that want
+        # that ID.  It is rebuilt whenever a connection is added or removed and
+        # replaced as a whole so the bus thread can read it without locking.
+        self.__index = [()] * (MAX_STD_ID + 1)
+        self.__lock = threading.Lock()
+        # Pending transactions are kept in a dictionary keyed by (control code,
+        # node) and each entry is a list of transactions in the order they were
+        # sent.  The Node Configuration Set and Query responses don't contain
+        # the configuration key so outstanding requests of the same type to the
+        # same node are completed in order.  The key is kept with the transaction
+        # for the caller.  __pendingIds is the set of arbitration IDs that we
+        # are waiting on and lets the bus thread ignore everything else.
+        self.__transactions = {}
+        self.__pendingIds = frozenset()
+        # Round trip time estimators keyed by (node, kind).  See rtt()
+        self.__rtt = {}
+        # Two way channel occupancy.  __channelActivity is the last time that
+        # we saw each channel used on the bus and __channelOwners holds the
+        # channels that have been allocated to something in this program.
+        # __watchStart is when we started listening to the bus.
+        self.__channelActivity = [None] * TWOWAY_CHANNELS
+        self.__channelOwners = {}
+        self.__watchStart = None
         self.__bus = None
         self.__connected = threading.Event()
         self.__connected.clear()
@@ -111,8 +434,8 @@ class CANBus(threading.Thread):
         self.connectedCallback = None
         self.disconnectedCallback = None
         self.recvMessageCallback = None
-        self.sendMessageCallback = None
-        self.recvMessageCallback = None
+        # Senders may reuse the message object once send() returns so this
+        # callback has to copy the message if it wants to keep it.
         self.sendMessageCallback = None
         self.recvErrorCallback = None
         self.sendErrorCallback = None
@@ -124,8 +447,12 @@ class CANBus(threading.Thread):
                 try:
                     msg = self.__bus.recv(timeout = 1.0)
                     if msg:
-                        for each in self.__connections:
-                            each.recvQueue.put(msg)
+                        if msg.arbitration_id >= canfix.NODE_SPECIFIC_MSGS:
+                            self.__track_channel(msg)
+                        if msg.arbitration_id in self.__pendingIds:
+                            self.__complete_transaction(msg)
+                        for each in self.__dispatch(msg):
+                            each.put(msg)
                         if self.recvMessageCallback != None:
                             self.recvMessageCallback(msg)
                         self.recvFrames += 1
@@ -139,6 +466,8 @@ class CANBus(threading.Thread):
     def send(self, msg):
         try:
             self.__bus.send(msg)
+            if msg.arbitration_id >= canfix.NODE_SPECIFIC_MSGS:
+                self.__track_channel(msg)
             self.sendFrames += 1
             if self.sendMessageCallback != None:
                 self.sendMessageCallback(msg)
@@ -153,8 +482,9 @@ class CANBus(threading.Thread):
     def connect(self, interface, **kwargs):
         log.debug("Connecting... {}".format(interface))
         try:
-            self.__bus = can.ThreadSafeBus(bustype=interface, **kwargs)
+            self.__bus = can.ThreadSafeBus(interface=interface, **kwargs)
             self.interface = interface
+            self.__watchStart = time.time()
             self.__connected.set()
             if self.connectedCallback is not None:
                 self.connectedCallback()
@@ -179,13 +509,184 @@ class CANBus(threading.Thread):
     def connect_wait(self, timeout=None):
         return self.__connected.wait(timeout)
 
-    def get_connection(self):
-        c = Connection(self.send)
-        self.__connections.append(c)
+    # Called from the bus thread for frames from a node that we have a pending
+    # transaction for.  Only the raw bytes are checked here, the response is
+    # parsed by whoever is waiting on the transaction.
+    def __complete_transaction(self, msg):
+        if len(msg.data) < 2:
+            return
+        node = msg.arbitration_id - canfix.NODE_SPECIFIC_MSGS
+        with self.__lock:
+            pending = self.__transactions.get((msg.data[0], node))
+            if not pending:
+                return
+            for t in pending:
+                if t.sendNode == msg.data[1]:
+                    break
+            else:
+                return
+            self.__remove_transaction(t)
+        if t.sample:
+            self.rtt(t.destNode).update(time.time() - t.sent)
+        t.future.set_result(msg)
+
+    # Must be called with the lock held
+    def __remove_transaction(self, t):
+        k = (t.controlCode, t.destNode)
+        pending = self.__transactions.get(k)
+        if pending and t in pending:
+            pending.remove(t)
+            if not pending:
+                del self.__transactions[k]
+                self.__pendingIds = frozenset(canfix.NODE_SPECIFIC_MSGS + x[1] for x in self.__transactions)
+
+    def start_transaction(self, msg, destNode, key=None, sample=True):
+        """Sends the node specific request in msg and returns a Transaction
+           that will be completed when destNode responds.  key is optional
+           and is just stored with the transaction.  sample should be False
+           for retries and for requests that are queued behind others."""
+        t = Transaction(msg.data[0], destNode, msg.arbitration_id - canfix.NODE_SPECIFIC_MSGS, key, sample)
+        with self.__lock:
+            self.__transactions.setdefault((t.controlCode, destNode), []).append(t)
+            self.__pendingIds = self.__pendingIds | {canfix.NODE_SPECIFIC_MSGS + destNode}
+        t.sent = time.time()
+        if not self.send(msg):
+            with self.__lock:
+                self.__remove_transaction(t)
+            t.future.set_exception(NotConnected())
+        return t
+
+    def cancel_transaction(self, t):
+        with self.__lock:
+            self.__remove_transaction(t)
+        t.future.cancel()
+
+    def transaction(self, msg, destNode, key=None, timeout=None, attempts=1):
+        """Sends the request in msg and waits for the response.  Returns the
+           response frame or None if the node didn't respond in time.  If
+           timeout is None the node's adaptive timeout is used and the request
+           is sent up to attempts times, doubling the timeout each time."""
+        rtt = self.rtt(destNode)
+        for attempt in range(attempts):
+            t = self.start_transaction(msg, destNode, key, sample=(attempt == 0))
+            try:
+                return t.wait(rtt.timeout if timeout is None else timeout)
+            except NotConnected:
+                return None
+            except Timeout:
+                self.cancel_transaction(t)
+                rtt.backoff()
+        return None
+
+    def rtt(self, node, kind="", **kwargs):
+        """Returns the RTTEstimator for the node.  kind can be used to keep a
+           separate estimate for requests that take much longer than others,
+           like flash writes in a bootloader.  kwargs are passed to the
+           RTTEstimator when it is created."""
+        k = (node, kind)
+        try:
+            return self.__rtt[k]
+        except KeyError:
+            with self.__lock:
+                return self.__rtt.setdefault(k, RTTEstimator(**kwargs))
+
+    # Returns a dictionary of the round trip time statistics keyed
+    # by (node, kind)
+    def rtt_statistics(self):
+        return {k: v.statistics() for k, v in list(self.__rtt.items())}
+
+    # Records the time of any traffic on a two way channel.  This includes the
+    # frames on the channel itself as well as the Update Firmware and Two Way
+    # Connection requests that assign a channel.
+    def __track_channel(self, msg):
+        arbid = msg.arbitration_id
+        if msg.is_extended_id or arbid > MAX_STD_ID:
+            return
+        ch = None
+        if arbid >= canfix.TWOWAY_CONN_CHANS:
+            ch = (arbid - canfix.TWOWAY_CONN_CHANS) // 2
+        elif len(msg.data) == 5 and msg.data[0] == 0x07: # Update Firmware Request
+            ch = msg.data[4]
+        elif len(msg.data) == 5 and msg.data[0] == 0x08: # Two Way Connection Request
+            ch = msg.data[2]
+        if ch is not None and ch < TWOWAY_CHANNELS:
+            self.__channelActivity[ch] = time.time()
+
+    def allocate_channel(self, owner=None, idle=CHANNEL_IDLE_TIME):
+        """Returns the number of a two way channel that hasn't been used on the
+           bus for idle seconds and isn't allocated to anyone else in this
+           program, or None if they are all busy.  The channel belongs to owner
+           until it is given back with release_channel().  If we haven't been
+           listening to the bus for idle seconds yet we wait until we have."""
+        if self.__watchStart is not None:
+            wait = self.__watchStart + idle - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        now = time.time()
+        with self.__lock:
+            for ch in range(TWOWAY_CHANNELS):
+                last = self.__channelActivity[ch]
+                if ch in self.__channelOwners or (last is not None and now - last < idle):
+                    continue
+                self.__channelOwners[ch] = owner
+                return ch
+        return None
+
+    def release_channel(self, ch):
+        with self.__lock:
+            self.__channelOwners.pop(ch, None)
+
+    # Returns a list with a dictionary for every two way channel that
+    # tells whether it is in use, how many seconds since it was last used
+    # (None if never) and who owns it if it is allocated in this program.
+    def channel_status(self, idle=CHANNEL_IDLE_TIME):
+        now = time.time()
+        status = []
+        with self.__lock:
+            for ch in range(TWOWAY_CHANNELS):
+                last = self.__channelActivity[ch]
+                age = None if last is None else now - last
+                status.append({"channel": ch,
+                               "active": age is not None and age < idle,
+                               "allocated": ch in self.__channelOwners,
+                               "owner": self.__channelOwners.get(ch),
+                               "idle": age})
+        return status
+
+    # Returns the connections that should receive the given frame
+    def __dispatch(self, msg):
+        if msg.is_extended_id or msg.arbitration_id > MAX_STD_ID:
+            return [c for c in self.__connections if c.accepts(msg.arbitration_id)]
+        return self.__index[msg.arbitration_id]
+
+    def __build_index(self):
+        index = [[] for x in range(MAX_STD_ID + 1)]
+        for c in self.__connections:
+            for arbid in c.accepted_ids():
+                index[arbid].append(c)
+        self.__index = [tuple(x) for x in index]
+
+    # Returns a new connection.  See the Connection class for a description
+    # of the arguments.
+    def get_connection(self, ids=None, ranges=None, masks=None, predicate=None,
+                       bufferSize=DEFAULT_BUFFER_SIZE, overflow=DROP_OLDEST, limiter=None):
+        c = Connection(self.send, ids=ids, ranges=ranges, masks=masks, predicate=predicate,
+                       bufferSize=bufferSize, overflow=overflow, limiter=limiter)
+        with self.__lock:
+            self.__connections = self.__connections + [c]
+            self.__build_index()
         return c
 
     def free_connection(self, c):
-        self.__connections.remove(c)
+        with self.__lock:
+            self.__connections = [x for x in self.__connections if x is not c]
+            self.__build_index()
+        c.recvQueue.close()
+
+    # Returns a list of the receive buffer counters for all of the
+    # open connections
+    def connection_statistics(self):
+        return [c.statistics() for c in self.__connections]
 
     def stop(self):
         self.getout = True
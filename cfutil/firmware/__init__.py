@@ -20,11 +20,17 @@
 import can
 import string
 import argparse
+import threading
+import logging
+import canfix
+from cfutil import connection
 
 #from . import common as fw
 from .common import *
 from .stdfile import *
 
+log = logging.getLogger(__name__)
+
 def Firmware(driver, filename, node, vcode, conn):
     if driver == "AT328":
         from .drivers import AVR8
@@ -40,16 +46,140 @@ def Firmware(driver, filename, node, vcode, conn):
         from .drivers import BASIC
         d = BASIC.Driver(filename, node, vcode, conn)
         return d
+    elif driver == "STM32_AHRS":
+        from .drivers import STM32_AHRS
+        return STM32_AHRS.Driver(filename, node, vcode, conn)
     elif driver == "DUMMY":
         from .drivers import DUMMY
         return DUMMY.Driver(filename, node, vcode, conn)
     else:
         raise FirmwareError("No such driver")
 
+# Downloads firmware to several nodes at the same time.  targets is a list of
+# (driver, filename, node, vcode) tuples.  Each download gets its own
+# connection and two-way channel and runs in its own thread.  All of the
+# connections share one rate limiter so rate is the maximum number of frames
+# per second that we send in total.  The results dictionary has an entry for
+# every node that is either "OK" or the reason that the download failed.
+# nodeStatus and nodeProgress hold the latest status message and progress
+# (0.0 - 1.0) of each download.  options is a dictionary of driver arguments
+# that are set on every driver that supports them.  If resume is True each
+# download starts where an interrupted download of the same file stopped.
+# models is an optional dictionary of (device type, model) by node.  A node
+# can only be given once in targets.
+class FirmwareGroup(threading.Thread):
+    def __init__(self, targets, rate=None, options=None, resume=False, models=None):
+        super(FirmwareGroup, self).__init__()
+        self.daemon = True
+        self.targets = list(targets)
+        # Each node gets one driver and two-way channel
+        nodes = [node for driver, filename, node, vcode in self.targets]
+        for node in nodes:
+            if nodes.count(node) > 1:
+                raise FirmwareError(f"Node {node} is given more than once")
+        self.rate = rate
+        self.options = dict(options) if options else {}
+        self.resume = resume
+        self.models = dict(models) if models else {}
+        self.kill = False
+        self.drivers = {}
+        self.results = {}
+        self.nodeStatus = {}
+        self.nodeProgress = {}
+        self.statusCallback = lambda message : print(message)
+        self.progressCallback = lambda *args: None
+        self.nodeStatusCallback = lambda *args: None
+        self.nodeProgressCallback = lambda *args: None
+        self.finishedCallback = lambda *args: None
+
+    @property
+    def progress(self):
+        if not self.nodeProgress:
+            return 0.0
+        return sum(self.nodeProgress.values()) / len(self.nodeProgress)
+
+    def __set_status(self, node, status):
+        self.nodeStatus[node] = status
+        self.nodeStatusCallback(node, status)
+
+    def __set_progress(self, node, progress):
+        self.nodeProgress[node] = progress
+        self.nodeProgressCallback(node, progress)
+        self.progressCallback(self.progress)
+
+    def __download(self, fw):
+        node = fw.destNode
+        try:
+            fw.download()
+            if fw.kill:
+                self.results[node] = "Canceled"
+            elif fw.progress >= 1.0:
+                self.results[node] = "OK"
+            else:
+                self.results[node] = fw.status
+        except FirmwareError as e:
+            self.results[node] = str(e)
+        except connection.Timeout:
+            self.results[node] = "Timeout"
+        except Exception as e:
+            log.error(f"Node {node}: {e}")
+            self.results[node] = str(e)
+        finally:
+            fw.end_download()
+            connection.canbus.free_connection(fw.can)
+        if self.results[node] == "OK":
+            self.__set_progress(node, 1.0)
+        self.statusCallback(f"Node {node}: {self.results[node]}")
+
+    def run(self):
+        limiter = connection.RateLimiter(self.rate)
+        for driver, filename, node, vcode in self.targets:
+            self.nodeProgress[node] = 0.0
+            conn = connection.canbus.get_connection(ranges=[(canfix.NODE_SPECIFIC_MSGS, connection.MAX_STD_ID)],
+                                                    limiter=limiter)
+            try:
+                fw = Firmware(driver, filename, node, vcode, conn)
+            except Exception as e:
+                connection.canbus.free_connection(conn)
+                log.error(f"Node {node}: {e}")
+                self.results[node] = str(e)
+                self.__set_status(node, str(e))
+                continue
+            for key, value in self.options.items():
+                try:
+                    fw[key] = value
+                except IndexError:
+                    log.debug(f"Node {node}: driver {driver} does not support {key}")
+            fw.resume = self.resume
+            fw.model = self.models.get(node)
+            fw.setStatusCallback(lambda status, node=node: self.__set_status(node, status))
+            fw.setProgressCallback(lambda progress, node=node: self.__set_progress(node, progress))
+            self.drivers[node] = fw
+        if self.kill:
+            for fw in self.drivers.values():
+                fw.kill = True
+        self.statusCallback(f"Updating firmware on {len(self.drivers)} nodes")
+        workers = []
+        for fw in self.drivers.values():
+            t = threading.Thread(target=self.__download, args=(fw,), daemon=True)
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+        good = [n for n, r in self.results.items() if r == "OK"]
+        self.statusCallback(f"Finished - Updated {len(good)} of {len(self.targets)} nodes")
+        self.finishedCallback(len(good) == len(self.targets))
+
+    def stop(self):
+        self.kill = True
+        for fw in list(self.drivers.values()):
+            fw.stop()
+
 def GetDriverList():
     return {"AT328":"ATmega328",
             "AT2561":"Atmega2561",
             "BASIC":"Basic Standard Driver",
+            "STM32_AHRS":"STM32 AHRS",
             "DUMMY":"Test Driver"}
 
 # def config():
@@ -16,15 +16,23 @@
 #  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import time
+import hashlib
+import threading
 import logging
 import canfix
 from .. import config
+from .. import settings
 import collections
 from cfutil import connection
 
 log = logging.getLogger(__name__)
 canbus = connection.canbus
 
+# Checkpoints are only written to the settings file this often while the
+# download is running.  end_download() writes the last one.
+CHECKPOINT_INTERVAL = 1.0
+_checkpointLock = threading.Lock()
+
 class FirmwareError(Exception):
     pass
 
@@ -38,9 +46,25 @@ class FirmwareBase:
         self.progress = 0.0
         self.can = conn
         self.args = {}
+        self.channel = None
+        # Round trip time estimates for the node's bootloader.  programRtt is
+        # kept separately for the requests that wait on the node to write to
+        # flash and it never goes below the fixed timeout that we used to use.
+        self.rtt = canbus.rtt(node, "firmware")
+        self.programRtt = canbus.rtt(node, "program", minimum=1.0,
+                                     maximum=max(config.rto_max, 1.0))
 
         # kill when set to True should stop downloads
         self.kill = False
+        # When resume is True the driver starts at the checkpoint that an
+        # earlier download of the same image to this node left behind.
+        self.resume = False
+        # (device type, model) of the node if the caller knows it.  Drivers
+        # use this to remember things about a kind of device.
+        self.model = None
+        self.__imageHash = None
+        self.__checkpoint = None
+        self.__checkpointSaved = 0.0
 
         # This is our node number
         if config.node is not None:
@@ -99,41 +123,28 @@ class FirmwareBase:
 
     # Download support functions
     def __getFreeChannel(self):
-        """Waits for a half a second to see if there is any traffic on any
-           of the channels and returns the channel number of the first
-           free channel"""
-        endtime = time.time() + 0.5
-        channels = [0]*16
-        while True: # Wait loop
-            try:
-                rframe = self.can.recv(0.1)
-                if rframe is not None:
-                    msg = canfix.parseMessage(rframe)
-                    if isinstance(msg, canfix.TwoWayConnection):
-                        self.channels[msg.channel] = 1
-            except connection.Timeout:
-                pass
-            except Exception as e:
-                print(e)
-            finally:
-                now = time.time()
-                if now > endtime: break
-        for ch, v in enumerate(channels):
-            if v == 0: return ch
-        return -1
+        """Returns the number of a free two way channel from the bus thread's
+           channel table or -1 if they are all in use.  We keep the channel
+           that we already have if this is a retry."""
+        if self.channel is None:
+            self.channel = canbus.allocate_channel(owner=f"Firmware Node {self.destNode}")
+        if self.channel is None:
+            return -1
+        return self.channel
 
     def __tryFirmwareReq(self):
         """Requests a firmware load, waits for 1/2 a second and determines
            if the response is correct and if so returns True returns
            False on timeout"""
-        self.channel = self.__getFreeChannel()
-        if self.channel < 0:
+        if self.__getFreeChannel() < 0:
             raise FirmwareError("No Free Channel")
         msg = canfix.UpdateFirmware(node=self.destNode, verification=self.firmwareCode, channel=self.channel)
         msg.sendNode = self.srcNode
         msg.msgType = canfix.MSG_REQUEST
         self.can.send(msg.msg)
-        endtime = time.time() + 0.1
+        # The request is repeated until the bootloader answers so we don't
+        # wait longer than the specification allows between requests.
+        endtime = time.time() + min(max(self.rtt.timeout, 0.1), 0.5)
         while True: # Wait loop
             if self.kill:
                 raise FirmwareError("Canceled")
@@ -145,7 +156,7 @@ class FirmwareBase:
             if rframe != None:
                 msg = canfix.parseMessage(rframe, silent=True)
                 if isinstance(msg, canfix.UpdateFirmware):
-                    if msg.destNode == self.srcNode:
+                    if msg.destNode == self.srcNode and msg.sendNode == self.destNode:
                         if msg.status == canfix.MSG_SUCCESS:
                             return True
                         else:
@@ -156,6 +167,78 @@ class FirmwareBase:
             if now > endtime: return False
         return True
 
+    def waitResponse(self, rtt, resend=None):
+        """Waits for the next frame from the node on our channel for the
+           adaptive timeout in rtt.  When it runs out the estimator is backed
+           off and connection.Timeout is raised so that the driver can decide
+           what to send again.  If resend is given it is called instead each
+           time the timeout runs out and we keep waiting until the estimator's
+           maximum has passed.  It should send the request again if the node
+           can take it twice or do nothing if it can't."""
+        start = time.time()
+        while True:
+            try:
+                return self.can.channel_recv(self.channel, rtt=rtt)
+            except connection.Timeout:
+                if self.kill:
+                    raise FirmwareError("Canceled")
+                if resend is None or time.time() - start >= rtt.maximum:
+                    raise
+                resend()
+
+    # Resumable downloads.  The drivers call checkpoint() with the position
+    # (block count, address, etc. it's up to the driver) up to which the node
+    # has acknowledged the image.  The checkpoint is kept in the settings file
+    # keyed by node and only holds for the image with the same hash.
+    @property
+    def imageHash(self):
+        if self.__imageHash is None:
+            h = hashlib.sha256()
+            with open(self.filename, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    h.update(chunk)
+            self.__imageHash = h.hexdigest()
+        return self.__imageHash
+
+    def getCheckpoint(self):
+        """Returns the position that an earlier download of this image to
+           this node got to or 0 if there isn't one"""
+        cp = (settings.get("firmware_checkpoints") or {}).get(str(self.destNode))
+        if cp and cp.get("driver") == type(self).__module__ and cp.get("hash") == self.imageHash:
+            return cp.get("position", 0)
+        return 0
+
+    def checkpoint(self, position):
+        self.__checkpoint = position
+        if time.time() - self.__checkpointSaved >= CHECKPOINT_INTERVAL:
+            self.__saveCheckpoint()
+
+    def clearCheckpoint(self):
+        self.__checkpoint = 0
+        self.__saveCheckpoint()
+
+    def __saveCheckpoint(self):
+        if self.__checkpoint is None:
+            return
+        self.__checkpointSaved = time.time()
+        with _checkpointLock:
+            cps = dict(settings.get("firmware_checkpoints") or {})
+            if self.__checkpoint:
+                cps[str(self.destNode)] = {"driver": type(self).__module__, "hash": self.imageHash,
+                                           "position": self.__checkpoint}
+            else:
+                cps.pop(str(self.destNode), None)
+            settings.set("firmware_checkpoints", cps)
+        self.__checkpoint = None
+
+    def end_download(self):
+        """Gives back the channel that the download was using.  This should
+           be called once the download is over whether it worked or not."""
+        self.__saveCheckpoint()
+        if self.channel is not None:
+            canbus.release_channel(self.channel)
+        self.channel = None
+
     def start_download(self):
         """this function is called from the derived class object to find
            a free channel and send the firmware request messages."""
@@ -55,8 +55,10 @@ table = (
 0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040 )
 
 class crc16:
-    def __init__(self):
-        self.crc = INITIAL_MODBUS
+    def __init__(self, data=None, initial=INITIAL_MODBUS):
+        self.crc = initial
+        if data is not None:
+            self.update(data)
 
     def addByte(self, byte):
         """Calculate a new CRC-16 with the additional byte"""
@@ -64,19 +66,56 @@ class crc16:
         crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
         self.crc = crc & 0xFFFF
 
+    def update(self, data):
+        """Calculate a new CRC-16 with all of the bytes in data.  data can be
+           bytes, bytearray, memoryview or any iterable of byte values so the
+           CRC can be built up one block at a time."""
+        crc = self.crc
+        tbl = table # Local lookups are much faster in the loop
+        for byte in data:
+            crc = (crc >> 8) ^ tbl[(crc ^ byte) & 0xFF]
+        self.crc = crc & 0xFFFF
+
     def getResult(self):
         """Return the current CRC Result"""
         return self.crc
 
 
 if __name__ == '__main__':
-    buffer = list(range(64))
+    import os
+    import timeit
 
-    crc = crc16()
+    # Check the table against the MODBUS polynomial (0xA001 reflected)
+    for n in range(256):
+        c = n
+        for bit in range(8):
+            c = (c >> 1) ^ 0xA001 if c & 1 else c >> 1
+        assert table[n] == c, f"Table entry {n} is wrong"
+
+    # Standard check value for CRC-16/MODBUS
+    assert crc16(b"123456789").getResult() == 0x4B37
 
+    # The buffer function has to match the byte at a time function
+    # whether it's done all at once or block by block
+    buffer = os.urandom(65536)
+    crc = crc16()
     for each in buffer:
         crc.addByte(each)
+    whole = crc16(buffer)
+    blocks = crc16()
+    view = memoryview(buffer)
+    for n in range(0, len(buffer), 1000):
+        blocks.update(view[n:n+1000])
+    assert crc.getResult() == whole.getResult() == blocks.getResult()
+    print("crc16 checks passed 0x{:04X}".format(crc.getResult()))
 
-    result = crc.getResult()
-    print(result)
-    print(hex(result))
+    # Micro-benchmark
+    def bytewise():
+        c = crc16()
+        for each in buffer:
+            c.addByte(each)
+    count = 20
+    t1 = timeit.timeit(bytewise, number=count) / count
+    t2 = timeit.timeit(lambda: crc16(buffer), number=count) / count
+    print("addByte(): {:.1f} MB/s".format(len(buffer) / t1 / 1e6))
+    print("update():  {:.1f} MB/s".format(len(buffer) / t2 / 1e6))
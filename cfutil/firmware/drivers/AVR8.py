@@ -20,10 +20,17 @@
 from intelhex import IntelHex
 from .. import crc
 import time
+import struct
 import can
+import canfix
 from .. import FirmwareBase
 from cfutil import connection
 
+# Bootloaders that have two page buffers answer this command with the number
+# of buffers.  We can then fill one buffer while the node is programming the
+# page from the other.
+BUFFER_QUERY = 0x06
+
 
 class Driver(FirmwareBase):
     def __init__(self, filename, node, vcode, conn):
@@ -31,14 +38,19 @@ class Driver(FirmwareBase):
         self.__ih = IntelHex()
         self.__ih.loadhex(filename)
 
-        cs = crc.crc16()
-        for each in range(self.__ih.minaddr(), self.__ih.maxaddr()+1):
-            cs.addByte(self.__ih[each])
+        cs = crc.crc16(self.__ih.tobinstr(start=self.__ih.minaddr(), end=self.__ih.maxaddr()))
         self.__size = self.__ih.maxaddr()+1
         self.__checksum = cs.getResult()
         self.__progress = 0.0
         self.blocksize = 128
         self.__currentblock = 0
+        # Use the overlapped mode if the bootloader has two page buffers.
+        # self.buffers is the number that the node told us about.
+        self.overlap = True
+        self.buffers = 1
+        # Answers that we are still waiting for from the pages that the node
+        # is erasing and writing in the overlapped mode
+        self.__pending = []
 
     # These are overriding the base class indexing methods
     # This is so that we can use the Driver["blocksize"]
@@ -46,12 +58,16 @@ class Driver(FirmwareBase):
     def __getitem__(self, idx):
         if idx == "blocksize":
             return self.blocksize
+        elif idx == "overlap":
+            return self.overlap
         else:
             raise IndexError
 
     def __setitem__(self, idx, value):
         if idx == "blocksize":
             self.blocksize = value
+        elif idx == "overlap":
+            self.overlap = bool(value)
         else:
             raise IndexError
 
@@ -68,108 +84,103 @@ class Driver(FirmwareBase):
 
     blocksize = property(getBlocksize, setBlocksize)
 
-    def __waitBufferResponse(self, channel, offset):
-        endtime = time.time() + 0.5
+    # Waits for the node to answer sframe.  If offset is None the node should
+    # echo the frame back otherwise it should answer with the buffer offset.
+    # The wait starts at the adaptive timeout in rtt and is backed off each
+    # time it runs out until the estimator's maximum has passed.  Echoes of
+    # the erase and write commands that are pending are taken off the list
+    # as they come in.  If sframe is None we wait for all of those.
+    def __waitResponse(self, sframe, rtt, offset=None):
+        start = time.time()
+        endtime = start + rtt.timeout
         while True:
+            if sframe is None and not self.__pending:
+                return True
             try:
-                rframe = self.can.recv(0.5)
+                rframe = self.can.recv(max(endtime - time.time(), 0))
             except connection.Timeout:
                 pass
             else:
-                if rframe.arbitration_id == 0x7E0 + channel + 1:
-                    if (rframe.data[0] + (rframe.data[1]<<8)) == offset:
+                if rframe.arbitration_id == self.__sframe.arbitration_id+1:
+                    if bytes(rframe.data) in self.__pending:
+                        self.__pending.remove(bytes(rframe.data))
+                    elif sframe is None:
+                        pass
+                    elif offset is None:
+                        if rframe.data == sframe.data: break
+                    elif (rframe.data[0] + (rframe.data[1]<<8)) == offset:
                         break
                     else:
                         raise connection.BadOffset
             now = time.time()
             if now > endtime:
-                raise connection.Timeout
+                rtt.backoff()
+                if now - start >= rtt.maximum:
+                    raise connection.Timeout
+                endtime = now + rtt.timeout
+        rtt.update(time.time() - start)
         return True
 
-    def __fillBuffer(self, ch, address, data):
-        length = len(data)
-        #print("Address 0x{:08X} {}".format(address, address))
-        sframe = can.Message(arbitration_id = 0x7E0 + ch, is_extended_id =False,
-                             data=[0x01, address & 0xFF, (address & 0xFF00) >> 8, (address & 0xFF0000) >> 16, (address & 0xFF000000) >> 24, 0, 1])
+    # All of the frames are sent from the one message object that is created
+    # when the download starts.  This copies data into it.
+    def __setFrame(self, data):
+        self.__sframe.data[:] = data
+        self.__sframe.dlc = len(self.__sframe.data)
+        return self.__sframe
+
+    # Asks the node how many page buffers it has.  Older bootloaders don't
+    # know the command so anything but the right answer means one.
+    def __queryBuffers(self):
+        sframe = self.__setFrame([BUFFER_QUERY])
         self.can.send(sframe)
-        endtime = time.time() + 0.5
-        while True: # Channel wait loop
+        endtime = time.time() + max(self.rtt.timeout, 0.25)
+        while time.time() < endtime:
             try:
-                rframe = self.can.recv(1)
+                rframe = self.can.recv(max(endtime - time.time(), 0))
             except connection.Timeout:
-                pass
-            else:
-                if rframe.arbitration_id == sframe.arbitration_id+1 and \
-                    rframe.data == sframe.data: break
-            now = time.time()
-            if now > endtime:
-                raise connection.Timeout
+                break
+            if rframe.arbitration_id == sframe.arbitration_id+1 and len(rframe.data) and rframe.data[0] == BUFFER_QUERY:
+                if len(rframe.data) >= 2:
+                    return max(rframe.data[1], 1)
+                break
+        return 1
+
+    def __fillBuffer(self, address, data, buffer=0):
+        length = len(data)
+        sframe = self.__setFrame(struct.pack('<BIBB', 0x01, address, buffer, 1))
+        self.can.send(sframe)
+        self.__waitResponse(sframe, self.rtt)
         for n in range(length//8):
-            # print("[{:02}: ".format(n), end='')
-            # for each in data[(8*n):(8*n) + 8]:
-            #     print("{:02X} ".format(each), end='')
-            # print("]")
-            sframe.data = data[(8*n):(8*n) + 8]
-            sframe.dlc=8
+            # data is a memoryview so this slice doesn't copy the image
+            self.__setFrame(data[(8*n):(8*n) + 8])
             self.can.send(sframe)
-            self.__waitBufferResponse(ch, (n+1)*8)
-            #time.sleep(0.3)
+            self.__waitResponse(sframe, self.rtt, (n+1)*8)
             # TODO Need to deal with the abort from the uC somewhere
         return True
 
-    def __erasePage(self, ch, address):
-        sframe = can.Message(arbitration_id = 0x7E0 + ch, is_extended_id =False,
-                             data=[0x02, address & 0xFF, (address & 0xFF00) >> 8, (address & 0xFF0000) >> 16, (address & 0xFF000000) >> 24])
+    def __erasePage(self, address):
+        sframe = self.__setFrame(struct.pack('<BI', 0x02, address))
         self.can.send(sframe)
-        endtime = time.time() + 0.5
-        while True: # Channel wait loop
-            try:
-                rframe = self.can.recv(0.1)
-            except connection.Timeout:
-                pass
-            else:
-                if rframe.arbitration_id == sframe.arbitration_id+1 and \
-                    rframe.data == sframe.data: break
-            now = time.time()
-            if now > endtime:
-                raise connection.Timeout
+        self.__waitResponse(sframe, self.programRtt)
         return True
 
-    def __writePage(self, ch, address):
-        sframe = can.Message(arbitration_id = 0x7E0 + ch, is_extended_id =False,
-                             data=[0x03, address & 0xFF, (address & 0xFF00) >> 8, (address & 0xFF0000) >> 16, (address & 0xFF000000) >> 24])
+    def __writePage(self, address):
+        sframe = self.__setFrame(struct.pack('<BI', 0x03, address))
         self.can.send(sframe)
-        endtime = time.time() + 0.5
-        while True: # Channel wait loop
-            try:
-                rframe = self.can.recv(1)
-            except connection.Timeout:
-                pass
-            else:
-                if rframe.arbitration_id == sframe.arbitration_id+1 and \
-                    rframe.data == sframe.data: break
-            now = time.time()
-            if now > endtime:
-                raise connection.Timeout
+        self.__waitResponse(sframe, self.programRtt)
 
-    def __sendComplete(self, ch):
-        sframe = can.Message(arbitration_id = 0x7E0 + ch, is_extended_id =False,
-                             data=[0x05, self.__checksum & 0xFF, (self.__checksum & 0xFF00) >> 8, \
-                                   self.__size & 0xFF, (self.__size & 0xFF00) >> 8, \
-                                   (self.__size & 0xFF0000) >> 16, (self.__size & 0xFF000000) >> 24])
+    # Sends the erase and write commands for the page in buffer without
+    # waiting for them.  The echoes are picked up while the next page is
+    # being sent.
+    def __programPage(self, address, buffer):
+        for data in (struct.pack('<BI', 0x02, address), struct.pack('<BIB', 0x03, address, buffer)):
+            self.__pending.append(data)
+            self.can.send(self.__setFrame(data))
+
+    def __sendComplete(self):
+        sframe = self.__setFrame(struct.pack('<BHI', 0x05, self.__checksum, self.__size))
         self.can.send(sframe)
-        endtime = time.time() + 0.5
-        while True: # Channel wait loop
-            try:
-                rframe = self.can.recv(1)
-            except connection.Timeout:
-                pass
-            else:
-                if rframe.arbitration_id == sframe.arbitration_id+1 and \
-                    rframe.data == sframe.data: break
-            now = time.time()
-            if now > endtime:
-                raise connection.Timeout
+        self.__waitResponse(sframe, self.programRtt)
 
     # TODO Need to make sure this fails properly when something goes wrong and
     #      it might be nice to have some retires on blocks that fail.  Might
@@ -178,31 +189,61 @@ class Driver(FirmwareBase):
     #      but it's not exactly like the specification.  Maybe change the spec,
     #      that might simplify the bootloader
     def download(self):
-        data=[]
         FirmwareBase.start_download(self)
-        for n in range(self.__blocks * self.__blocksize):
-            data.append(self.__ih[n])
+        # We send on the first id of the channel and the node answers on the
+        # second one
+        self.__sframe = can.Message(arbitration_id = canfix.TWOWAY_CONN_CHANS + 2 * self.channel,
+                                    is_extended_id =False)
+        # Gaps and the end of the last block are filled with 0xFF
+        data = memoryview(self.__ih.tobinstr(start=0, size=self.__blocks * self.__blocksize))
+        self.__pending = []
+        self.buffers = self.__queryBuffers() if self.overlap else 1
+        overlapped = self.buffers >= 2
+        buffer = 0
+        programming = None # The address of the page the node is writing
+
+        # The checkpoint is the address up to which the pages have been written
+        first = 0
+        if self.resume:
+            first = min(self.getCheckpoint() // self.__blocksize, self.__blocks)
+            if first:
+                self.sendStatus("Resuming download at block %d of %d" % (first+1, self.__blocks))
 
-        for block in range(self.__blocks):
+        for block in range(first, self.__blocks):
+            if self.kill:
+                self.sendStatus("Download Stopped")
+                return
             try:
                 address = block * self.__blocksize
                 self.sendStatus("Writing Block %d of %d" % (block+1, self.__blocks))
                 self.sendProgress(float(block) / float(self.__blocks))
                 self.__currentblock = block
-                while(self.__fillBuffer(self.channel, address, data[address:address+self.blocksize])==False):
+                while(self.__fillBuffer(address, data[address:address+self.blocksize], buffer)==False):
                     if self.kill:
                         self.sendProgress(0.0)
                         self.sendStatus("Download Stopped")
                         return
                         #raise firmware.FirmwareError("Canceled")
 
+                if overlapped:
+                    # The page before this one has to be done before we
+                    # give the node the next one to write
+                    if programming is not None:
+                        self.__waitResponse(None, self.programRtt)
+                        self.checkpoint(programming + self.__blocksize)
+                    self.__programPage(address, buffer)
+                    programming = address
+                    buffer ^= 1
+                    continue
+
                 # Erase Page
                 #print( "Erase Page Address = {}".format(address))
-                self.__erasePage(self.channel ,address)
+                self.__erasePage(address)
 
                 # Write Page
                 #print("Write Page Address = {}".format(address))
-                self.__writePage(self.channel ,address)
+                self.__writePage(address)
+                self.checkpoint(address + self.__blocksize)
             except connection.Timeout:
                 self.sendProgress(0.0)
                 self.sendStatus("FAIL: Timeout Writing Data")
@@ -215,7 +256,11 @@ class Driver(FirmwareBase):
         #self.__progress = 1.0
         #print("Download Complete Checksum".format(hex(self.__checksum), "Size", self.__size))
         try:
-            self.__sendComplete(self.channel)
+            if programming is not None:
+                self.__waitResponse(None, self.programRtt)
+                self.checkpoint(programming + self.__blocksize)
+            self.__sendComplete()
+            self.clearCheckpoint()
             self.sendStatus("Download Complete Checksum 0x%X, Size %d" % (self.__checksum, self.__size))
             self.sendProgress(1.0)
         except connection.Timeout:
@@ -20,12 +20,45 @@
 import math
 import os
 import logging
+from cfutil import settings
 from .. import FirmwareBase
 from .. import FirmwareError
 from .. import StandardFileLoader
+from cfutil import connection
 
 log = logging.getLogger(__name__)
 
+# First byte of the Transfer Options frame that is used to negotiate the
+# optional protocol features and of the Block CRC Query frame.
+# See docs/firmware_basic.rst
+TRANSFER_OPTIONS = 0xFC
+OPTION_WINDOW = 0x01
+OPTION_BLOCK_CRC = 0x02
+OPTION_RESUME = 0x03
+OPTION_MAX_BLOCKSIZE = 0x04
+OPTION_ACK = 0x80
+BLOCK_CRC_QUERY = 0xFB
+DEFAULT_WINDOW = 8
+# Number of times in a row that we try again at the same place in a block
+# after a bad offset or a timeout before we give up.
+DEFAULT_RETRIES = 8
+# When the node can resume a block, in the windowed mode we stop after this
+# many windows of data frames and wait for the node to acknowledge all of
+# them.  A lost frame only costs us the frames that were sent since then.
+SYNC_WINDOWS = 4
+# Largest block size that we ask the node for and the smallest that we'll
+# go down to when the node rejects the one from the file.
+DEFAULT_MAX_BLOCKSIZE = 4096
+MIN_BLOCKSIZE = 8
+
+
+class UnsupportedBlockSize(FirmwareError):
+    pass
+
+
+class BadAddress(FirmwareError):
+    pass
+
 
 class Driver(FirmwareBase):
     def __init__(self, filename, node, vcode, conn):
@@ -48,6 +81,35 @@ class Driver(FirmwareBase):
                     log.warn(f"Verification code in {filename} is not properly formed")
 
         self.__progress = 0.0
+        # The number of data frames that we ask the node to let us have in
+        # flight at once.  1 turns off the windowed mode.  self.window is the
+        # value that the node agreed to.
+        self.requestWindow = DEFAULT_WINDOW
+        self.window = 1
+        # In delta mode blocks are only sent if the CRC that the node reports
+        # for the block doesn't match ours.  self.blockCrc is True if the
+        # node supports the Block CRC Query.
+        self.delta = False
+        self.blockCrc = False
+        self.blocksSkipped = 0
+        # False once the node has shown that it doesn't know about the
+        # Transfer Options frame so that we don't ask it again.
+        self.__options = True
+        # When a frame or its acknowledgement is lost the block is sent
+        # again.  If the node agrees to resume blocks only the rest of the
+        # block is sent, from the offset that the node last acknowledged.  We
+        # give up after self.retries tries in a row at the same offset.
+        # self.resends counts them for the whole download.
+        self.retries = DEFAULT_RETRIES
+        self.resends = 0
+        # We start with the block size from the firmware file.  Larger
+        # blocks up to self.maxBlocksize are only used if the node tells us
+        # that it takes them, or if self.probe is set, in which case we go
+        # down from there until the node accepts one.  0 never uses more
+        # than the file's block size.  The size that works is remembered for
+        # the device model if self.model is set.
+        self.maxBlocksize = DEFAULT_MAX_BLOCKSIZE
+        self.probe = False
 
     # These are overriding the base class indexing methods
     # This is so that we can use the Driver["blocksize"]
@@ -55,82 +117,325 @@ class Driver(FirmwareBase):
     def __getitem__(self, idx):
         if idx == "blocksize":
             return self.blocksize
+        elif idx == "window":
+            return self.requestWindow
+        elif idx == "delta":
+            return self.delta
+        elif idx == "retries":
+            return self.retries
+        elif idx == "maxblocksize":
+            return self.maxBlocksize
+        elif idx == "probe":
+            return self.probe
         else:
             raise IndexError
 
     def __setitem__(self, idx, value):
         if idx == "blocksize":
             self.blocksize = value
+        elif idx == "window":
+            self.requestWindow = max(min(int(value), 255), 1)
+        elif idx == "delta":
+            self.delta = bool(value)
+        elif idx == "retries":
+            self.retries = max(int(value), 0)
+        elif idx == "maxblocksize":
+            # Block sizes are powers of two
+            value = max(int(value), 0)
+            self.maxBlocksize = 1 << (value.bit_length() - 1) if value else 0
+        elif idx == "probe":
+            self.probe = bool(value)
         else:
             raise IndexError
 
+    # Sends a Transfer Options frame and returns the value that the node
+    # answers with, or None if the node doesn't support the option.
+    # Bootloaders that don't know about the Transfer Options frame will
+    # answer with an error, echo the frame or say nothing at all.
+    def __transfer_option(self, option, value):
+        if not self.__options:
+            return None
+        self.can.channel_send(self.channel, [TRANSFER_OPTIONS, option, value])
+        try:
+            frame = self.can.channel_recv(self.channel, timeout=max(self.rtt.timeout, 0.5))
+        except connection.Timeout:
+            log.debug("No response to Transfer Options")
+            self.__options = False
+            return None
+        if len(frame.data) >= 3 and frame.data[0] == TRANSFER_OPTIONS and \
+           frame.data[1] == option | OPTION_ACK:
+            return frame.data[2]
+        self.__options = False
+        if len(frame.data) >= 1 and frame.data[0] == TRANSFER_OPTIONS:
+            # The node took this as the start of a block so we close it
+            self.can.channel_send(self.channel, [])
+            self.__wait_program()
+        return None
+
+    # Asks the node if it can accept more than one data frame at a time.
+    # If it can't we fall back to sending one frame at a time.
+    def __negotiate_window(self):
+        self.window = 1
+        if self.requestWindow <= 1:
+            return
+        granted = self.__transfer_option(OPTION_WINDOW, self.requestWindow)
+        if granted is not None:
+            self.window = max(min(granted, self.requestWindow), 1)
+        log.debug(f"Using a transfer window of {self.window}")
+
+    # Asks the node if it can report the CRC of a block of its memory.  If
+    # it can't every block is sent.
+    def __negotiate_block_crc(self):
+        self.blockCrc = False
+        if self.delta:
+            self.blockCrc = bool(self.__transfer_option(OPTION_BLOCK_CRC, 1))
+            log.debug(f"Block CRC Query {'supported' if self.blockCrc else 'not supported'}")
+
+    # Asks the node if it can take a Start Block frame in the middle of a
+    # block that failed and keep the data that it already acknowledged.  If
+    # it can't failed blocks are sent again from the start.
+    def __negotiate_resume(self):
+        self.__resume = bool(self.__transfer_option(OPTION_RESUME, 1))
+        log.debug(f"Resuming blocks {'supported' if self.__resume else 'not supported'}")
+
+    # Asks the node for the largest block size that it accepts, up to
+    # self.maxBlocksize.  It is 0 if the node doesn't tell us.
+    def __negotiate_max_blocksize(self):
+        self.__nodeBlocksize = 0
+        if self.maxBlocksize:
+            granted = self.__transfer_option(OPTION_MAX_BLOCKSIZE, self.maxBlocksize.bit_length() - 1)
+            if granted:
+                self.__nodeBlocksize = min(1 << granted, self.maxBlocksize)
+            log.debug(f"Largest block size {self.__nodeBlocksize or 'not reported'}")
+
+    # Returns True if the node already has the data of the given block.  Only
+    # whole blocks are checked since the node computes the CRC over the full
+    # block size.
+    def __block_matches(self, file, block):
+        if not self.blockCrc or len(file.block(block)) != file.blocksize:
+            return False
+        offset = file.offset + (block * file.blocksize)
+        self.can.channel_send(self.channel, [BLOCK_CRC_QUERY, file.blocktype, file.subsystem,
+                                             int(math.log2(file.blocksize))] + list(offset.to_bytes(4, 'little')))
+        # No answer is taken as a mismatch.  The query isn't sent again since
+        # the answer doesn't say which block it is for.
+        try:
+            frame = self.waitResponse(self.programRtt)
+        except connection.Timeout:
+            log.debug(f"No answer to the Block CRC Query for block {block}")
+            return False
+        if len(frame.data) < 3 or frame.data[0] != BLOCK_CRC_QUERY:
+            log.debug(f"Block CRC Query for block {block} failed {bytes(frame.data).hex()}")
+            return False
+        return int.from_bytes(frame.data[1:3], 'little') == file.blockcrc(block)
+
+    # Waits for the node to answer something that takes it a while, like
+    # writing a block to flash.  Nothing is sent again, we just wait longer.
+    def __wait_program(self):
+        return self.waitResponse(self.programRtt, resend=lambda: None)
+
     def __send_terminate(self, end_block = True):
         if end_block:
             data = []
             self.can.channel_send(self.channel, data)
-            self.can.channel_recv(self.channel)
+            self.__wait_program()
         data = [0xFE]
         self.can.channel_send(self.channel, data)
-        self.can.channel_recv(self.channel)
+        self.__wait_program()
 
 
-    # Sends a single block of data from the file given by 'block'
-    def __send_block(self, file, block):
-        offset = file.offset + (block * file.blocksize)
+    # Sends a single block of data from the file given by 'block'.  The node
+    # can't be told to go back within a block so if it reports an offset that
+    # we don't expect, or stops answering, the block is closed and sent again
+    # from the beginning.  If the node has agreed to resume blocks a new
+    # block is started at the address of the data that the node has
+    # acknowledged instead.  If shrink is True and the whole block has to be
+    # sent again we give up on it and return False so that it can be sent
+    # again in smaller blocks.
+    def __send_block(self, file, block, shrink=False):
+        address = file.offset + (block * file.blocksize)
+        # The file data starts at file.offset so the block is sliced from
+        # the start of the data.  This is a view, not a copy.
+        blockdata = file.block(block)
+        done = 0 # Bytes of the block that the node is known to have
+        tries = 0 # Times that we have tried again at this offset
+        while True:
+            self.__acked = 0
+            # Each time we try again at the same offset we stop to let the
+            # node catch up twice as often.  There is no point stopping if
+            # the whole block is sent again anyway.
+            if self.__resume:
+                self.__sync = max((self.window * SYNC_WINDOWS) >> tries, 1)
+            else:
+                self.__sync = len(blockdata)
+            try:
+                # The node may have all of the data if it was the Block End
+                # acknowledgement that was lost
+                if done < len(blockdata):
+                    self.__write_block(file, address + done, blockdata[done:])
+                break
+            except BadAddress:
+                if not done:
+                    raise
+                log.debug(f"Node did not take a block at {address + done}, sending the whole block")
+                self.__resume = False
+                done = 0
+                if shrink:
+                    return False
+            except (connection.BadOffset, connection.Timeout) as e:
+                if self.kill:
+                    raise FirmwareError("Canceled")
+                if self.__acked and self.__resume:
+                    done += self.__acked
+                    tries = 0
+                elif not self.__resume:
+                    done = 0
+                if tries >= self.retries:
+                    if isinstance(e, connection.BadOffset):
+                        self.__send_terminate()
+                        raise FirmwareError("Bad block offset received")
+                    raise
+                tries += 1
+                self.resends += 1
+                reason = "Bad offset" if isinstance(e, connection.BadOffset) else "Timeout"
+                log.debug(f"{reason} on block {block} of {file.filename}, resending from byte {done}")
+                self.sendStatus(f"{reason} writing {file.filename}: Resending Block {block+1} of {file.blockcount} "
+                                f"from byte {done} ({tries} of {self.retries} retries used)")
+                if self.__blockOpen:
+                    self.__end_block()
+                if shrink and not self.__resume:
+                    return False
+        self.__send_progress(len(blockdata))
+        return True
+
+    # Closes the block that the node is receiving and waits for the Block End
+    # acknowledgement.  The Block End frame is sent again while we wait, the
+    # node answers each one.  Anything else the node sends before that
+    # belongs to the block.  Returns True if an acknowledgement came for data
+    # past length.
+    def __end_block(self, length=None):
+        end = lambda: self.can.channel_send(self.channel, [])
+        end()
+        badOffset = False
+        frame = self.waitResponse(self.programRtt, resend=end)
+        while len(frame.data):
+            if length is not None and len(frame.data) == 4 and int.from_bytes(frame.data, 'little') >= length:
+                badOffset = True
+            frame = self.waitResponse(self.programRtt, resend=end)
+        self.__blockOpen = False
+        return badOffset
+
+    # Writes data to the node as a block that starts at address.  This is the
+    # whole block or the part of it that the node doesn't have yet.  When
+    # Timeout or BadOffset is raised self.__acked is the number of bytes from
+    # the start of data that the node is known to have.
+    def __write_block(self, file, address, data):
         # This converts the block size into the proper value for sending in the message
         # see the protocol specification for details.
         mblocksize = math.log2(file.blocksize)
         if mblocksize % 1 != 0.0:
             raise FirmwareError(f"{file.blocksize} is an invalid block size")
-        data = [file.blocktype, file.subsystem, int(mblocksize), offset & 0xFF, (offset & 0xFF00) >> 8, \
-                            (offset & 0xFF0000) >> 16, (offset & 0xFF000000) >> 24]
-        self.can.channel_send(self.channel, data)
-        frame = self.can.channel_recv(self.channel)
+        start = [file.blocktype, file.subsystem, int(mblocksize), address & 0xFF, (address & 0xFF00) >> 8, \
+                            (address & 0xFF0000) >> 16, (address & 0xFF000000) >> 24]
+        # If the acknowledgement is lost the node has the block open
+        self.__blockOpen = True
+        self.can.channel_send(self.channel, start)
+        frame = self.waitResponse(self.rtt)
+        # A late answer to the Transfer Options frame or Block CRC Query or a
+        # data or Block End acknowledgement from an earlier attempt at the
+        # block is not the ack we want.  Block End is acknowledged with an
+        # empty frame.
+        while not len(frame.data) or frame.data[0] in (TRANSFER_OPTIONS, BLOCK_CRC_QUERY) or len(frame.data) == 4:
+            frame = self.waitResponse(self.rtt)
         if frame.data[0] == 0xFF:
+            self.__blockOpen = False
+            if len(frame.data) < 2:
+                raise FirmwareError("Node Returned an Error on Block Start")
             if frame.data[1] == 0x00:
                 raise FirmwareError(f"Bad Block Type Error: {file.blocktype}")
             elif frame.data[1] == 0x01:
                 raise FirmwareError(f"Wrong Subsystem ID Error: {file.subsystem}")
             elif frame.data[1] == 0x02:
-                raise FirmwareError(f"Unsupported Block Size Error: {file.blocksize}")
+                raise UnsupportedBlockSize(f"Unsupported Block Size Error: {file.blocksize}")
             elif frame.data[1] == 0x03:
-                raise FirmwareError(f"Bad Address Error: {offset}")
+                raise BadAddress(f"Bad Address Error: {address}")
             else:
                 raise FirmwareError(f"Node Returned Error #{frame.data[1]} on Block Start")
 
-        if offset + 8 > file.size: # last block of the file
-            blockdata = file.data[offset:file.size]
-        else:
-            blockdata = file.data[offset:offset+file.blocksize]
-
-        data = []
-        for i, b in enumerate(blockdata):
-            data.append(b)
-            if i % 8 == 7:
-                self.can.channel_send(self.channel, data)
-                frame = self.can.channel_recv(self.channel)
-                result = frame.data[0] + frame.data[1]*256 + frame.data[2]*65536 + frame.data[3]*16777216;
-                # Check that the node is sending back the correct offset
-                if result != i-7:
-                    self.__send_terminate()
-                    raise FirmwareError("Bad block offset received")
-                self.__send_progress(8)
-                data = []
-
-        if data: # Send the leftovers if there is any data left
-            self.can.channel_send(self.channel, data)
-            frame = self.can.channel_recv(self.channel)
-            result = frame.data[0] + frame.data[1]*256 + frame.data[2]*65536 + frame.data[3]*16777216;
-            # Check that the node is sending back the correct offset
-            if result != i-len(data)+1:
-                self.__send_terminate()
-                raise FirmwareError("Bad block offset received")
+        self.__send_data(data)
+
+        # Send the end of block frame which is just an empty frame dlc=0.
+        # Every frame that we sent has been acknowledged so any other
+        # acknowledgement means the node has data that we didn't send.
+        if self.__end_block(len(data)):
+            self.__acked = 0
+            raise connection.BadOffset()
 
-            self.__send_progress(len(data))
+    # Sends the data frames of a block keeping up to self.window frames in
+    # flight.  With a window of 1 we wait for the acknowledgement of each
+    # frame before sending the next.  data is a memoryview so the frames are
+    # sent straight from slices of the image.
+    #
+    # The acknowledgements are cumulative so an ack for the last frame that
+    # we have sent means that the node has every frame up to it.  Acks before
+    # that don't tell us much since the node puts the next frame in the place
+    # of one that was lost.  So every self.__sync frames we stop and let the
+    # node catch up.  self.__acked is moved up each time it does.
+    def __send_data(self, data):
+        count = (len(data) + 7) // 8
+        sent = 0
+        acked = 0
+        while acked < count:
+            limit = min(count, self.__acked // 8 + self.__sync)
+            while sent < limit and sent - acked < self.window:
+                self.can.channel_send(self.channel, data[sent*8:sent*8+8])
+                sent += 1
+            frame = self.waitResponse(self.rtt)
+            if len(frame.data) != 4:
+                continue # Late answer to something else
+            result = int.from_bytes(frame.data, 'little')
+            # The offset has to be the start of a frame that we have sent
+            if result % 8 != 0 or result // 8 >= sent:
+                raise connection.BadOffset()
+            acked = max(acked, result // 8 + 1) # Older acks are just ignored
+            if acked == sent:
+                self.__acked = min(sent * 8, len(data))
 
-        # Send the end of block frame which is just an empty frame dlc=0
-        self.can.channel_send(self.channel, [])
-        self.can.channel_recv(self.channel)
+    # Block sizes that worked are kept in the settings by device model and
+    # the memory that the file is written to.
+    def __blocksize_key(self, file):
+        if self.model is None:
+            return None
+        return "{}:{}:{}:{}".format(self.model[0], self.model[1], file.blocktype, file.subsystem)
+
+    # Returns the block size that we try first for the file.  This is the one
+    # that worked the last time, or the largest power of two that the file
+    # needs up to what the node says it takes.  Otherwise it is the block
+    # size from the file unless we have been told to probe.
+    def __first_blocksize(self, file):
+        if not self.maxBlocksize:
+            return file.blocksize
+        key = self.__blocksize_key(file)
+        if key is not None:
+            cached = (settings.get("basic_block_sizes") or {}).get(key)
+            if cached:
+                return min(cached, self.maxBlocksize)
+        largest = self.__nodeBlocksize or (self.maxBlocksize if self.probe else 0)
+        if not largest:
+            return file.blocksize
+        if largest < file.blocksize:
+            return largest
+        size = 1 << max(file.size - 1, 0).bit_length()
+        return max(min(size, largest), file.blocksize)
+
+    def __save_blocksize(self, file):
+        key = self.__blocksize_key(file)
+        if key is None:
+            return
+        sizes = dict(settings.get("basic_block_sizes") or {})
+        if sizes.get(key) != file.blocksize:
+            sizes[key] = file.blocksize
+            settings.set("basic_block_sizes", sizes)
 
     def __send_progress(self, bytes):
         self.bytes_sent += bytes
@@ -142,28 +447,95 @@ class Driver(FirmwareBase):
         # Calling this function requests the download from the node
         # and sets up the channel that we'll use.
         FirmwareBase.start_download(self)
+        self.__options = True
+        self.__negotiate_window()
+        self.__negotiate_block_crc()
+        self.__negotiate_resume()
+        self.__negotiate_max_blocksize()
+        self.blocksSkipped = 0
+        self.resends = 0
+        self.__blockOpen = False
 
-        # Calculation the total number of blocks that we have to send
-        # so that we can upate the progress appropriatly.  This would
-        # be more accurate if we calculated it based on bytes of frames
-        # but this will do for now.
-        total_blocks = 0
-        blocks_sent = 0
-
-        for file in self.file.files:
-            total_blocks += file.blockcount
+        # The checkpoint is the number of bytes of all the files that the
+        # node has acknowledged.  It is kept in bytes since the block size
+        # may not be the same the next time.
+        position = 0
+        start = self.getCheckpoint() if self.resume else 0
+        if start:
+            self.sendStatus(f"Resuming download at byte {start} of {self.file.totalsize}")
 
         # Loop through the files and send them
         for file in self.file.files:
-            for block in range(file.blockcount):
-                self.sendStatus(f"Writing {file.filename}: Block {block+1} of {file.blockcount}")
-                self.__send_block(file, block)
-                blocks_sent += 1
+            # The block size is fixed once the node has accepted a block.
+            # Until then an Unsupported Block Size error means we try again
+            # with half the size.  If the node can't take the rest of a block
+            # that has failed the block size is halved, down to the one in the
+            # file, since a smaller block loses less when it is sent again.
+            # Only a size that a whole block has been written with is saved.
+            smallest = file.blocksize
+            file.blocksize = self.__first_blocksize(file)
+            negotiating = True
+            block = 0
+            while block < file.blockcount:
+                if self.kill:
+                    raise FirmwareError("Canceled")
+                size = len(file.block(block))
+                if position + size <= start:
+                    position += size
+                    self.__send_progress(size)
+                    block += 1
+                    continue
+                if self.__block_matches(file, block):
+                    self.blocksSkipped += 1
+                    self.sendStatus(f"Skipping {file.filename}: Block {block+1} of {file.blockcount} is unchanged")
+                    position += size
+                    self.__send_progress(size)
+                    self.checkpoint(position)
+                    block += 1
+                    continue
+                if self.resends:
+                    self.sendStatus(f"Writing {file.filename}: Block {block+1} of {file.blockcount} "
+                                    f"({self.resends} retries)")
+                else:
+                    self.sendStatus(f"Writing {file.filename}: Block {block+1} of {file.blockcount}")
+                try:
+                    if not self.__send_block(file, block, shrink=file.blocksize > smallest):
+                        negotiating = False
+                        log.debug(f"Sending {file.filename} in blocks of {file.blocksize // 2}")
+                        file.blocksize //= 2
+                        block *= 2 # Same position in the file with the smaller blocks
+                        continue
+                except UnsupportedBlockSize:
+                    if not negotiating or file.blocksize <= MIN_BLOCKSIZE:
+                        raise
+                    log.debug(f"Node does not accept a block size of {file.blocksize}")
+                    file.blocksize //= 2
+                    block *= 2 # Same position in the file with the smaller blocks
+                    continue
+                if negotiating:
+                    negotiating = False
+                    log.debug(f"Using a block size of {file.blocksize} for {file.filename}")
+                    self.__save_blocksize(file)
+                position += size
+                self.checkpoint(position)
+                block += 1
 
-        # Send end of transmission message
-        data=[0xFD]
-        self.can.channel_send(self.channel, data)
-        frame = self.can.channel_recv(self.channel)
+        # Send end of transmission message.  It is sent again if the node
+        # doesn't answer but a node that has started the new firmware may not
+        # answer at all.  Every block has been acknowledged by then.
+        end = lambda: self.can.channel_send(self.channel, [0xFD])
+        end()
+        try:
+            while list(self.waitResponse(self.programRtt, resend=end).data[:1]) != [0xFD]:
+                pass
+        except connection.Timeout:
+            log.warning("Node did not acknowledge the end of the download")
+        self.clearCheckpoint()
 
-        self.sendStatus("Download Complete")
+        status = "Download Complete"
+        if self.blockCrc:
+            status += f", {self.blocksSkipped} unchanged blocks skipped"
+        if self.resends:
+            status += f", {self.resends} retries"
+        self.sendStatus(status)
         self.sendProgress(1.0)
@@ -1,13 +1,35 @@
-from .. import FirmwareBase
-from intelhex import IntelHex
-import can
-from canfix.globals import TWOWAY_CONN_CHANS
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Firmware driver for the bootloader of the STM32 based AHRS.  The
+# bootloader erases the flash sectors that we ask for, then takes each
+# segment of the image as an address / length frame followed by the data
+# eight bytes at a time.
+
 import struct
-import time
-import argparse
-import tqdm
+import logging
+from intelhex import IntelHex
+from .. import FirmwareBase
+from .. import FirmwareError
 
+log = logging.getLogger(__name__)
 
+# Application flash sectors of the STM32 that the bootloader can erase.
+# The sectors below 5 hold the bootloader itself.
 SECTORS = {5:  (0x8020000, 0x8040000),
            6:  (0x8040000, 0x8060000),
            7:  (0x8060000, 0x8080000),
@@ -16,67 +38,95 @@ SECTORS = {5:  (0x8020000, 0x8040000),
            10: (0x80C0000, 0x80E0000),
            11: (0x80E0000, 0x8100000),
           }
-
-
-class STM32Firmware(FirmwareBase):
-
-  def __init__(self, filename, node, vcode, conn):
-    super().__init__(filename, node, vcode, conn)
-    self._ih = IntelHex(filename)
-
-  def __send_recv(self, data, expected_ret):
-    msg = can.Message(arbitration_id=TWOWAY_CONN_CHANS + self.channel*2, is_extended_id=False,
-                      data=data)
-    self.can.send(msg)
-    t0 = time.time()
-    while True:
-      rframe = self.can.recv()
-      if (rframe.arbitration_id == TWOWAY_CONN_CHANS + self.channel*2 + 1):
-        #print("response to set_addr", rframe)
-        if rframe.data[0] != expected_ret:
-          raise IOError(f"Expected {expected_ret} but received {rframe.data[0]}")
-        break
-      if (time.time() - t0) > 1:
-        raise IOError("Timeout waiting for response")
-
-  def __sectors_used(self):
-    for sect, bnds in SECTORS.items():
-      s = set(range(bnds[0], bnds[1])).intersection(set(range(self._ih.minaddr(), self._ih.maxaddr())))
-      if len(s) > 0:
-        yield sect
-
-  def update_fw(self):
-    self.start_download()  # This will set self.channel
-
-    # Erase necessary sectors
-    for sect in self.__sectors_used():
-      self.__send_recv([sect], 0x1)
-
-    # send code specifying done with erasing
-    self.__send_recv([0xff], 0x2)
-
-    for ns, (start_addr, stop_addr) in enumerate(self._ih.segments()):
-      print(f"Segment {ns+1} of {len(self._ih.segments())}")
-      self.__send_recv(struct.pack('II', start_addr, stop_addr - start_addr), 0x3)
-
-      # Send data
-      for n in tqdm.tqdm(list(range(start_addr, stop_addr-8, 8))):
-        self.__send_recv(bytearray([self._ih[xx] for xx in range(n,n+8)]), 0x4)
-      # last msg has a different return code
-      self.__send_recv(bytearray([self._ih[xx] for xx in range(n,n+8)]), 0x5)
-
-    # Send addr 0, 0 to state we're done.
-    self.__send_recv(struct.pack('II', 0, 0), 0x6)
-
-
-if __name__ == '__main__':
-  parser = argparse.ArgumentParser(epilog="Run within the first 10 seconds of AHRS powerup.")
-  parser.add_argument('fn', help=".hex filename")
-  parser.add_argument('-c', '--can', default='can0')
-  parser.add_argument('--ahrs-node-id', default=0x12, type=int)
-  args = parser.parse_args()
-
-  c = can.interface.Bus(args.can, bustype='socketcan')
-
-  f = STM32Firmware(args.fn, args.ahrs_node_id, 1, c)
-  f.update_fw()
+APP_START = min(lo for lo, hi in SECTORS.values())
+APP_END = max(hi for lo, hi in SECTORS.values())
+
+# Commands and the codes that the bootloader answers them with
+ERASE_DONE = 0xFF
+RET_ERASE = 0x01
+RET_ERASE_DONE = 0x02
+RET_SEGMENT = 0x03
+RET_DATA = 0x04
+RET_SEGMENT_DONE = 0x05
+RET_COMPLETE = 0x06
+
+# How often, in bytes, we report progress
+PROGRESS_INTERVAL = 1024
+
+
+class Driver(FirmwareBase):
+    def __init__(self, filename, node, vcode, conn):
+        FirmwareBase.__init__(self, filename, node, vcode, conn)
+        self.__ih = IntelHex(filename)
+        # Segments are (start, stop) with stop being one past the last byte
+        self.__segments = self.__ih.segments()
+        if not self.__segments:
+            raise FirmwareError(f"{filename} contains no data")
+        for start, stop in self.__segments:
+            if start < APP_START or stop > APP_END:
+                raise FirmwareError("Firmware contains data outside of the application flash "
+                                    f"0x{start:08X} - 0x{stop:08X}")
+        self.__size = sum(stop - start for start, stop in self.__segments)
+        # The segments are converted once into one buffer, each one padded
+        # out to a whole frame.  self.__offsets is where each one starts.
+        chunks = []
+        self.__offsets = []
+        offset = 0
+        for start, stop in self.__segments:
+            length = (stop - start + 7) & ~7
+            chunks.append(self.__ih.tobinstr(start=start, size=length))
+            self.__offsets.append(offset)
+            offset += length
+        self.__image = memoryview(b"".join(chunks))
+
+    # Returns the sectors that any of the segments overlap
+    def __sectors_used(self):
+        for sect, (lo, hi) in sorted(SECTORS.items()):
+            if any(lo < stop and start < hi for start, stop in self.__segments):
+                yield sect
+
+    def __send_recv(self, data, expected_ret, rtt=None):
+        self.can.channel_send(self.channel, data)
+        # The bootloader would take a frame that is sent again as the next
+        # one so we only ever wait longer for the answer
+        rframe = self.waitResponse(rtt or self.rtt, resend=lambda: None)
+        if len(rframe.data) == 0 or rframe.data[0] != expected_ret:
+            raise FirmwareError(f"Expected {expected_ret} but received {bytes(rframe.data).hex()}")
+        return rframe
+
+    def download(self):
+        FirmwareBase.start_download(self) # This will set self.channel
+
+        # Erase necessary sectors
+        for sect in self.__sectors_used():
+            if self.kill:
+                raise FirmwareError("Canceled")
+            self.sendStatus(f"Erasing Sector {sect}")
+            self.__send_recv([sect], RET_ERASE, self.programRtt)
+
+        # send code specifying done with erasing
+        self.__send_recv([ERASE_DONE], RET_ERASE_DONE, self.programRtt)
+
+        sent = 0
+        for ns, (start_addr, stop_addr) in enumerate(self.__segments):
+            self.sendStatus(f"Writing Segment {ns+1} of {len(self.__segments)}")
+            self.__send_recv(struct.pack('<II', start_addr, stop_addr - start_addr), RET_SEGMENT)
+
+            # The frames are slices of the image so nothing is copied
+            first = self.__offsets[ns]
+            last = first + stop_addr - start_addr
+            reported = 0
+            for n in range(first, last, 8):
+                if self.kill:
+                    raise FirmwareError("Canceled")
+                # The last frame of the segment has a different return code
+                self.__send_recv(self.__image[n:n+8], RET_SEGMENT_DONE if n + 8 >= last else RET_DATA)
+                if n - first - reported >= PROGRESS_INTERVAL:
+                    reported = n - first
+                    self.sendProgress((sent + reported) / self.__size)
+            sent += last - first
+
+        # Send addr 0, 0 to state we're done.
+        self.__send_recv(struct.pack('<II', 0, 0), RET_COMPLETE, self.programRtt)
+        self.sendStatus("Download Complete")
+        self.sendProgress(1.0)
@@ -19,12 +19,17 @@ import tarfile
 import json
 import intelhex
 import io
+import re
 import logging
+from . import crc
 
 log = logging.getLogger(__name__)
 
 # Within the tar/gzipped file there should be one or more files.  This class
-# is the base class for each file format that we supoprt.
+# is the base class for each file format that we supoprt.  The image data of
+# each file is kept in .data as a read only memoryview of one contiguous bytes
+# object so the drivers can slice blocks and frames out of it without copying.
+# .data[0] is the byte that is written to .offset.
 class StandardFileBase():
     def __init__(self, filedef):
         # These are the defaults
@@ -45,6 +50,19 @@ class StandardFileBase():
             raise ValueError("blocksize is requireed")
         log.debug(f"File {self.filename} loaded: block type = {self.blocktype}, subsyste = {self.subsystem}, block size = {self.blocksize}")
 
+    def setData(self, data):
+        self.data = memoryview(bytes(data))
+        self.size = len(self.data)
+
+    # Returns a view of the data for the given block number
+    def block(self, block):
+        start = block * self.blocksize
+        return self.data[start:start+self.blocksize]
+
+    # Returns the CRC-16 (MODBUS) of the given block
+    def blockcrc(self, block):
+        return crc.crc16(self.block(block)).getResult()
+
     @property
     def blockcount(self):
         blocks = self.size // self.blocksize
@@ -60,31 +78,19 @@ class IntelHexFile(StandardFileBase):
 
         self.__ih = intelhex.IntelHex(fobj)
         self.offset = self.__ih.minaddr() # Since IntelHex files have this information
-        self.size = self.__ih.maxaddr() - self.__ih.minaddr() + 1
-        self.data = []
-
-        for n in range(self.size):
-            self.data.append(self.__ih[n])
+        size = self.__ih.maxaddr() - self.__ih.minaddr() + 1
+        # Gaps in the file are filled with the IntelHex padding value (0xFF)
+        self.setData(self.__ih.tobinstr(start=self.offset, size=size))
 
 # This represents the ASCII hex file format.  Each
-# pair of characters represents one byte.  White
-# space is ignored.
+# pair of characters represents one byte.  Anything
+# that isn't a hex digit is ignored.
 class HexFile(StandardFileBase):
     def __init__(self, filedef, fobj):
         StandardFileBase.__init__(self, filedef)
-        self.data = []
-        x = 0
-        s = fobj.read()
-        st = s.decode()
-        for ch in st:
-            if ch.isnumeric() or (ch >= 'A' and ch <= 'F'):
-                if x % 2 == 0:
-                    sum = int(ch, 16) * 16
-                else:
-                    sum += int(ch, 16)
-                    self.data.append(sum)
-                x += 1
-        self.size = len(self.data)
+        digits = re.sub(rb'[^0-9A-Fa-f]', b'', fobj.read())
+        # A trailing half byte is dropped
+        self.setData(bytes.fromhex(digits[:len(digits) & ~1].decode('ascii')))
 
 # The List file format is for data that is actually contained
 # in the index.json file itself.  This is for small amounts of
@@ -92,17 +98,17 @@ class HexFile(StandardFileBase):
 class ListFile(StandardFileBase):
     def __init__(self, filedef):
         StandardFileBase.__init__(self, filedef)
-        self.data = []
+        data = bytearray()
 
         for x in filedef['data']:
             if isinstance(x, int):
-                self.data.append(x)
+                data.append(x)
             else:
                 try:
-                    self.data.append(int(x, 16)) # Try Base16
+                    data.append(int(x, 16)) # Try Base16
                 except:
-                    self.data.append(int(x)) # Try Base 10
-        self.size = len(self.data)
+                    data.append(int(x)) # Try Base 10
+        self.setData(data)
 
 # TODO Add base64, binhex4 and binary file fomrats
 
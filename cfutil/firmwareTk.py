@@ -18,12 +18,14 @@
 
 import logging
 import logging.config
+import canfix
 from . import connection
 from . import firmware
 from cfutil.widgets import NodeSelect
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter import filedialog
+from tkinter import messagebox
 import threading
 
 log = logging.getLogger(__name__)
@@ -40,6 +42,8 @@ class FirmwareThread(threading.Thread):
         except firmware.FirmwareError as e:
             log.error(e)
             self.error = str(e)
+        finally:
+            self.fw.end_download()
 
 
 
@@ -200,12 +204,19 @@ class FirmwareDialog(tk.Toplevel):
 
     # upload button callback.  Launch the firmware thread and disable the upload button
     def btn_upload(self, e=None):
-        conn = connection.canbus.get_connection()
+        # Firmware drivers only need node specific messages and the two way channels
+        conn = connection.canbus.get_connection(ranges=[(canfix.NODE_SPECIFIC_MSGS, connection.MAX_STD_ID)])
         try:
             self.fw = firmware.Firmware(self.driverselect.get(), self.filename.get(), self.nodeselect.value, int(self.codetext.get()), conn)
         except Exception as e:
             self.progressLabel.configure(text = e)
             return
+        node = self.nodelist[self.nodeselect.value] if self.nodeselect.value is not None else None
+        if node is not None and node.deviceid is not None:
+            self.fw.model = (node.deviceid, node.model)
+        if self.fw.getCheckpoint():
+            self.fw.resume = messagebox.askyesno("Resume Download",
+                message="An earlier download of this file to this node did not finish.  Resume where it stopped?")
         self.fw.setStopCallback(self.downloadEnded)
         self.fwThread = FirmwareThread(self.fw)
         self.fwThread.start()
@@ -224,6 +235,150 @@ class FirmwareDialog(tk.Toplevel):
             self.returning = ";`x`;"
             self.quit()
 
+
+# Dialog box used to update the firmware on several nodes at once.  Every
+# selected node gets the same firmware file and the driver and verification
+# code are taken from each node's EDS information.
+class FirmwareGroupDialog(tk.Toplevel):
+    def __init__(self, parent, nodelist, *args, **kwargs):
+        tk.Toplevel.__init__(self, parent, *args, **kwargs)
+        self.title("CANFiX Configuration Utility - Update Firmware on Multiple Nodes")
+        self.nodelist = nodelist
+        self.group = None
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        mainframe = tk.Frame(self)
+        mainframe.grid_rowconfigure(0, weight=1)
+        mainframe.grid_columnconfigure(1, weight=1)
+        mainframe.grid(column = 0, row=0, padx=2, pady=2, sticky = tk.NSEW)
+        buttonframe = tk.Frame(self)
+        buttonframe.grid_columnconfigure(0, weight=1)
+        buttonframe.grid(column=0, row=1, padx=2, pady=2, sticky=tk.EW)
+
+        self.tree = ttk.Treeview(mainframe, columns=("name", "status", "progress"), selectmode="extended")
+        self.tree.heading("#0", text="Node")
+        self.tree.heading("name", text="Device")
+        self.tree.heading("status", text="Status")
+        self.tree.heading("progress", text="Progress")
+        self.tree.column("#0", width=60, stretch=False)
+        self.tree.column("progress", width=80, stretch=False)
+        for each in self.nodelist:
+            if each is not None:
+                self.tree.insert("", tk.END, iid=str(each.nodeid), text=str(each.nodeid),
+                                 values=(each.name, "", ""))
+        self.tree.grid(row=0, column=0, columnspan=3, sticky=tk.NSEW, pady = 2, padx = 2)
+        samebtn = ttk.Button(mainframe, text="Select Same Device", command=self.select_same)
+        samebtn.grid(row=1, column=2, padx=2, pady=2, sticky=tk.E)
+
+        l = tk.Label(mainframe, text="Filename")
+        l.grid(row=2, column=0, sticky=tk.E, pady = 2, padx = 5)
+        self.filename = tk.StringVar()
+        fileentry = ttk.Entry(mainframe, textvariable=self.filename)
+        fileentry.grid(row=2, column=1, sticky=tk.EW, pady = 5, padx = 5)
+        brownsebtn = ttk.Button(mainframe, text="Browse", command=self.get_filename)
+        brownsebtn.grid(row=2, column=2, padx=2, pady=2, sticky=tk.E)
+
+        l = tk.Label(mainframe, text="Max Frame Rate")
+        l.grid(row=3, column=0, sticky=tk.E, pady = 2, padx = 5)
+        self.ratetext = tk.StringVar(value="0")
+        rateentry = ttk.Entry(mainframe, textvariable=self.ratetext)
+        rateentry.grid(row=3, column=1, sticky=tk.EW, pady = 2, padx = 5)
+        self.resumeVar = tk.IntVar(self, 1)
+        cb = ttk.Checkbutton(mainframe, text="Resume interrupted downloads", variable=self.resumeVar)
+        cb.grid(row=3, column=2, padx=2, pady=2, sticky=tk.W)
+
+        self.progressLabel = tk.Label(mainframe, text="Waiting...")
+        self.progressLabel.grid(row=4, column=0, columnspan=3, sticky=tk.W)
+        self.progressVariable = tk.IntVar()
+        self.progressBar = ttk.Progressbar(mainframe, orient='horizontal', length='300', mode='determinate', variable=self.progressVariable)
+        self.progressBar.grid(row=5, column=0, columnspan=3, sticky=tk.EW)
+
+        btn1 = ttk.Button(buttonframe, text="Close", command=self.close_mod, takefocus=0)
+        btn1.grid(row=0, column=0, padx=2, pady=2, sticky=tk.SE)
+        self.uploadButton = ttk.Button(buttonframe, text="Upload", command=self.btn_upload, underline=0, takefocus=0)
+        self.uploadButton.grid(row=0, column=1, padx=2, pady=2, sticky=tk.SE)
+
+        self.bind("<Control-u>", self.btn_upload)
+        self.bind("<Escape>", self.close_mod)
+
+        self.protocol("WM_DELETE_WINDOW", self.close_mod)
+        self.grab_set() # makes the dialog modal
+
+    # Adds every node with the same device type and model as the
+    # selected nodes to the selection
+    def select_same(self):
+        selected = [self.nodelist[int(x)] for x in self.tree.selection()]
+        kinds = {(n.deviceid, n.model) for n in selected if n.deviceid is not None}
+        for each in self.nodelist:
+            if each is not None and (each.deviceid, each.model) in kinds:
+                self.tree.selection_add(str(each.nodeid))
+
+    def get_filename(self):
+        filetypes = (
+            ('firmware', '*.cfw'),
+            ('firmware', '*.tar.gz'),
+            ('firmware', '*.bin'),
+            ('All files', '*.*')
+        )
+        filename = filedialog.askopenfilename(title="Open Firmware File",
+                                              filetypes=filetypes)
+        self.filename.set(filename)
+
+    # Called periodically during the download to update the status
+    # and the progress of each node
+    def update(self):
+        for node, status in list(self.group.nodeStatus.items()):
+            self.tree.set(str(node), "status", self.group.results.get(node, status))
+        for node, progress in list(self.group.nodeProgress.items()):
+            self.tree.set(str(node), "progress", f"{int(progress*100)}%")
+        self.progressVariable.set(int(self.group.progress*100))
+        if self.group.is_alive():
+            self.after(100, self.update)
+        else:
+            for node, result in self.group.results.items():
+                self.tree.set(str(node), "status", result)
+            good = [n for n, r in self.group.results.items() if r == "OK"]
+            self.progressLabel.configure(text = f"Updated {len(good)} of {len(self.group.targets)} nodes")
+            self.uploadButton.configure(command = self.btn_upload, text = "Upload")
+
+    def btn_upload(self, e=None):
+        if self.group is not None and self.group.is_alive():
+            return
+        try:
+            rate = int(self.ratetext.get() or 0)
+        except ValueError:
+            self.progressLabel.configure(text = "Frame rate must be a number")
+            return
+        targets = []
+        models = {}
+        for x in self.tree.selection():
+            node = self.nodelist[int(x)]
+            if node.device is None:
+                self.tree.set(x, "status", "No EDS information")
+                continue
+            self.tree.set(x, "status", "")
+            self.tree.set(x, "progress", "")
+            targets.append((node.device.fwDriver, self.filename.get(), node.nodeid, node.device.fwUpdateCode))
+            models[node.nodeid] = (node.deviceid, node.model)
+        if not targets:
+            self.progressLabel.configure(text = "No nodes selected")
+            return
+        self.group = firmware.FirmwareGroup(targets, rate=rate, resume=bool(self.resumeVar.get()), models=models)
+        self.group.statusCallback = lambda message: log.info(message)
+        self.group.start()
+        self.progressLabel.configure(text = f"Updating {len(targets)} nodes")
+        self.uploadButton.configure(command = self.btn_cancel, text = "Cancel")
+        self.after(100, self.update)
+
+    def btn_cancel(self, e=None):
+        self.group.stop()
+
+    def close_mod(self, e=None):
+        if self.group is None or not self.group.is_alive():
+            self.returning = ";`x`;"
+            self.quit()
+
 if __name__ == "__main__":
     pass
 
@@ -0,0 +1,145 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Generates CAN-FiX traffic for load testing.  The traffic comes from
+# simulated nodes that are made from the devices that we have EDS files
+# for, so each node publishes the parameters of its device.  On top of that
+# the generator can send bursts of frames, frames that are not valid and
+# parameters from nodes that share a node id with another node.
+
+import logging
+import random
+import time
+import can
+import canfix
+from . import devices
+from . import simulator
+
+log = logging.getLogger(__name__)
+
+# The parameters that are used if we don't know about any devices
+DEFAULT_PARAMETERS = [0x180, 0x181, 0x183, 0x184, 0x186, 0x190]
+
+
+# Returns the devices that have parameters, optionally only the ones that
+# match the given device type, model and version.
+def findDevices(device=None, model=None, version=None):
+    return [d for d in devices.devices.values() if d.parameters and
+            (device is None or d.deviceType == device) and
+            (model is None or d.modelNumber == model) and
+            (version is None or d.version == version)]
+
+
+# Sends the traffic of simulated nodes on the given interface.  The devices
+# are used in turn for the nodes and each parameter of a device is sent rate
+# times a second.  burst frames are sent back to back every burstInterval
+# seconds and bad is the number of frames per second that are not valid
+# CAN-FiX.  duplicates is the number of extra nodes that use the node id of
+# one of the other nodes.  The node ids in exclude are not used.
+class TrafficGenerator:
+    def __init__(self, interface, channel, deviceList=None, nodes=8, rate=10.0, burst=0,
+                 burstInterval=1.0, bad=0.0, duplicates=0, exclude=(), **kwargs):
+        self.deviceList = deviceList if deviceList is not None else findDevices()
+        self.rate = rate
+        self.burst = burst
+        self.burstInterval = burstInterval
+        self.bad = bad
+        self.badFrames = 0
+        self.burstFrames = 0
+        self.nodes = []
+        self.__random = random.Random()
+        self.network = simulator.Network(channel, interface, **kwargs)
+
+        nodeid = 0
+        for n in range(nodes + duplicates):
+            if n < nodes:
+                nodeid += 1
+                while nodeid in exclude:
+                    nodeid += 1
+                if nodeid > 255:
+                    raise ValueError("Too many nodes")
+                node = self.__makeNode(nodeid, n)
+                self.network.addNode(node)
+            else:
+                # A node that sends with the same id as another one only
+                # publishes.  It isn't added to the network so it doesn't
+                # answer anything.
+                node = self.__makeNode(self.nodes[n % nodes].nodeid, n)
+                node.attach(self.network)
+            self.nodes.append(node)
+
+        if self.burst and self.burstInterval:
+            self.network.every(self.burstInterval, self.__sendBurst, time.time() + self.burstInterval)
+        if self.bad:
+            self.network.every(1.0 / self.bad, self.__sendBad, time.time() + 1.0 / self.bad)
+
+    def __makeNode(self, nodeid, n):
+        device = self.deviceList[n % len(self.deviceList)] if self.deviceList else None
+        parameters = []
+        for pid in device.parameters if device else DEFAULT_PARAMETERS:
+            try:
+                parameters.append(simulator.Parameter(pid, self.rate))
+            except ValueError as e:
+                log.warning(f"Generator not sending: {e}")
+        if device is None:
+            return simulator.Node(nodeid, parameters=parameters)
+        return simulator.Node(nodeid, device.deviceType, device.modelNumber, device.version,
+                              description=device.name, eds={"configuration": device.configuration},
+                              parameters=parameters)
+
+    # The expected number of frames per second not counting the bursts
+    @property
+    def frameRate(self):
+        rate = sum(len(n.parameters) * self.rate for n in self.nodes)
+        rate += sum(1.0 / n.statusInterval for n in self.nodes if n.statusInterval)
+        return rate + self.bad
+
+    @property
+    def framesSent(self):
+        return self.network.framesSent
+
+    def __sendBurst(self):
+        now = time.time()
+        nodes = [n for n in self.nodes if n.parameters]
+        for x in range(self.burst if nodes else 0):
+            node = self.__random.choice(nodes)
+            p = self.__random.choice(node.parameters)
+            self.network.send(p.getMessage(node.nodeid, now))
+            self.burstFrames += 1
+
+    # Sends one of the kinds of bad frame
+    def __sendBad(self):
+        kind = self.__random.randrange(4)
+        node = self.__random.choice(self.nodes).nodeid
+        if kind == 0: # Parameter that is too short
+            msg = can.Message(arbitration_id=0x180, is_extended_id=False, data=[node, 0])
+        elif kind == 1: # Empty frame
+            msg = can.Message(arbitration_id=0x181, is_extended_id=False, data=[])
+        elif kind == 2: # Node specific message with an unknown control code
+            msg = can.Message(arbitration_id=canfix.NODE_SPECIFIC_MSGS + node, is_extended_id=False,
+                              data=[0x7F, 0, 1, 2, 3, 4, 5, 6])
+        else: # Random data on a random id
+            msg = can.Message(arbitration_id=self.__random.randrange(0x800), is_extended_id=False,
+                              data=bytes(self.__random.randrange(256) for x in range(self.__random.randrange(9))))
+        self.network.send(msg)
+        self.badFrames += 1
+
+    def start(self):
+        self.network.start()
+
+    def stop(self):
+        self.network.stop()
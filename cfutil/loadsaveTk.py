@@ -90,6 +90,11 @@ class LoadSaveDialog(tk.Toplevel):
         self.statusLabel = ttk.Label(mainFrame, text = self.status)
         self.statusLabel.grid(row=5, column=0, padx=4, pady=4, sticky=tk.W)
 
+        if self.box_type == "LOAD":
+            self.differentialVar = tk.IntVar(self, 1 if settings.get("load_differential") else 0)
+            cb = ttk.Checkbutton(mainFrame, text="Only send changed keys", variable=self.differentialVar)
+            cb.grid(row=6, column=0, padx=4, pady=4, sticky=tk.W)
+
         # cancel and 'go' buttons
         btnCancel = ttk.Button(self, text="Close", command=self.close_mod, takefocus=0)
         btnCancel.grid(row=1, column=0, sticky=tk.SE, padx=4, pady=4)
@@ -167,6 +172,8 @@ class LoadDialog(LoadSaveDialog):
                 messagebox.showerror("JSON Error", message="Configuration Save file loading error")
                 return
 
+            self.thread.differential = bool(self.differentialVar.get())
+            settings.set("load_differential", self.thread.differential)
             self.thread.statusCallback = self.set_status
             self.thread.percentCallback = self.set_progress
             self.thread.start()
@@ -193,6 +200,97 @@ class SaveDialog(LoadSaveDialog):
             self.after(100, self.update)
 
 
+# Dialog box used to save the configuration of every node on the network
+# that we have an EDS file for into a single archive.
+class NetworkSaveDialog(tk.Toplevel):
+    def __init__(self, parent, nodelist, *args, **kwargs):
+        tk.Toplevel.__init__(self, parent, *args, **kwargs)
+        self.title("Save Network Configuration")
+        self.nodelist = nodelist
+        self.status = ""
+        self.progress = 0
+        self.thread = None
+        g = settings.get("loadsave_geometry")
+        if g:
+            self.geometry(g)
+        self.grid_columnconfigure(0, weight=1)
+
+        mainFrame = ttk.Frame(self)
+        mainFrame.grid(column=0,row=0,sticky=tk.NSEW, padx=2, pady=2, columnspan=10)
+        mainFrame.grid_columnconfigure(0, weight=1)
+
+        l = ttk.Label(mainFrame, text = 'Select Archive File')
+        l.grid(row=0, column=0, padx=4, pady=4, sticky=tk.W)
+        self.filenameVar = tk.StringVar()
+        fn = settings.get("last_network_save_file")
+        if fn: self.filenameVar.set(fn)
+        self.fileEntry = ttk.Entry(mainFrame, textvariable=self.filenameVar)
+        self.fileEntry.grid(row=1, column=0, padx=4, pady=4, sticky=tk.NSEW)
+        btnBrowse = ttk.Button(mainFrame, text="Browse", command=self.file_select, underline=0)
+        btnBrowse.grid(row=1, column=1, sticky=tk.SE, padx=4, pady=4)
+
+        self.progressVariable = tk.IntVar()
+        self.progressBar = ttk.Progressbar(mainFrame, orient='horizontal', length='300', mode='determinate', variable=self.progressVariable)
+        self.progressBar.grid(row=2, column=0, padx=8, pady=8, sticky=tk.EW, columnspan=2)
+
+        self.statusLabel = ttk.Label(mainFrame, text = self.status)
+        self.statusLabel.grid(row=3, column=0, padx=4, pady=4, sticky=tk.W)
+
+        btnCancel = ttk.Button(self, text="Close", command=self.close_mod, takefocus=0)
+        btnCancel.grid(row=1, column=0, sticky=tk.SE, padx=4, pady=4)
+        btnStart = ttk.Button(self, text="Save", command=self.btn_apply, underline=0, takefocus=0)
+        btnStart.grid(row=1, column=1, sticky=tk.SE, padx=4, pady=4)
+
+        self.bind("<Control-b>", self.file_select)
+        self.bind("<Escape>", self.close_mod)
+
+        self.protocol("WM_DELETE_WINDOW", self.close_mod)
+        self.grab_set() # makes the dialog modal
+
+    def file_select(self, e=None):
+        filetypes = (
+            ('archive files', '*.tar.gz'),
+            ('All files', '*.*')
+        )
+        dn = os.path.dirname(self.filenameVar.get())
+        filename = filedialog.asksaveasfilename(filetypes=filetypes, initialdir=dn)
+        if filename:
+            self.filenameVar.set(filename)
+
+    def btn_apply(self, e=None):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        nodes = [n.nodeid for n in self.nodelist if n is not None and n.device is not None]
+        if not nodes:
+            messagebox.showerror("Save Error", message="No configurable nodes found on the network")
+            return
+        settings.set("last_network_save_file", self.filenameVar.get())
+        self.thread = configNode.NetworkSaveThread(self.filenameVar.get(), nodes)
+        self.thread.statusCallback = self.set_status
+        self.thread.percentCallback = self.set_progress
+        self.thread.start()
+        self.after(100, self.update)
+
+    def update(self):
+        self.statusLabel.configure(text = self.status)
+        self.progressVariable.set(int(self.progress))
+        if self.thread.is_alive():
+            self.after(100, self.update)
+        else:
+            self.thread.join()
+
+    def set_status(self, s):
+        self.status = s
+
+    def set_progress(self, p):
+        self.progress = p
+
+    def close_mod(self, e=None):
+        settings.set("loadsave_geometry", self.geometry())
+        self.returning = ";`x`;"
+        self.quit()
+
+
 if __name__ == "__main__":
     pass
 
@@ -31,6 +31,10 @@ import cfutil.config as config
 def auto_int(x):
     return int(x, 0)
 
+# Comma separated list of integers that could include hex values
+def auto_int_list(x):
+    return [int(each, 0) for each in x.split(',') if each.strip()]
+
 def main():
     parser = argparse.ArgumentParser(description='CAN-FIX Configuration Utility Program')
     parser.add_argument('--interactive', '-i', action='store_true', help='Run in interactive mode')
@@ -58,6 +62,59 @@ def main():
                             help='Load the configuration from the file to --node')
     parser.add_argument('--save-configuration', type=argparse.FileType('w'),
                             help='Save the configuration to the file from --node')
+    parser.add_argument('--load-network', type=argparse.FileType('r'), metavar='FILENAME',
+                            help='Load the configuration from the file to every node given by --target-nodes '
+                                 'or to every node on the network that matches the --device-* arguments')
+    parser.add_argument('--differential', action='store_true',
+                            help='Only write the configuration keys that differ from what the node already has')
+    parser.add_argument('--target-nodes', type=auto_int_list, help='Comma separated list of destination node numbers')
+    parser.add_argument('--save-network', metavar='FILENAME',
+                            help='Save the configuration of every known node on the network to an archive')
+    parser.add_argument('--max-frame-rate', type=int, default=0,
+                            help='Maximum number of frames per second to send for bulk operations (0 = no limit)')
+    parser.add_argument('--firmware-target', nargs=2, action='append', metavar=('NODE', 'FILENAME'),
+                            help='Node number and firmware file for a multi node firmware update.  Can be given more '
+                                 'than once.  --firmware-file with --target-nodes or the --device-* arguments '
+                                 'updates every one of those nodes')
+    parser.add_argument('--firmware-delta', action='store_true',
+                            help='Only send the firmware blocks that differ from what the node already has '
+                                 '(BASIC bootloaders that support the Block CRC Query)')
+    parser.add_argument('--firmware-resume', action='store_true',
+                            help='Continue an interrupted firmware download from where it stopped')
+    parser.add_argument('--simulate', action='append', metavar='EDSFILE',
+                            help='Run a simulated node described by the EDS file on a virtual CAN bus instead of '
+                                 'connecting to the configured interface.  Can be given more than once')
+    parser.add_argument('--generate', action='store_true',
+                            help='Send CAN-FiX traffic from simulated nodes made from the known EDS files.  '
+                                 'The --device-* arguments pick the devices.  With --interactive nothing else is run')
+    parser.add_argument('--generate-nodes', type=int, default=8, metavar='COUNT',
+                            help='Number of nodes to generate traffic for')
+    parser.add_argument('--generate-rate', type=float, default=10.0, metavar='HZ',
+                            help='Times per second that each parameter is sent')
+    parser.add_argument('--generate-burst', type=int, default=0, metavar='FRAMES',
+                            help='Number of frames to send back to back in each burst')
+    parser.add_argument('--generate-burst-interval', type=float, default=1.0, metavar='SECONDS',
+                            help='Time between bursts')
+    parser.add_argument('--generate-bad', type=float, default=0.0, metavar='RATE',
+                            help='Number of invalid frames to send each second')
+    parser.add_argument('--generate-duplicates', type=int, default=0, metavar='COUNT',
+                            help='Number of extra nodes that send with the node id of another node')
+    parser.add_argument('--generate-duration', type=float, default=0, metavar='SECONDS',
+                            help='Time to generate traffic for with --interactive.  0 is until interrupted')
+    parser.add_argument('--capture', metavar='FILENAME',
+                            help='Write the bus traffic to a capture file until --frame-count frames or interrupted')
+    parser.add_argument('--capture-size', type=float, default=256, metavar='MB',
+                            help='Size at which a new capture file is started.  0 writes a single file')
+    parser.add_argument('--export', nargs=2, metavar=('CAPTURE', 'OUTPUT'),
+                            help='Export a capture to a candump (.log) or Vector ASC (.asc) file')
+    parser.add_argument('--export-ids', type=auto_int_list, metavar='IDS',
+                            help='Comma separated list of arbitration IDs to export')
+    parser.add_argument('--replay', metavar='CAPTURE',
+                            help='Show the traffic from a capture instead of the bus')
+    parser.add_argument('--replay-speed', type=float, default=1.0, metavar='MULTIPLE',
+                            help='Speed to replay the capture at.  0 is as fast as possible')
+    parser.add_argument('--replay-start', type=float, default=0.0, metavar='SECONDS',
+                            help='Time into the capture to start the replay')
 
 
     args = parser.parse_args()
@@ -75,20 +132,45 @@ def main():
     from . import connection
 
     settings.set("last_start", time.time())
-    try:
-        connection.canbus.connect(config.interface, channel=config.channel)
-    except:
-        log.error("Failed to connect to {}".format(config.interface))
+    network = None
+    if args.simulate:
+        from . import simulator
+        config.interface = "virtual"
+        config.channel = args.channel or simulator.DEFAULT_CHANNEL
+        network = simulator.Network(config.channel)
+        nodeid = 1
+        for filename in args.simulate:
+            if nodeid == config.node:
+                nodeid += 1
+            network.addNode(simulator.Node(nodeid, eds=filename))
+            nodeid += 1
+        network.start()
+    # A replay doesn't need the bus
+    if not args.replay:
+        try:
+            connection.canbus.connect(config.interface, channel=config.channel)
+        except:
+            log.error("Failed to connect to {}".format(config.interface))
+    generator = None
+    if args.generate:
+        generator = mainCommand.start_generator(args)
     result = mainCommand.run(args)
     # We don't run the GUI if mainCommand.run() executed some command or we
     # were in interactive mode.
     if args.interactive is False and not result:
         from . import mainTk
-        app = mainTk.App(None)
+        replay = mainCommand.open_replay(args) if args.replay else None
+        app = mainTk.App(None, replay=replay)
         app.run()
+    elif generator is not None and not result:
+        mainCommand.wait_generator(generator, args.generate_duration)
+    if generator is not None:
+        generator.stop()
 
     connection.canbus.stop()
     connection.canbus.join()
+    if network is not None:
+        network.stop()
 
 if __name__ == "__main__":
     main()
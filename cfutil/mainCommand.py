@@ -21,6 +21,8 @@
 
 import traceback
 import logging
+import time
+import json
 import can
 import canfix
 import cfutil.config as config
@@ -65,6 +67,70 @@ def listen(conn, msg_count, raw):
             else:
                 log.error(str(e))
 
+# Writes the bus traffic to a capture until msg_count frames have been
+# captured or we are interrupted
+def capture_traffic(filename, msg_count, segmentSize):
+    import cfutil.capture as capture
+    ct = capture.CaptureThread(filename, segmentSize)
+    ct.start()
+    print("Capturing to {}".format(filename))
+    try:
+        while ct.is_alive() and (msg_count == 0 or ct.frames < msg_count):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    ct.stop()
+    ct.join()
+    print("Captured {} frames to {} file(s), {} dropped".format(ct.frames, len(ct.writer.files), ct.dropped))
+
+def export_capture(filename, output, ids):
+    import cfutil.capture as capture
+    with capture.CaptureReader(filename) as reader:
+        count = capture.export(reader, output, ids)
+    print("Exported {} of {} frames to {}".format(count, len(reader), output))
+
+# Opens the capture given by --replay.  --replay-start is the number of
+# seconds into the capture to start from.
+def open_replay(args):
+    import cfutil.replay as replay
+    r = replay.Replay(args.replay, args.replay_speed)
+    if args.replay_start and r.timeRange is not None:
+        r.seek(r.timeRange[0] + args.replay_start)
+    return r
+
+# Replays a capture through a NodeThread and prints what it finds.  The
+# rate at which the frames are handled is printed once a second so an
+# as fast as possible replay shows the throughput of the NodeThread.
+def replay_capture(args):
+    import cfutil.nodes as nodes
+    r = open_replay(args)
+    nt = nodes.NodeThread(r)
+    nt.start()
+    nt.ready.wait(1.0)
+    print("Replaying {} frames from {}".format(len(r) - r.position, args.replay))
+    start = time.time()
+    r.start()
+    last = (start, r.recvFrames)
+    try:
+        while not r.finished.wait(1.0):
+            now = time.time()
+            frames = r.recvFrames
+            print("Replayed {} frames, {:.0f} frames/s".format(frames, (frames - last[1]) / (now - last[0])))
+            last = (now, frames)
+    except KeyboardInterrupt:
+        pass
+    # Let the NodeThread finish what is in its buffer
+    while nt.conn.recvQueue.qsize() and nt.is_alive():
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    nt.stop()
+    nt.join()
+    r.stop()
+    r.join()
+    print("Replayed {} frames in {:.2f}s, {:.0f} frames/s".format(r.recvFrames, elapsed, r.recvFrames / elapsed))
+    print("Nodes: {}".format(" ".join("{:02X}".format(n.nodeid) for n in nt.nodelist if n is not None)))
+    print("Parameters: {}".format(len(nt.parameterlist)))
+
 def fwstatus(status):
     print(status)
 
@@ -72,6 +138,7 @@ def load_firmware(conn, filename, args):
     import cfutil.firmware as firmware
     driver = None
     vcode = None
+    model = None
     if args.firmware_driver:
         driver = args.firmware_driver
     if args.firmware_code:
@@ -91,6 +158,7 @@ def load_firmware(conn, filename, args):
             print("ERROR: Device firmware version must be given")
         if args.device_type and args.device_model and args.device_version:
             device = devices.findDevice(args.device_type, args.device_model, args.device_version)
+            model = (args.device_type, args.device_model)
             if device:
                 print("Found {}".format(device.name))
                 print("Using Firmware Driver", device.fwDriver)
@@ -113,6 +181,7 @@ def load_firmware(conn, filename, args):
                     msg = canfix.parseMessage(frame)
                     if msg is canfix.NodeIdentification:
                         device = devices.findDevice(msg.device, msg.model, msg.fwrev)
+                        model = (msg.device, msg.model)
                     if device:
                         print("Found", device.name, "At Node", node)
                         print("Using Firmware Driver", device.fwDriver)
@@ -127,14 +196,108 @@ def load_firmware(conn, filename, args):
             except KeyboardInterrupt:
                 return
 
+    fw = firmware.Firmware(driver, filename, node, vcode, conn)
+    fw.setStatusCallback(fwstatus)
+    fw.srcNode = args.node
+    fw.destNode = node
+    fw.model = model
+    if args.firmware_delta:
+        try:
+            fw["delta"] = True
+        except IndexError:
+            print("WARNING: Firmware driver {} does not support delta updates".format(driver))
+    fw.resume = args.firmware_resume
+    if not fw.resume and fw.getCheckpoint():
+        print("An earlier download of this file to node {} did not finish, use --firmware-resume to continue it".format(node))
     try:
-        fw = firmware.Firmware(driver, filename, node, vcode, conn)
-        fw.setStatusCallback(fwstatus)
-        fw.srcNode = args.node
-        fw.destNode = node
         fw.download()
     except KeyboardInterrupt:
         fw.kill = True
+    finally:
+        fw.end_download()
+
+# Returns True if the --device-* arguments pick the nodes to update
+def device_arguments(args):
+    return bool(args.device_type or args.device_model or args.device_version)
+
+# Returns True if the arguments ask for a firmware update on more than one node
+def multiple_firmware_targets(args):
+    if args.firmware_target:
+        return True
+    return bool(args.firmware_file and args.target_node is None and (args.target_nodes or device_arguments(args)))
+
+# Updates the firmware on several nodes at the same time.  The targets are the
+# --firmware-target pairs and/or the --firmware-file sent to the --target-node,
+# every node in --target-nodes or every node on the network that matches the
+# --device-* arguments.  A node can only be given once.  The driver and verification code come from the arguments if
+# they are given, otherwise from the EDS information for each node.  The
+# network is only searched when the nodes are picked by the --device-*
+# arguments, otherwise only the nodes that were given are asked who they are
+# and only if we need to know.
+def load_firmware_group(args):
+    import cfutil.firmware as firmware
+    if args.firmware_driver and args.firmware_code is None:
+        print("ERROR: Firmware verification code must be given with the firmware driver")
+        return
+    pairs = []
+    if args.firmware_target:
+        for node, filename in args.firmware_target:
+            pairs.append((int(node, 0), filename))
+    nodes = args.target_nodes or ([args.target_node] if args.target_node is not None else [])
+    searching = args.firmware_file and not nodes and device_arguments(args)
+    if args.firmware_file and not nodes and not searching:
+        print("ERROR: Target Node or Device must be given for the firmware file")
+        return
+    if args.firmware_file:
+        pairs.extend((node, args.firmware_file) for node in nodes)
+    found = {}
+    if searching:
+        found = configNode.findNodes(config.node)
+        nodes = [n for n, v in sorted(found.items())
+                 if (args.device_type is None or v[0] == args.device_type) and
+                    (args.device_model is None or v[1] == args.device_model) and
+                    (args.device_version is None or v[2] == args.device_version)]
+        pairs.extend((node, args.firmware_file) for node in nodes)
+    elif not args.firmware_driver:
+        def identify(node):
+            info = configNode.getNodeInformation(config.node, node)
+            if info is not None:
+                found[node] = info
+        configNode.runPerNode(sorted({node for node, filename in pairs}), identify)
+    if not pairs:
+        print("ERROR: No matching nodes found")
+        return
+    given = [node for node, filename in pairs]
+    duplicates = sorted({node for node in given if given.count(node) > 1})
+    if duplicates:
+        print("ERROR: Node {} given more than once".format(", ".join("0x{:02X}".format(n) for n in duplicates)))
+        return
+
+    targets = []
+    for node, filename in pairs:
+        if args.firmware_driver:
+            targets.append((args.firmware_driver, filename, node, args.firmware_code))
+            continue
+        device = devices.findDevice(*found[node]) if node in found else None
+        if device is None:
+            print("ERROR: Unknown Device at node 0x{:02X}".format(node))
+            continue
+        print("Found", device.name, "At Node", node, "Using Firmware Driver", device.fwDriver)
+        targets.append((device.fwDriver, filename, node, device.fwUpdateCode))
+
+    options = {"delta": True} if args.firmware_delta else {}
+    models = {node: found[node][:2] for node, filename in pairs if node in found}
+    fg = firmware.FirmwareGroup(targets, rate=args.max_frame_rate, options=options,
+                                resume=args.firmware_resume, models=models)
+    fg.start()
+    try:
+        while fg.is_alive():
+            fg.join(0.5)
+    except KeyboardInterrupt:
+        fg.stop()
+        fg.join()
+    for node in sorted(fg.results):
+        print("Node 0x{:02X} ({}): {}".format(node, node, fg.results[node]))
 
 # Creates, starts and then waits on a thread for saving the node's configuration
 # to the file poitned to by the file
@@ -143,13 +306,72 @@ def save_configuration(node, file):
     st.start()
     st.join()
 
+# Saves the configuration of every node on the network that we have an EDS
+# file for to a single archive
+def save_network_configuration(filename, rate):
+    nt = configNode.NetworkSaveThread(filename, rate=rate)
+    nt.start()
+    nt.join()
+
+# Loads one configuration file to many nodes at once and prints the
+# result for each node
+def load_network_configuration(file, args):
+    cfg = json.load(file)
+    lt = configNode.NetworkLoadThread(cfg, nodes=args.target_nodes, device=args.device_type,
+                                      model=args.device_model, version=args.device_version,
+                                      rate=args.max_frame_rate)
+    lt.differential = args.differential
+    lt.start()
+    lt.join()
+    for node in sorted(lt.results):
+        if node in lt.skipped and args.differential:
+            print("Node 0x{:02X} ({}): {} ({} unchanged keys skipped)".format(node, node, lt.results[node], lt.skipped[node]))
+        else:
+            print("Node 0x{:02X} ({}): {}".format(node, node, lt.results[node]))
+
 # Creates, starts and then waits on a thread for loading the node's configuration
 # from the file poitned to by the file
-def load_configuration(node, file):
+def load_configuration(node, file, differential=False):
     lt = configNode.LoadThread(node, file)
+    lt.differential = differential
     lt.start()
     lt.join()
 
+# Starts sending generated traffic on the configured interface.  The
+# generator has its own connection to the bus so that with the virtual
+# interface our own connection sees the traffic too.
+def start_generator(args):
+    import cfutil.generator as generator
+    deviceList = generator.findDevices(args.device_type, args.device_model, args.device_version)
+    if not deviceList:
+        print("No devices with parameters found, using the default parameters")
+    gen = generator.TrafficGenerator(config.interface, config.channel, deviceList,
+                                     nodes=args.generate_nodes, rate=args.generate_rate,
+                                     burst=args.generate_burst, burstInterval=args.generate_burst_interval,
+                                     bad=args.generate_bad, duplicates=args.generate_duplicates,
+                                     exclude=(config.node,))
+    gen.start()
+    print("Generating about {:.0f} frames/s from {} nodes".format(gen.frameRate, len(gen.nodes)))
+    return gen
+
+# Prints the rate that the generator is sending at once a second until
+# duration seconds have passed or we are interrupted
+def wait_generator(gen, duration=0):
+    start = time.time()
+    last = (start, gen.framesSent)
+    try:
+        while duration == 0 or time.time() - start < duration:
+            time.sleep(1.0)
+            now = time.time()
+            sent = gen.framesSent
+            print("Sent {} frames, {:.0f} frames/s".format(sent, (sent - last[1]) / (now - last[0])))
+            last = (now, sent)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.time() - start
+    print("Sent {} frames in {:.1f}s ({} in bursts, {} bad), {:.0f} frames/s".format(
+          gen.framesSent, elapsed, gen.burstFrames, gen.badFrames, gen.framesSent / elapsed))
+
 def run(args):
     cmdrun = False
     try:
@@ -157,7 +379,12 @@ def run(args):
         if args.list_devices == True:
             list_devices()
             cmdrun = True
-        if args.firmware_file:
+        if multiple_firmware_targets(args):
+            cmdrun = True
+            if not connection.canbus.connected:
+                raise(Exception("ERROR: No valid CAN Bus connection"))
+            load_firmware_group(args)
+        elif args.firmware_file:
             cmdrun = True
             if not connection.canbus.connected:
                 raise(Exception("ERROR: No valid CAN Bus connection"))
@@ -168,13 +395,34 @@ def run(args):
             load_firmware(conn, args.firmware_file, args)
         if args.load_configuration:
             cmdrun = True
-            load_configuration(args.node, args.load_configuration)
+            load_configuration(args.node, args.load_configuration, args.differential)
         if args.save_configuration:
             cmdrun = True
             save_configuration(args.node, args.save_configuration)
+        if args.load_network:
+            cmdrun = True
+            if not connection.canbus.connected:
+                raise(Exception("ERROR: No valid CAN Bus connection"))
+            load_network_configuration(args.load_network, args)
+        if args.save_network:
+            cmdrun = True
+            if not connection.canbus.connected:
+                raise(Exception("ERROR: No valid CAN Bus connection"))
+            save_network_configuration(args.save_network, args.max_frame_rate)
         if args.listen == True:
             listen(conn, args.frame_count, args.raw)
             cmdrun = True
+        if args.capture:
+            cmdrun = True
+            if not connection.canbus.connected:
+                raise(Exception("ERROR: No valid CAN Bus connection"))
+            capture_traffic(args.capture, args.frame_count, int(args.capture_size * 1024 * 1024))
+        if args.export:
+            cmdrun = True
+            export_capture(args.export[0], args.export[1], args.export_ids)
+        if args.replay and args.interactive:
+            cmdrun = True
+            replay_capture(args)
     except Exception as e:
         #print(e)
         traceback.print_exc()
@@ -25,16 +25,18 @@ import canfix
 from . import nodes
 from . import connection
 from . import settings
+from . import capture
 from .connectTk  import ConnectDialog
 from .configTk  import ConfigDialog
 from .infoTk import InfoDialog
 from .paramInfoTk import ParamInfoDialog
-from .firmwareTk import FirmwareDialog
-from .loadsaveTk import LoadDialog, SaveDialog
+from .firmwareTk import FirmwareDialog, FirmwareGroupDialog
+from .loadsaveTk import LoadDialog, SaveDialog, NetworkSaveDialog
 from .prefsTk import PrefsDialog
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 import tkinter.ttk as ttk
+from tkinter import filedialog
 from tkinter.messagebox import showerror
 import queue
 
@@ -50,13 +52,14 @@ UPDATE_PARAMETER = 6
 TRAFFIC_MESSAGE = 7
 
 class TrafficThread(Thread):
-    def __init__(self, callback):
+    def __init__(self, callback, bus=None):
         Thread.__init__(self)
         self.getout = False
         self.msg_callback = callback
+        self.bus = connection.canbus if bus is None else bus
 
     def run(self):
-        self.conn = connection.canbus.get_connection()
+        self.conn = self.bus.get_connection()
         while(not self.getout):
             try:
                 msg = self.conn.recv(0.5)
@@ -65,11 +68,66 @@ class TrafficThread(Thread):
                 pass
             except Exception as e:
                 log.error(e)
-        connection.canbus.free_connection(self.conn)
+        self.bus.free_connection(self.conn)
 
     def stop(self):
         self.getout = True
 
+# Replay speeds that can be picked from the controls.  0 is as fast as possible
+REPLAY_SPEEDS = {"x0.1": 0.1, "x0.25": 0.25, "x0.5": 0.5, "x1": 1.0, "x2": 2.0, "x5": 5.0,
+                 "x10": 10.0, "x100": 100.0, "Max": 0.0}
+
+# Controls for a replay.Replay.  The scale shows where we are in the
+# capture and moving it seeks the replay.
+class ReplayBar(ttk.Frame):
+    def __init__(self, master, replay):
+        ttk.Frame.__init__(self, master)
+        self.replay = replay
+        self.start, self.end = replay.timeRange or (0.0, 0.0)
+        self.__dragging = False
+        self.playButton = ttk.Button(self, text="Pause", width=6, command=self.play_pause)
+        self.playButton.pack(side=tk.LEFT, padx=4, pady=2)
+        self.speedVar = tk.StringVar()
+        for name, speed in REPLAY_SPEEDS.items():
+            if speed == replay.speed:
+                self.speedVar.set(name)
+        speedCombo = ttk.Combobox(self, textvariable=self.speedVar, values=list(REPLAY_SPEEDS),
+                                  width=6, state="readonly")
+        speedCombo.bind("<<ComboboxSelected>>", self.set_speed)
+        speedCombo.pack(side=tk.LEFT, padx=4, pady=2)
+        self.timeLabel = ttk.Label(self, width=24)
+        self.timeLabel.pack(side=tk.RIGHT, padx=4, pady=2)
+        self.scale = ttk.Scale(self, from_=0.0, to=max(self.end - self.start, 0.001), orient=tk.HORIZONTAL)
+        self.scale.bind("<ButtonPress-1>", self.drag_start)
+        self.scale.bind("<ButtonRelease-1>", self.drag_end)
+        self.scale.pack(side=tk.LEFT, padx=4, pady=2, fill=tk.X, expand=True)
+
+    def play_pause(self):
+        if self.replay.paused:
+            self.replay.resume()
+        else:
+            self.replay.pause()
+        self.refresh()
+
+    def set_speed(self, event=None):
+        self.replay.speed = REPLAY_SPEEDS[self.speedVar.get()]
+
+    def drag_start(self, event):
+        self.__dragging = True
+
+    def drag_end(self, event):
+        self.__dragging = False
+        self.replay.seek(self.start + self.scale.get())
+
+    # Called from the manager to keep the controls up to date
+    def refresh(self):
+        self.playButton.configure(text="Play" if self.replay.paused or self.replay.finished.is_set() else "Pause")
+        t = self.replay.time if self.replay.time is not None else self.start
+        if not self.__dragging:
+            self.scale.set(t - self.start)
+        self.timeLabel.configure(text="{:.1f} / {:.1f}s  {}/{}".format(t - self.start, self.end - self.start,
+                                                                     self.replay.position, len(self.replay)))
+
 class StatusBar(tk.Frame):
     def __init__(self, master):
         tk.Frame.__init__(self, master)
@@ -120,9 +178,12 @@ class ParameterView(ttk.Treeview):
         self.column('quality', width=80, stretch=False)
 
 
+# If replay is given the nodes, parameters and traffic come from that
+# replay.Replay instead of the bus.
 class App(tk.Tk):
-    def __init__(self, parent, *args, **kwargs):
+    def __init__(self, parent, *args, replay=None, **kwargs):
         tk.Tk.__init__(self, parent, *args, **kwargs)
+        self.replay = replay
         self.title("CANFiX Configuration Utility")
         g = settings.get("main_geometry")
         if g:
@@ -133,7 +194,7 @@ class App(tk.Tk):
         self.nb = ttk.Notebook(self)
         self.cmd_queue = queue.Queue()
 
-        self.nt = nodes.NodeThread()
+        self.nt = nodes.NodeThread(replay)
         self.nt.set_node_callbacks(self.add_node, self.del_node, self.update_node)
         self.nt.set_parameter_callbacks(self.add_parameter, self.del_parameter, self.update_parameter)
         connection.canbus.connectedCallback = self.connect_callback
@@ -144,6 +205,7 @@ class App(tk.Tk):
         file_menu = tk.Menu(self.menubar, tearoff = 0)
         file_menu.add_command(label='Save Configuration...', command=self.save_configuration, underline=0)
         file_menu.add_command(label='Load Configuration...', command=self.load_configuration, underline=0)
+        file_menu.add_command(label='Save Network Configuration...', command=self.save_network_configuration, underline=5)
         file_menu.add_separator()
         file_menu.add_command(label='Preferences...', command=self.preferences, underline=0)
         file_menu.entryconfig('Preferences...', state='disabled') # Temporary until we finish the preferences
@@ -157,6 +219,8 @@ class App(tk.Tk):
             self.comm_menu.entryconfig('Connect...', state='disabled')
         else:
             self.comm_menu.entryconfig('Disconnect...', state='disabled')
+        if replay is not None:
+            self.comm_menu.entryconfig('Connect...', state='disabled')
 
         self.tools_menu = tk.Menu(self.menubar, tearoff = 0)
         self.tools_menu.add_command(label='Information...', underline=0, command=self.show_information)
@@ -164,6 +228,7 @@ class App(tk.Tk):
         self.tools_menu.add_command(label='Configure Node...', underline=1, command=self.configure_node)
         self.tools_menu.add_separator()
         self.tools_menu.add_command(label='Update Firmware...', underline=0, command=self.load_firmware)
+        self.tools_menu.add_command(label='Update Firmware on Multiple Nodes...', underline=19, command=self.load_firmware_group)
         help_menu = tk.Menu(self.menubar, tearoff = 0)
         help_menu.add_command(label='Specification', underline=0)
         help_menu.add_separator()
@@ -199,18 +264,27 @@ class App(tk.Tk):
 
         # Traffic Tab
         self.trafficbox = ScrolledText(trafficTab)
-        self.trafficbox.grid(row=0, column=0, padx=2, pady=2, sticky=tk.NSEW, columnspan=2)
+        self.trafficbox.grid(row=0, column=0, padx=2, pady=2, sticky=tk.NSEW, columnspan=3)
         self.trafficRawVar = tk.IntVar()
         trafficRawCheck = ttk.Checkbutton(trafficTab, text="Raw CAN Messages", variable=self.trafficRawVar)
-        trafficRawCheck.grid(row=1, column=0, padx=4, pady=4, sticky=tk.E, columnspan=2)
+        trafficRawCheck.grid(row=1, column=0, padx=4, pady=4, sticky=tk.E, columnspan=3)
+        self.captureButton = ttk.Button(trafficTab, text = "Capture...", command=self.start_capture)
+        self.captureButton.grid(row=2, column=0, padx=4, pady=4, sticky=tk.E)
         self.clearnButton = ttk.Button(trafficTab, text = "Clear", command=self.clear_traffic)
-        self.clearnButton.grid(row=2, column=0, padx=4, pady=4, sticky=tk.E)
+        self.clearnButton.grid(row=2, column=1, padx=4, pady=4, sticky=tk.E)
         self.trafficButton = ttk.Button(trafficTab, text = "Start", command=self.start_traffic)
-        self.trafficButton.grid(row=2, column=1, padx=4, pady=4, sticky=tk.E)
+        self.trafficButton.grid(row=2, column=2, padx=4, pady=4, sticky=tk.E)
+        self.captureThread = None
 
         self.nb.pack(expand=True, fill=tk.BOTH, side=tk.TOP)
+        self.replayBar = None
+        if replay is not None:
+            self.replayBar = ReplayBar(self, replay)
+            self.replayBar.pack(fill=tk.X)
         self.sb = StatusBar(self)
-        if connection.canbus.connected:
+        if replay is not None:
+            self.sb.set("Replaying {}".format(replay.reader.filename))
+        elif connection.canbus.connected:
             self.sb.set("Connected")
         else:
             self.sb.set("Not Connected")
@@ -224,6 +298,8 @@ class App(tk.Tk):
         self.protocol("WM_DELETE_WINDOW", self.close_mod)
 
     def close_mod(self):
+        if self.captureThread is not None:
+            self.stop_capture()
         settings.set("main_geometry", self.geometry())
         self.destroy()
 
@@ -256,7 +332,7 @@ class App(tk.Tk):
         self.cmd_queue.put((TRAFFIC_MESSAGE, msg))
 
     def start_traffic(self): # Start Traffic button
-        self.trafficThread = TrafficThread(self.traffic_callback)
+        self.trafficThread = TrafficThread(self.traffic_callback, self.replay)
         self.trafficThread.start()
         self.trafficButton.configure(command = self.stop_traffic, text = "Stop")
 
@@ -266,6 +342,28 @@ class App(tk.Tk):
         self.trafficThread = None
         self.trafficButton.configure(command = self.start_traffic, text = "Start")
 
+    def start_capture(self): # Capture... button
+        filetypes = (("Capture Files", "*" + capture.CAPTURE_EXT), ("All Files", "*.*"))
+        filename = filedialog.asksaveasfilename(title="Capture Traffic", filetypes=filetypes,
+                                                defaultextension=capture.CAPTURE_EXT)
+        if not filename:
+            return
+        try:
+            self.captureThread = capture.CaptureThread(filename, segmentSize=0)
+        except OSError as e:
+            showerror("Capture", str(e))
+            return
+        self.captureThread.start()
+        self.captureButton.configure(command = self.stop_capture, text = "Stop Capture")
+        self.sb.set("Capturing to {}".format(filename))
+
+    def stop_capture(self): # Stop Capture button
+        self.captureThread.stop()
+        self.captureThread.join(2.0)
+        self.sb.set("Captured {} frames, {} dropped".format(self.captureThread.frames, self.captureThread.dropped))
+        self.captureThread = None
+        self.captureButton.configure(command = self.start_capture, text = "Capture...")
+
     def clear_traffic(self): # Clear Traffic button
         self.trafficbox['state']='normal'
         self.trafficbox.delete('1.0', tk.END)
@@ -341,6 +439,11 @@ class App(tk.Tk):
         sd.mainloop()
         sd.destroy()
 
+    def save_network_configuration(self):
+        sd = NetworkSaveDialog(self, self.nt.nodelist)
+        sd.mainloop()
+        sd.destroy()
+
     def preferences(self):
         prefs = PrefsDialog(self)
         prefs.mainloop()
@@ -403,6 +506,11 @@ class App(tk.Tk):
         fd.mainloop()
         fd.destroy()
 
+    def load_firmware_group(self):
+        fd = FirmwareGroupDialog(self, self.nt.nodelist)
+        fd.mainloop()
+        fd.destroy()
+
 
     def node_select(self, event):
         pass
@@ -469,13 +577,20 @@ class App(tk.Tk):
 
                 except Exception as e:
                     print(f"Error in node.manager() {e}") #TODO change to debug logging
+        if self.replayBar is not None:
+            self.replayBar.refresh()
         self.after(100, self.manager)
 
     def run(self):
         self.nt.start() # Start the Node Handling Thread
+        if self.replay is not None:
+            self.nt.ready.wait(1.0)
+            self.replay.start()
         self.after(100, self.manager)
         self.mainloop() # Start the GUI
         self.nt.stop()
+        if self.replay is not None:
+            self.replay.stop()
 
 
 
@@ -16,7 +16,7 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-from threading import Thread
+from threading import Thread, Event
 import time
 import logging
 import can
@@ -41,10 +41,12 @@ class Parameter():
         self.quality = ''
         self.meta = {}
 
-    # This function returns True if a change was made
-    def update(self, msg):
+    # This function returns True if a change was made.  now is the time of
+    # the update, the current time if it isn't given.
+    def update(self, msg, now=None):
         # TODO Check that we make a change
-        self.lastupdate = time.time()
+        if now is None:
+            now = time.time()
         self.nodeid = msg.node
         self.pid = msg.identifier
         self.index = msg.index
@@ -70,7 +72,7 @@ class Parameter():
         #TODO deal with quality string
 
         #TODO add min / max and meta information
-        self.lastupdate = time.time()
+        self.lastupdate = now
         return True
 
 
@@ -131,8 +133,8 @@ class Node():
             self.device = devices.findDevice(self.__deviceid, self.__model, self.__version)
         self.lastupdate = time.time()
 
-    def update(self):
-        self.lastupdate = time.time()
+    def update(self, now=None):
+        self.lastupdate = time.time() if now is None else now
 
     @property
     def device(self):
@@ -156,10 +158,18 @@ class Node():
             return f"Error {self.status}"
 
 
+# bus is the connection.CANBus, or something with the same connection
+# interface like a replay.Replay, that the messages come from.  If the bus is
+# offline the nodes and parameters are aged by the timestamps of the frames
+# instead of the clock so that they come and go as they did when the frames
+# were captured, whatever speed they are replayed at.
 class NodeThread(Thread):
-    def __init__(self):
+    def __init__(self, bus=None):
         Thread.__init__(self)
         self.getout = False
+        self.bus = connection.canbus if bus is None else bus
+        # Set once we have our connection to the bus
+        self.ready = Event()
         # list of nodes.  The node id = the index
         self.nodelist = [None]*256
         # dictionary to contain all of the received parameters.  The key is the parameter id
@@ -172,8 +182,9 @@ class NodeThread(Thread):
         self.__update_parameter_callback = None
 
 
-    def __add_node(self, nodeid, sendid=True):
+    def __add_node(self, nodeid, now, sendid=True):
         self.nodelist[nodeid] = Node(nodeid)
+        self.nodelist[nodeid].update(now)
         if sendid:
             # Send a node identification request for the new node
             nid = canfix.NodeIdentification()
@@ -196,12 +207,15 @@ class NodeThread(Thread):
 
 
     # This takes the message and deals with it.  It handles creating nodes and parameters
-    # if needed as well as updating
-    def update_node(self, msg):
+    # if needed as well as updating.  now is the time that the message was received,
+    # the current time if it isn't given.
+    def update_node(self, msg, now=None):
+        if now is None:
+            now = time.time()
         if isinstance(msg, canfix.NodeIdentification):
             if msg.msgType == canfix.MSG_RESPONSE:
                 if self.nodelist[msg.sendNode] == None:
-                    self.__add_node(msg.sendNode, sendid = False)
+                    self.__add_node(msg.sendNode, now, sendid = False)
                 else:
                     if self.__update_node_callback is not None:
                         self.__update_node_callback(self.nodelist[msg.sendNode])
@@ -209,15 +223,16 @@ class NodeThread(Thread):
                 x.deviceid = msg.device
                 x.version = msg.fwrev
                 x.model = msg.model
+                x.update(now)
         elif isinstance(msg, canfix.NodeDescription):
             if self.nodelist[msg.sendNode] == None:
-                self.__add_node(msg.sendNode, sendid = False)
+                self.__add_node(msg.sendNode, now, sendid = False)
             self.nodelist[msg.sendNode].set_description(msg.packetnumber, msg.chars)
         elif isinstance(msg, canfix.NodeStatus):
             if self.nodelist[msg.sendNode] == None:
-                self.__add_node(msg.sendNode)
+                self.__add_node(msg.sendNode, now)
             else:
-                self.nodelist[msg.sendNode].update()
+                self.nodelist[msg.sendNode].update(now)
                 if self.__update_node_callback is not None:
                         self.__update_node_callback(self.nodelist[msg.sendNode])
             if msg.controlCode == 0: # Status
@@ -231,23 +246,25 @@ class NodeThread(Thread):
                     self.__add_parameter_callback(self.parameterlist[pid])
             # either way update the parameter in the dict and if the callback is
             # assigned then call it
-            if self.parameterlist[pid].update(msg) and self.__update_parameter_callback:
+            if self.parameterlist[pid].update(msg, now) and self.__update_parameter_callback:
                     self.__update_parameter_callback(self.parameterlist[pid])
             # If we don't have then node in the list yet then add it
             if self.nodelist[msg.node] == None:
-                self.__add_node(msg.node)
+                self.__add_node(msg.node, now)
             # If it's already there then we can update the time
             else:
-                self.nodelist[msg.node].update()
+                self.nodelist[msg.node].update(now)
 
     # This loops through everything and makes sure we're all goo
     # it'll delete nodes and paramters if they have not been updated
-    # in time
-    def checkall(self):
-        now = time.time()
+    # in time.  Anything updated after now is deleted too, that only happens when
+    # a replay is moved back.
+    def checkall(self, now=None):
+        if now is None:
+            now = time.time()
         for i, v in enumerate(self.nodelist):
             if v is not None:
-                if now > v.lastupdate + 5.0: # If node is more than 4 seconds old
+                if now > v.lastupdate + 5.0 or now < v.lastupdate: # If node is more than 4 seconds old
                     self.nodelist[i] = None  # Delete it
                     if self.__del_node_callback is not None:
                         self.__del_node_callback(v)
@@ -256,7 +273,7 @@ class NodeThread(Thread):
         # through the loop.
         del_list = []
         for k in self.parameterlist:
-            if now > self.parameterlist[k].lastupdate + 5:
+            if now > self.parameterlist[k].lastupdate + 5 or now < self.parameterlist[k].lastupdate:
                 if self.__del_parameter_callback is not None:
                     self.__del_parameter_callback(self.parameterlist[k])
                 del_list.append(k)
@@ -267,23 +284,33 @@ class NodeThread(Thread):
 
     def run(self):
         log.info("Starting Node Thread")
-        lastscan = time.time()
-        self.conn = connection.canbus.get_connection()
+        offline = self.bus.offline
+        now = lastscan = None
+        # We only deal with node alarms, parameters and node specific messages here
+        self.conn = self.bus.get_connection(ranges=[(0x001, 0x0FF), (0x100, 0x5FF),
+                                        (canfix.NODE_SPECIFIC_MSGS, canfix.TWOWAY_CONN_CHANS - 1)])
+        self.ready.set()
         while(not self.getout):
-            thisscan = time.time()
+            if not offline:
+                now = time.time()
             try:
                 msg = self.conn.recv(0.5)
+                if offline:
+                    now = msg.timestamp
                 x = canfix.parseMessage(msg)
-                self.update_node(x)
+                self.update_node(x, now)
             except connection.Timeout:
                 pass
             except Exception as e:
                 log.error(e)
-            if thisscan > lastscan + 2:
-                self.checkall()
-                lastscan = thisscan
-
-
+            if now is None:
+                continue
+            if lastscan is None:
+                lastscan = now
+            elif now > lastscan + 2 or now < lastscan:
+                self.checkall(now)
+                lastscan = now
+        self.bus.free_connection(self.conn)
 
     def stop(self):
         self.getout = True
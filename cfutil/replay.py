@@ -0,0 +1,213 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Replays a capture in place of the bus.  The Replay class has the same
+# connection interface as connection.CANBus so the NodeThread, the traffic
+# tab and anything else that gets its frames from a connection can be given
+# a Replay instead and will see the captured frames as if they were coming
+# from the network.  Nothing is ever sent, the frames that are sent on a
+# replay connection are counted and thrown away.
+
+import logging
+import threading
+import time
+from . import capture
+from . import connection
+
+log = logging.getLogger(__name__)
+
+
+class Replay(threading.Thread):
+    # The frames don't come from a live bus.  Things that age data use the
+    # frame timestamps instead of the clock.
+    offline = True
+
+    # speed is the multiple of the captured rate that the frames are sent at
+    # and 0 sends them as fast as the connections take them.  start is the
+    # capture time to start at.
+    def __init__(self, filename, speed=1.0, start=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.getout = False
+        self.reader = capture.CaptureReader(filename) if isinstance(filename, str) else filename
+        self.connected = False
+        self.interface = "replay"
+        self.__connections = []
+        self.__index = {}
+        self.__cond = threading.Condition()
+        self.__speed = speed
+        self.__paused = False
+        self.__position = 0
+        self.__frames = None
+        # Capture time and clock time that the pacing is measured from
+        self.__anchor = (0.0, 0.0)
+        # Time of the last frame that was sent to the connections
+        self.time = None
+        self.finished = threading.Event()
+        # Counters
+        self.recvFrames = 0
+        self.sendFrames = 0
+        # Callback functions
+        self.recvMessageCallback = None
+        self.finishedCallback = None
+        if start is not None:
+            self.seek(start)
+
+    def __len__(self):
+        return len(self.reader)
+
+    # Number of the next frame to be sent
+    @property
+    def position(self):
+        return self.__position
+
+    @property
+    def timeRange(self):
+        return self.reader.timeRange
+
+    @property
+    def paused(self):
+        return self.__paused
+
+    @property
+    def speed(self):
+        return self.__speed
+
+    @speed.setter
+    def speed(self, speed):
+        with self.__cond:
+            self.__speed = speed
+            self.__setAnchor()
+            self.__cond.notify_all()
+
+    # Measure the pacing from the next frame starting now
+    def __setAnchor(self):
+        if self.__position < len(self.reader):
+            self.__anchor = (self.reader.timestamp(self.__position), time.time())
+
+    def pause(self):
+        with self.__cond:
+            self.__paused = True
+            self.__cond.notify_all()
+
+    def resume(self):
+        with self.__cond:
+            self.__paused = False
+            self.__setAnchor()
+            self.__cond.notify_all()
+
+    # Moves to the first frame at or after capture time t
+    def seek(self, t):
+        self.seekFrame(self.reader.find(t))
+
+    def seekFrame(self, n):
+        with self.__cond:
+            self.__position = max(0, min(n, len(self.reader)))
+            self.__frames = None
+            self.__setAnchor()
+            if self.__position < len(self.reader):
+                self.finished.clear()
+            self.__cond.notify_all()
+
+    # Returns the connections that should receive a frame with the given id
+    def __dispatch(self, arbitration_id):
+        c = self.__index.get(arbitration_id)
+        if c is None:
+            c = self.__index[arbitration_id] = tuple(x for x in self.__connections if x.accepts(arbitration_id))
+        return c
+
+    # Connections work like the ones from CANBus.get_connection() except that
+    # by default a full receive buffer holds up the replay instead of losing
+    # frames.
+    def get_connection(self, ids=None, ranges=None, masks=None, predicate=None,
+                       bufferSize=connection.DEFAULT_BUFFER_SIZE, overflow=connection.BLOCK, limiter=None):
+        c = connection.Connection(self.send, ids=ids, ranges=ranges, masks=masks, predicate=predicate,
+                                  bufferSize=bufferSize, overflow=overflow)
+        with self.__cond:
+            self.__connections = self.__connections + [c]
+            self.__index = {}
+        return c
+
+    def free_connection(self, c):
+        with self.__cond:
+            self.__connections = [x for x in self.__connections if x is not c]
+            self.__index = {}
+        c.recvQueue.close()
+
+    def connection_statistics(self):
+        return [c.statistics() for c in self.__connections]
+
+    def send(self, msg):
+        self.sendFrames += 1
+        return False
+
+    # Waits until the next frame is due.  Returns the frame or None if we
+    # were paused, moved or stopped while waiting.
+    def __next(self):
+        with self.__cond:
+            if self.__paused or self.__position >= len(self.reader):
+                self.__cond.wait(0.5)
+                return None
+            if self.__frames is None:
+                self.__frames = self.reader.messages(start=self.__position)
+            msg = next(self.__frames)
+            # The speed can be changed while we wait so the time that the
+            # frame is due is worked out again each time we wake up
+            while self.__speed > 0 and not self.getout:
+                wait = self.__anchor[1] + (msg.timestamp - self.__anchor[0]) / self.__speed - time.time()
+                if wait <= 0:
+                    break
+                position = self.__position
+                self.__cond.wait(wait)
+                if self.__paused or self.__position != position:
+                    self.__frames = None
+                    return None
+            if self.getout:
+                return None
+            self.__position += 1
+            return msg
+
+    def run(self):
+        while not self.getout:
+            try:
+                msg = self.__next()
+            except Exception as e:
+                log.error(f"Replay error: {e}")
+                self.pause()
+                continue
+            if msg is not None:
+                self.time = msg.timestamp
+                for each in self.__dispatch(msg.arbitration_id):
+                    each.put(msg)
+                if self.recvMessageCallback is not None:
+                    self.recvMessageCallback(msg)
+                self.recvFrames += 1
+            if self.__position >= len(self.reader) and not self.finished.is_set():
+                self.finished.set()
+                if self.finishedCallback is not None:
+                    self.finishedCallback()
+        self.reader.close()
+
+    def stop(self):
+        self.getout = True
+        with self.__cond:
+            self.__cond.notify_all()
+        # Lets the thread go if it is waiting on a full buffer
+        for c in self.__connections:
+            c.recvQueue.close()
+        if not self.is_alive():
+            self.reader.close()
@@ -21,11 +21,14 @@
 import os
 import json
 import logging
+import threading
 from . import config
 
 log = logging.getLogger(__name__)
 
 __data = {"version":1}
+# Firmware downloads save their checkpoints from their own threads
+__lock = threading.RLock()
 
 #datapath = appdirs.user_data_dir() + "/cfutil/"
 datapath = config.datapath
@@ -33,8 +36,9 @@ datapath = config.datapath
 log.info("Loading Settings")
 
 def save_file():
-    with open(datapath + "/settings.json", "w") as file:
-        json.dump(__data, file, indent=2)
+    with __lock:
+        with open(datapath + "/settings.json", "w") as file:
+            json.dump(__data, file, indent=2)
 
 def run():
     global __data
@@ -53,8 +57,9 @@ def get(key):
     return __data.get(key, None)
 
 def set(key, v, save=True):
-    __data[key] = v
-    if save:
-        save_file()
+    with __lock:
+        __data[key] = v
+        if save:
+            save_file()
 
 run()
\ No newline at end of file
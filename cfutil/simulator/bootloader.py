@@ -0,0 +1,309 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Simulated bootloaders for the firmware download protocols.  These are the
+# node side of the drivers in cfutil.firmware.drivers.  A bootloader is
+# started by its node when the node gets an Update Firmware request and it
+# gets every frame on the two way channels until the download is finished.
+
+import time
+import struct
+import functools
+import can
+from ..firmware import crc
+from ..firmware.drivers import STM32_AHRS
+
+
+# Memory that reads as erased (0xFF) where nothing has been written.  It is
+# kept in pages so that the bootloaders can use the real addresses.
+class Memory:
+    PAGE = 256
+
+    def __init__(self):
+        self.pages = {}
+
+    def write(self, address, data):
+        for n, byte in enumerate(data):
+            page, offset = divmod(address + n, self.PAGE)
+            if page not in self.pages:
+                self.pages[page] = bytearray(b'\xFF' * self.PAGE)
+            self.pages[page][offset] = byte
+
+    def read(self, address, length):
+        data = bytearray()
+        while length > 0:
+            page, offset = divmod(address, self.PAGE)
+            n = min(self.PAGE - offset, length)
+            data += self.pages.get(page, b'\xFF' * self.PAGE)[offset:offset+n]
+            address += n
+            length -= n
+        return bytes(data)
+
+
+class Bootloader:
+    def __init__(self, programTime=0.0):
+        # Time it takes to write a block or page to flash
+        self.programTime = programTime
+        self.active = False
+        self.node = None
+        self.channel = None
+        self.downloads = 0
+        self.framesReceived = 0
+
+    # Called by the node when it gets the Update Firmware request
+    def start(self, node, channel):
+        self.node = node
+        self.channel = channel
+        self.active = True
+        self.reset()
+
+    # Called when the download is finished.  The node goes back to running.
+    def finish(self):
+        self.active = False
+        self.downloads += 1
+
+    def reset(self):
+        pass
+
+    # The arbitration id of the frames that the host sends us.  We answer
+    # on the next one.  This is the first id of our two way channel.
+    def requestId(self):
+        return 0x7E0 + self.channel * 2
+
+    def receive(self, msg):
+        if msg.arbitration_id != self.requestId():
+            return
+        self.framesReceived += 1
+        self.request(bytes(msg.data))
+
+    # Handles the data of a frame from the host.  The protocols answer here.
+    def request(self, data):
+        pass
+
+    def reply(self, data, delay=0.0):
+        self.node.send(can.Message(arbitration_id=self.requestId() + 1,
+                                   is_extended_id=False, data=data), delay)
+
+
+# The BASIC protocol.  See docs/firmware_basic.rst.  window is the largest
+# transfer window that we agree to.  If it is 0 the bootloader doesn't know
+# about the Transfer Options frame at all, like the older bootloaders.  If
+# resume is True we agree to resume blocks.  Until the host has asked for
+# that we erase the memory of the whole block when a block starts, the way a
+# bootloader that erases a page before writing it would.  If reportBlocksize
+# is True we tell the host that we take blocks of up to maxBlocksize.
+class BasicBootloader(Bootloader):
+    def __init__(self, window=8, blockCrc=True, maxBlocksize=4096, programTime=0.0, blockTypes=None,
+                 resume=True, reportBlocksize=True):
+        Bootloader.__init__(self, programTime)
+        self.window = window
+        self.blockCrc = blockCrc
+        self.maxBlocksize = maxBlocksize
+        self.resume = resume
+        self.reportBlocksize = reportBlocksize
+        # The block types that we accept or None for any of them
+        self.blockTypes = blockTypes
+        # Memory for each (block type, subsystem)
+        self.memory = {}
+        self.blocksWritten = 0
+
+    def reset(self):
+        self.__block = None
+        self.__data = bytearray()
+        self.__resuming = False
+
+    def __memory(self, blocktype, subsystem):
+        return self.memory.setdefault((blocktype, subsystem), Memory())
+
+    def request(self, data):
+        if self.__block is not None:
+            self.__blockData(data)
+        elif len(data) == 0:
+            self.reply([]) # Nothing open, but the host wants an end of block ack
+        elif data[0] == 0xFD: # Download complete
+            self.reply(data)
+            self.finish()
+        elif data[0] == 0xFE: # Abort
+            self.reply(data)
+        elif data[0] == 0xFC and self.window:
+            self.__transferOption(data)
+        elif data[0] == 0xFB and self.window and self.blockCrc and len(data) == 8:
+            size = 1 << data[3]
+            address = int.from_bytes(data[4:8], 'little')
+            result = crc.crc16(self.__memory(data[1], data[2]).read(address, size)).getResult()
+            self.reply([0xFB, result & 0xFF, result >> 8])
+        elif len(data) == 7:
+            self.__startBlock(data)
+        else:
+            self.reply([0xFF, 0x00])
+
+    def __transferOption(self, data):
+        option = data[1] if len(data) > 1 else 0
+        value = data[2] if len(data) > 2 else 0
+        if option == 0x01:
+            self.reply([0xFC, 0x81, max(min(self.window, value), 1)])
+        elif option == 0x02:
+            self.reply([0xFC, 0x82, 1 if self.blockCrc and value else 0])
+        elif option == 0x03:
+            self.__resuming = bool(self.resume and value)
+            self.reply([0xFC, 0x83, int(self.__resuming)])
+        elif option == 0x04 and self.reportBlocksize:
+            self.reply([0xFC, 0x84, min(self.maxBlocksize.bit_length() - 1, value)])
+        else:
+            self.reply([0xFC, option | 0x80, 0])
+
+    def __startBlock(self, data):
+        blocktype, subsystem = data[0], data[1]
+        size = 1 << data[2]
+        address = int.from_bytes(data[3:7], 'little')
+        if self.blockTypes is not None and blocktype not in self.blockTypes:
+            self.reply([0xFF, 0x00])
+        elif size > self.maxBlocksize or size < 8:
+            self.reply([0xFF, 0x02])
+        else:
+            if not self.__resuming:
+                page = address - address % size
+                self.__memory(blocktype, subsystem).write(page, b'\xFF' * size)
+            self.__block = (blocktype, subsystem, address, size)
+            self.__data = bytearray()
+            self.reply(data)
+
+    def __blockData(self, data):
+        blocktype, subsystem, address, size = self.__block
+        if len(data) == 0: # End of block.  The ack waits for the write.
+            self.__memory(blocktype, subsystem).write(address, self.__data[:size])
+            self.blocksWritten += 1
+            self.__block = None
+            self.reply([], self.programTime)
+            return
+        offset = len(self.__data)
+        self.__data += data
+        self.reply(offset.to_bytes(4, 'little'))
+
+
+# The AVR8 bootloader.  The host fills a page buffer then has us erase and
+# write the page.  With two buffers the erase and write happen while the
+# host fills the other buffer so the echoes come back after the time they
+# take, in the order they were asked for.
+class AVR8Bootloader(Bootloader):
+    def __init__(self, pagesize=128, buffers=1, eraseTime=0.0, writeTime=0.0):
+        Bootloader.__init__(self, writeTime)
+        self.pagesize = pagesize
+        self.buffers = buffers
+        self.eraseTime = eraseTime
+        self.flash = Memory()
+        self.pagesWritten = 0
+        # The checksum and size that the host sent with the complete command
+        self.result = None
+
+    def reset(self):
+        self.__buffers = [bytearray() for _ in range(max(self.buffers, 1))]
+        self.__filling = None
+        self.__busyUntil = 0.0
+
+    # Returns how long to wait to answer a command that keeps the flash busy
+    # for t seconds.  Each one starts when the one before it finishes.
+    def __busy(self, t):
+        now = time.time()
+        self.__busyUntil = max(self.__busyUntil, now) + t
+        return self.__busyUntil - now
+
+    def request(self, data):
+        if self.__filling is not None and len(data) == 8:
+            buffer = self.__buffers[self.__filling]
+            buffer += data
+            if len(buffer) >= self.pagesize:
+                self.__filling = None
+            self.reply(len(buffer).to_bytes(2, 'little'))
+            return
+        if len(data) == 0:
+            return
+        cmd = data[0]
+        if cmd == 0x01: # Fill buffer
+            buffer = data[5] if len(data) > 5 and data[5] < len(self.__buffers) else 0
+            self.__buffers[buffer] = bytearray()
+            self.__filling = buffer
+            self.reply(data)
+        elif cmd == 0x02: # Erase page
+            self.__filling = None
+            self.reply(data, self.__busy(self.eraseTime))
+        elif cmd == 0x03: # Write page
+            self.__filling = None
+            buffer = data[5] if len(data) > 5 and data[5] < len(self.__buffers) else 0
+            self.flash.write(int.from_bytes(data[1:5], 'little'), self.__buffers[buffer][:self.pagesize])
+            self.pagesWritten += 1
+            self.reply(data, self.__busy(self.programTime))
+        elif cmd == 0x05: # Download complete
+            self.result = (int.from_bytes(data[1:3], 'little'), int.from_bytes(data[3:7], 'little'))
+            self.reply(data, self.__busy(0.0))
+            self.finish()
+        elif cmd == 0x06 and self.buffers > 1: # Older bootloaders ignore this
+            self.reply([0x06, self.buffers])
+
+
+# The bootloader of the STM32 based AHRS.  The host has us erase flash
+# sectors, then sends each segment as an address / length frame followed by
+# the data eight bytes at a time.  An address and length of 0 ends it.
+class STM32Bootloader(Bootloader):
+    def __init__(self, eraseTime=0.0, programTime=0.0):
+        Bootloader.__init__(self, programTime)
+        self.eraseTime = eraseTime
+        self.flash = Memory()
+        self.sectorsErased = 0
+
+    def reset(self):
+        self.__erasing = True
+        self.__address = None
+        self.__remaining = 0
+
+    def request(self, data):
+        if self.__erasing:
+            if len(data) != 1:
+                return
+            if data[0] == STM32_AHRS.ERASE_DONE:
+                self.__erasing = False
+                self.reply([STM32_AHRS.RET_ERASE_DONE])
+            elif data[0] in STM32_AHRS.SECTORS:
+                lo, hi = STM32_AHRS.SECTORS[data[0]]
+                for page in range(lo // Memory.PAGE, hi // Memory.PAGE):
+                    self.flash.pages.pop(page, None)
+                self.sectorsErased += 1
+                self.reply([STM32_AHRS.RET_ERASE], self.eraseTime)
+        elif self.__remaining > 0:
+            n = min(len(data), self.__remaining)
+            self.flash.write(self.__address, data[:n])
+            self.__address += n
+            self.__remaining -= n
+            if self.__remaining > 0:
+                self.reply([STM32_AHRS.RET_DATA])
+            else:
+                self.reply([STM32_AHRS.RET_SEGMENT_DONE], self.programTime)
+        elif len(data) == 8:
+            self.__address, self.__remaining = struct.unpack('<II', data)
+            if self.__address == 0 and self.__remaining == 0:
+                self.reply([STM32_AHRS.RET_COMPLETE])
+                self.finish()
+            else:
+                self.reply([STM32_AHRS.RET_SEGMENT])
+
+
+# The bootloaders for the firmware_driver names in the EDS files.  These are
+# the driver names that cfutil.firmware.Firmware() takes.
+bootloaders = {"BASIC": BasicBootloader,
+               "AT328": functools.partial(AVR8Bootloader, pagesize=128),
+               "AT2561": functools.partial(AVR8Bootloader, pagesize=256),
+               "STM32_AHRS": STM32Bootloader}
@@ -0,0 +1,141 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# The simulated network is a single thread that owns the bus connection.  It
+# hands every frame that it receives to each of the nodes and sends the frames
+# that the nodes give it, either right away or after a delay.  The periodic
+# work of the nodes, like publishing parameters, is run from the same thread
+# so the nodes never need any locking of their own.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+import can
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = "cfutil-sim"
+
+
+class Network(threading.Thread):
+    def __init__(self, channel=DEFAULT_CHANNEL, interface="virtual", **kwargs):
+        threading.Thread.__init__(self, daemon=True)
+        self.channel = channel
+        self.interface = interface
+        self.bus = can.Bus(interface=interface, channel=channel, **kwargs)
+        self.getout = False
+        self.nodes = {}
+        self.framesSent = 0
+        self.framesReceived = 0
+        # Heap of (time, sequence, function) for everything that is to be
+        # done later.  The sequence keeps things that are due at the same
+        # time in the order that they were scheduled.
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.__lock = threading.Lock()
+
+    def addNode(self, node):
+        with self.__lock:
+            self.nodes[node.nodeid] = node
+        node.attach(self)
+
+    def removeNode(self, nodeid):
+        with self.__lock:
+            node = self.nodes.pop(nodeid, None)
+        if node is not None:
+            node.detach()
+
+    # Calls func with no arguments at the given time.  This is how the nodes
+    # delay their responses and schedule their periodic messages.
+    def schedule(self, when, func):
+        with self.__lock:
+            heapq.heappush(self.__queue, (when, next(self.__sequence), func))
+
+    # Calls func every interval seconds, starting at the given time, until
+    # the network is stopped
+    def every(self, interval, func, when=None):
+        if when is None:
+            when = time.time()
+        def tick():
+            if self.getout:
+                return
+            func()
+            self.every(interval, func, max(when + interval, time.time()))
+        self.schedule(when, tick)
+
+    # Sends msg on the bus after delay seconds
+    def send(self, msg, delay=0.0):
+        if delay > 0:
+            self.schedule(time.time() + delay, lambda: self.__send(msg))
+        else:
+            self.__send(msg)
+
+    def __send(self, msg):
+        try:
+            self.bus.send(msg)
+            self.framesSent += 1
+        except can.CanError as e:
+            log.error(f"Simulator send error: {e}")
+
+    # Runs everything in the queue that is due and returns the time until
+    # the next item is due or None if the queue is empty.
+    def __runDue(self):
+        while True:
+            with self.__lock:
+                if not self.__queue:
+                    return None
+                wait = self.__queue[0][0] - time.time()
+                if wait > 0:
+                    return wait
+                func = heapq.heappop(self.__queue)[2]
+            try:
+                func()
+            except Exception as e:
+                log.error(f"Simulator error: {e}")
+
+    def run(self):
+        while not self.getout:
+            wait = self.__runDue()
+            wait = 0.1 if wait is None else min(wait, 0.1)
+            msg = self.bus.recv(wait)
+            if msg is None:
+                continue
+            self.framesReceived += 1
+            with self.__lock:
+                nodes = list(self.nodes.values())
+            for node in nodes:
+                try:
+                    node.receive(msg)
+                except Exception as e:
+                    log.error(f"Simulated node {node.nodeid} error: {e}")
+        self.bus.shutdown()
+
+    def stop(self):
+        self.getout = True
+        if self.is_alive():
+            self.join()
+        else:
+            self.bus.shutdown()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
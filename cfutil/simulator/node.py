@@ -0,0 +1,324 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# A simulated CAN-FIX node.  The node publishes its parameters and node
+# status, answers the node specific messages that the utility uses and keeps
+# its configuration in a key store that is built from an EDS file.  If it is
+# given a bootloader, an Update Firmware request hands the node over to it
+# until the download is finished.
+
+import json
+import logging
+import math
+import random
+import time
+from collections import OrderedDict
+import can
+import canfix
+from . import bootloader as bootloaders
+
+log = logging.getLogger(__name__)
+
+# How many times a second the parameters are published if we aren't told
+DEFAULT_RATE = 10.0
+
+# Error codes in the Node Configuration responses
+KEY_NOT_FOUND = 0x01
+BAD_VALUE = 0x02
+
+# Update Firmware error code for a bad verification code or no bootloader
+FIRMWARE_REFUSED = 0x01
+
+# Types that we can make up values for
+NUMERIC_TYPES = ("BYTE", "WORD", "SHORT", "USHORT", "INT", "UINT", "DINT", "UDINT", "FLOAT")
+
+
+# Reads an EDS file and returns it as a dictionary
+def loadEDS(filename):
+    with open(filename) as file:
+        return json.load(file, object_pairs_hook=OrderedDict)
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+class Parameter:
+    """A parameter that a simulated node publishes.  value can be a constant,
+       a function that is given the time and returns the value or None in
+       which case the value is a sine wave over the range of the parameter."""
+    def __init__(self, pid, rate=DEFAULT_RATE, value=None, index=0, period=10.0):
+        self.pid = pid
+        self.rate = rate
+        self.value = value
+        self.index = index
+        self.period = period
+        self.definition = canfix.protocol.parameters.get(pid)
+        if self.definition is None:
+            raise ValueError(f"Unknown parameter 0x{pid:03X}")
+        if value is None and self.definition.type not in NUMERIC_TYPES:
+            raise ValueError(f"Parameter 0x{pid:03X} of type {self.definition.type} needs a value")
+        try:
+            low, high = float(self.definition.min), float(self.definition.max)
+        except (TypeError, ValueError):
+            low, high = 0.0, 100.0
+        self.__middle = (low + high) / 2
+        self.__amplitude = (high - low) * 0.4
+        self.__phase = (pid % 16) / 16 * 2 * math.pi
+
+    def getValue(self, t):
+        if callable(self.value):
+            return self.value(t)
+        if self.value is not None:
+            return self.value
+        return self.__middle + self.__amplitude * math.sin(2 * math.pi * t / self.period + self.__phase)
+
+    def getMessage(self, nodeid, t):
+        p = canfix.Parameter()
+        p.identifier = self.pid
+        p.node = nodeid
+        p.index = self.index
+        p.value = self.getValue(t)
+        return p.msg
+
+
+class Node:
+    def __init__(self, nodeid, device=None, model=None, version=None, description=None,
+                 eds=None, parameters=None, bootloader=None, firmwareCode=None,
+                 latency=0.0, loss=0.0, statusInterval=1.0, seed=None):
+        if isinstance(eds, str):
+            eds = loadEDS(eds)
+        eds = eds or {}
+        self.nodeid = nodeid
+        self.device = device if device is not None else _int(eds.get("type", 0))
+        self.model = model if model is not None else _int(eds.get("model", 0))
+        self.version = version if version is not None else _int(eds.get("version", 0))
+        self.description = description if description is not None else eds.get("name", "")
+        if firmwareCode is None and "firmware_code" in eds:
+            firmwareCode = _int(eds["firmware_code"])
+        self.firmwareCode = firmwareCode
+        if parameters is None:
+            parameters = []
+            for pid in eds.get("parameters", []):
+                try:
+                    parameters.append(Parameter(_int(pid)))
+                except ValueError as e:
+                    log.warning(f"Simulated node {nodeid} not publishing: {e}")
+        self.parameters = parameters
+        if bootloader is None and eds.get("firmware_driver") in bootloaders.bootloaders:
+            bootloader = bootloaders.bootloaders[eds["firmware_driver"]]()
+        self.bootloader = bootloader
+        self.latency = latency
+        self.loss = loss
+        self.statusInterval = statusInterval
+        self.network = None
+        self.configReads = 0
+        self.configWrites = 0
+        self.framesLost = 0
+        self.__random = random.Random(seed)
+
+        # The configuration is kept as the raw bytes of each key
+        self.items = OrderedDict()
+        self.configuration = {}
+        for item in eds.get("configuration", []):
+            self.items[item["key"]] = item
+        for key in self.items:
+            if "depends" not in self.items[key]:
+                self.__setDefault(key)
+        for key in self.items:
+            if "depends" in self.items[key]:
+                self.__setDefault(key)
+
+        self.__handlers = {0x00: self.__identify,
+                           0x07: self.__updateFirmware,
+                           0x09: self.__setConfiguration,
+                           0x0A: self.__queryConfiguration,
+                           0x0B: self.__describe}
+
+    @property
+    def inBootloader(self):
+        return self.bootloader is not None and self.bootloader.active
+
+    # Returns the (type, multiplier) of a configuration key.  The type of a
+    # dependent key comes from the current value of the key it depends on.
+    # Returns None if the key doesn't have a type right now.
+    def itemType(self, key):
+        item = self.items[key]
+        mult = item.get("multiplier", 1.0)
+        if "depends" not in item:
+            return item["type"], mult
+        parent = self.getValue(item["depends"]["key"])
+        for de in item["depends"]["definitions"]:
+            compare = de["compare"] if isinstance(de["compare"], list) else [de["compare"]]
+            if parent in compare:
+                return de["type"], mult
+        return None
+
+    def getValue(self, key):
+        t = self.itemType(key)
+        if t is None or key not in self.configuration:
+            return None
+        return canfix.utils.getValue(t[0], self.configuration[key], t[1])
+
+    def setValue(self, key, value):
+        t = self.itemType(key)
+        if t is None:
+            raise ValueError(f"Configuration key {key} has no type")
+        self.configuration[key] = bytes(canfix.utils.setValue(t[0], value, t[1]))
+        self.__checkChildren(key)
+
+    def __setDefault(self, key):
+        t = self.itemType(key)
+        if t is None:
+            self.configuration.pop(key, None)
+            return
+        value = self.items[key].get("default", 0)
+        self.configuration[key] = bytes(canfix.utils.setValue(t[0], value, t[1]))
+
+    # When a key changes the keys that depend on it may have a different
+    # type, so the ones that no longer fit are set back to their defaults.
+    def __checkChildren(self, key):
+        for child, item in self.items.items():
+            if "depends" in item and item["depends"]["key"] == key:
+                t = self.itemType(child)
+                old = self.configuration.get(child)
+                if t is None or old is None or len(old) != canfix.utils.getTypeSize(t[0]):
+                    self.__setDefault(child)
+
+    # Called by the network when the node is added to it.  The status and
+    # parameters start at random times so the nodes don't all send at once.
+    def attach(self, network):
+        self.network = network
+        now = time.time()
+        if self.statusInterval:
+            self.__every(network, now + self.__random.random() * self.statusInterval,
+                         self.statusInterval, self.__sendStatus)
+        for p in self.parameters:
+            if p.rate:
+                interval = 1.0 / p.rate
+                self.__every(network, now + self.__random.random() * interval, interval,
+                             lambda p=p: self.send(p.getMessage(self.nodeid, time.time())))
+
+    def detach(self):
+        self.network = None
+
+    # Runs func every interval seconds while the node is on network.  If the
+    # network falls behind the missed ones are skipped instead of all being
+    # sent at once.
+    def __every(self, network, when, interval, func):
+        def tick():
+            if self.network is not network:
+                return
+            if not self.inBootloader:
+                func()
+            self.__every(network, max(when + interval, time.time()), interval, func)
+        network.schedule(when, tick)
+
+    def __lost(self):
+        if self.loss and self.__random.random() < self.loss:
+            self.framesLost += 1
+            return True
+        return False
+
+    # Sends a frame from the node after the node's latency plus delay
+    def send(self, msg, delay=0.0):
+        if self.network is None or self.__lost():
+            return
+        self.network.send(msg, self.latency + delay)
+
+    def __respond(self, data, delay=0.0):
+        self.send(can.Message(arbitration_id=canfix.NODE_SPECIFIC_MSGS + self.nodeid,
+                              is_extended_id=False, data=data), delay)
+
+    # Called by the network with every frame that is on the bus
+    def receive(self, msg):
+        aid = msg.arbitration_id
+        if self.inBootloader:
+            if aid >= canfix.TWOWAY_CONN_CHANS and not self.__lost():
+                self.bootloader.receive(msg)
+            return
+        if aid < canfix.NODE_SPECIFIC_MSGS or aid >= canfix.TWOWAY_CONN_CHANS or len(msg.data) < 2:
+            return
+        code, dest = msg.data[0], msg.data[1]
+        # Node Identification is the only request that is broadcast
+        if dest != self.nodeid and not (dest == 0 and code == 0x00):
+            return
+        handler = self.__handlers.get(code)
+        if handler is None or self.__lost():
+            return
+        handler(aid - canfix.NODE_SPECIFIC_MSGS, bytes(msg.data))
+
+    def __sendStatus(self):
+        s = canfix.NodeStatus(parameter=0, value=0)
+        s.sendNode = self.nodeid
+        self.send(s.msg)
+
+    def __identify(self, src, data):
+        if len(data) != 2:
+            return # This is somebody else's response
+        msg = canfix.NodeIdentification()
+        msg.sendNode = self.nodeid
+        msg.destNode = src
+        msg.device = self.device
+        msg.fwrev = self.version
+        msg.model = self.model
+        self.send(msg.msg)
+
+    # Sends the description four characters at a time
+    def __describe(self, src, data):
+        if len(data) == 8:
+            return
+        chars = self.description.encode()
+        for n in range(0, max(len(chars), 1), 4):
+            packet = n // 4
+            self.__respond(bytes([0x0B, src, packet & 0xFF, packet >> 8]) + chars[n:n+4].ljust(4, b'\x00'))
+
+    def __updateFirmware(self, src, data):
+        if len(data) != 5:
+            return
+        code = data[2] | data[3] << 8
+        if self.bootloader is None or (self.firmwareCode is not None and code != self.firmwareCode):
+            self.__respond([0x07, src, FIRMWARE_REFUSED])
+            return
+        self.__respond([0x07, src, 0x00])
+        self.bootloader.start(self, data[4])
+
+    def __queryConfiguration(self, src, data):
+        if len(data) != 4:
+            return
+        key = data[2] | data[3] << 8
+        self.configReads += 1
+        value = self.configuration.get(key)
+        if value is None:
+            self.__respond([0x0A, src, KEY_NOT_FOUND])
+        else:
+            self.__respond(bytes([0x0A, src, 0x00]) + value)
+
+    def __setConfiguration(self, src, data):
+        if len(data) < 5:
+            return
+        key = data[2] | data[3] << 8
+        if key not in self.items or self.itemType(key) is None:
+            self.__respond([0x09, src, KEY_NOT_FOUND])
+            return
+        size = canfix.utils.getTypeSize(self.itemType(key)[0])
+        if len(data) - 4 < size:
+            self.__respond([0x09, src, BAD_VALUE])
+            return
+        self.configWrites += 1
+        self.configuration[key] = data[4:4+size]
+        self.__checkChildren(key)
+        self.__respond([0x09, src, 0x00])
@@ -0,0 +1,152 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Downloads to a simulated BASIC bootloader on the virtual bus
+
+import argparse
+import tempfile
+import unittest
+from unittest import mock
+import canfix
+from cfutil import config
+
+CHANNEL = "cfutil-test"
+NODE = 0x31
+DEVICE = 0xFE
+MODEL = 1
+VCODE = 0x5A5A
+SIZE = 16384
+patches = []
+
+
+def patch(target, name, value):
+    patches.append(mock.patch.object(target, name, value))
+    patches[-1].start()
+
+
+def setUpModule():
+    global datadir
+    config.initialize(argparse.Namespace(interface="virtual", channel=CHANNEL, bitrate=None))
+    # Downloads save their checkpoints and block sizes in the settings so
+    # those go to a directory of our own instead of the user's
+    datadir = tempfile.TemporaryDirectory()
+    patch(config, "datapath", datadir.name)
+    from cfutil import settings
+    patch(settings, "datapath", datadir.name)
+    patch(settings, "__data", {"version": 1})
+    from cfutil import connection
+    if not connection.canbus.connected:
+        connection.canbus.connect("virtual", channel=CHANNEL)
+
+
+def tearDownModule():
+    while patches:
+        patches.pop().stop()
+    datadir.cleanup()
+
+
+class TestBasicDownload(unittest.TestCase):
+    def setUp(self):
+        from cfutil import benchmark
+        self.directory = tempfile.TemporaryDirectory()
+        self.image, hexname, self.filename = benchmark.firmwareFiles(self.directory.name, SIZE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # Downloads the image to a node with the given bootloader and returns
+    # the driver once the download is over
+    def download(self, bootloader, loss=0.0, seed=1, **args):
+        from cfutil import connection
+        from cfutil import firmware
+        from cfutil import simulator
+        net = simulator.Network(CHANNEL)
+        node = simulator.Node(NODE, DEVICE, MODEL, 1, parameters=[], bootloader=bootloader,
+                              firmwareCode=VCODE, loss=loss, seed=seed, statusInterval=0)
+        net.addNode(node)
+        net.start()
+        conn = connection.canbus.get_connection(ranges=[(canfix.NODE_SPECIFIC_MSGS, 0x7FF)])
+        try:
+            fw = firmware.Firmware("BASIC", self.filename, NODE, VCODE, conn)
+            for key, value in args.items():
+                fw[key] = value
+            try:
+                fw.download()
+            finally:
+                fw.end_download()
+        finally:
+            connection.canbus.free_connection(conn)
+            net.stop()
+        return fw
+
+    def written(self, bootloader):
+        return bootloader.memory[(0, 0)].read(0, len(self.image))
+
+    def test_download(self):
+        from cfutil import simulator
+        for window in (1, 8):
+            with self.subTest(window=window):
+                bl = simulator.BasicBootloader()
+                fw = self.download(bl, window=window)
+                self.assertEqual(self.written(bl), self.image)
+                self.assertEqual(fw.resends, 0)
+
+    # A node that agrees to resume blocks gets a lost frame or acknowledgement
+    # again from the offset that it last acknowledged
+    def test_download_with_loss(self):
+        from cfutil import simulator
+        for window in (1, 8):
+            with self.subTest(window=window):
+                bl = simulator.BasicBootloader()
+                fw = self.download(bl, loss=0.01, window=window)
+                self.assertEqual(self.written(bl), self.image)
+                self.assertGreater(fw.resends, 0)
+                self.assertEqual(bl.downloads, 1)
+
+    # A node that doesn't resume blocks gets the whole block again and the
+    # block size is made smaller so that less is resent
+    def test_download_without_resume_with_loss(self):
+        from cfutil import simulator
+        bl = simulator.BasicBootloader(resume=False)
+        fw = self.download(bl, loss=0.01)
+        self.assertEqual(self.written(bl), self.image)
+        self.assertLess(fw.file.files[0].blocksize, 4096)
+
+    # Larger blocks than the file's are only sent when the node says that it
+    # takes them or when we are told to try them
+    def test_blocksize(self):
+        from cfutil import simulator
+        for args, expected in (({}, 4096), ({"reportBlocksize": False}, 256), ({"window": 0}, 256),
+                               ({"maxBlocksize": 1024}, 1024)):
+            with self.subTest(**args):
+                bl = simulator.BasicBootloader(**args)
+                fw = self.download(bl)
+                self.assertEqual(self.written(bl), self.image)
+                self.assertEqual(fw.file.files[0].blocksize, expected)
+
+    # Without a report from the node a probe goes down from the largest
+    # block size until the node accepts one
+    def test_blocksize_probe(self):
+        from cfutil import simulator
+        bl = simulator.BasicBootloader(maxBlocksize=1024, reportBlocksize=False)
+        fw = self.download(bl, probe=True)
+        self.assertEqual(self.written(bl), self.image)
+        self.assertEqual(fw.file.files[0].blocksize, 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#  CAN-FIX Utilities - An Open Source CAN FIX Utility Package
+#  Copyright (c) 2023 Phil Birkelbach
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Simulated nodes built from EDS files
+
+import argparse
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import canfix
+from cfutil import config
+
+CHANNEL = "cfutil-test"
+NODE = 0x32
+VCODE = 0x1234
+SIZE = 8192
+patches = []
+
+
+def patch(target, name, value):
+    patches.append(mock.patch.object(target, name, value))
+    patches[-1].start()
+
+
+def setUpModule():
+    global datadir
+    config.initialize(argparse.Namespace(interface="virtual", channel=CHANNEL, bitrate=None))
+    # Downloads save their checkpoints and block sizes in the settings so
+    # those go to a directory of our own instead of the user's
+    datadir = tempfile.TemporaryDirectory()
+    patch(config, "datapath", datadir.name)
+    from cfutil import settings
+    patch(settings, "datapath", datadir.name)
+    patch(settings, "__data", {"version": 1})
+    from cfutil import connection
+    if not connection.canbus.connected:
+        connection.canbus.connect("virtual", channel=CHANNEL)
+
+
+def tearDownModule():
+    while patches:
+        patches.pop().stop()
+    datadir.cleanup()
+
+
+class TestEDSNode(unittest.TestCase):
+    def setUp(self):
+        from cfutil import benchmark
+        self.directory = tempfile.TemporaryDirectory()
+        self.image, self.hexname, stdname = benchmark.firmwareFiles(self.directory.name, SIZE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def eds(self, driver):
+        filename = os.path.join(self.directory.name, f"{driver}.json")
+        with open(filename, "w") as f:
+            json.dump({"name": f"{driver} Device", "type": "0x40", "model": "0x000002", "version": "0x01",
+                       "firmware_code": hex(VCODE), "firmware_driver": driver}, f)
+        return filename
+
+    # The node gets the bootloader for the firmware driver that its EDS file
+    # names and a download with that driver writes the image to its flash.
+    # The first channel is taken so that the download uses another one.
+    def test_avr_download(self):
+        from cfutil import connection
+        from cfutil import firmware
+        from cfutil import simulator
+        taken = connection.canbus.allocate_channel(owner="test")
+        self.addCleanup(connection.canbus.release_channel, taken)
+        for driver, pagesize in (("AT328", 128), ("AT2561", 256)):
+            with self.subTest(driver=driver):
+                node = simulator.Node(NODE, eds=self.eds(driver), statusInterval=0)
+                self.assertIsInstance(node.bootloader, simulator.AVR8Bootloader)
+                self.assertEqual(node.bootloader.pagesize, pagesize)
+                net = simulator.Network(CHANNEL)
+                net.addNode(node)
+                net.start()
+                conn = connection.canbus.get_connection(ranges=[(canfix.NODE_SPECIFIC_MSGS, 0x7FF)])
+                try:
+                    fw = firmware.Firmware(driver, self.hexname, NODE, VCODE, conn)
+                    try:
+                        fw.download()
+                    finally:
+                        fw.end_download()
+                finally:
+                    connection.canbus.free_connection(conn)
+                    net.stop()
+                self.assertEqual(node.bootloader.flash.read(0, len(self.image)), self.image)
+                self.assertEqual(node.bootloader.downloads, 1)
+
+    def test_no_bootloader(self):
+        from cfutil import simulator
+        self.assertIsNone(simulator.Node(NODE, eds=self.eds("DUMMY")).bootloader)
+
+
+if __name__ == '__main__':
+    unittest.main()